@@ -4,11 +4,19 @@ import logging
 import os
 import time
 import gc
+import io
+import tempfile
+import functools
+import heapq
 import re
 import collections
+import concurrent.futures
+import sqlite3
+import socket
+from abc import ABC, abstractmethod
 from collections import defaultdict, OrderedDict
+from types import MappingProxyType
 from uuid import uuid4
-import asyncpg
 from telethon import TelegramClient, events, Button
 from telethon.sessions import StringSession
 from telethon.errors import (
@@ -33,13 +41,15 @@ from telethon.errors import (
     RpcCallFailError,
     BotMethodInvalidError,
     UserNotMutualContactError,
-    UserPrivacyRestrictedError
+    UserPrivacyRestrictedError,
+    SlowModeWaitError,
+    FileReferenceExpiredError
 )
 from telethon.tl.types import MessageEntityBlockquote, MessageEntitySpoiler, MessageEntityTextUrl, MessageEntityCustomEmoji
-from telethon.tl.types import Channel, Chat, PeerUser, PeerChat, PeerChannel
+from telethon.tl.types import Channel, Chat, PeerUser, PeerChat, PeerChannel, InputPeerChannel, InputPeerChat, InputPeerUser
+from telethon.tl.types import InputPhoto, InputDocument
 from telethon.tl import functions
-from telethon.utils import get_peer_id 
-import copy
+from telethon.utils import get_peer_id, resolve_id 
 import datetime
 
 # --- Konfigurasi Logging ---
@@ -54,15 +64,21 @@ logger = logging.getLogger(__name__)
 logging.getLogger('telethon').setLevel(logging.WARNING)
 
 # --- Konfigurasi Utama ---
-ADMIN_IDS = [, ] 
+ADMIN_IDS = [int(admin_id) for admin_id in os.environ.get('ADMIN_IDS', '').split(',') if admin_id.strip()] 
 API_ID = os.environ.get('API_ID', '')
 API_HASH = os.environ.get('API_HASH', '')
 BOT_TOKEN = os.environ.get('BOT_TOKEN', '') 
 WELCOME_IMAGE_URL = os.environ.get('WELCOME_IMAGE_URL', '') 
 KEY_PURCHASE_CONTACT = os.environ.get('KEY_PURCHASE_CONTACT', '') 
+# Nama tetap instance ini (harus berbeda per proses bila beberapa proses memakai DB yang sama); pemilik sesi userbot.
+# Default host:direktori kerja agar dua proses tanpa INSTANCE_NAME di host/direktori berbeda tidak saling mereset sesi.
+INSTANCE_NAME_FROM_ENV = os.environ.get('INSTANCE_NAME', '')
+INSTANCE_NAME = INSTANCE_NAME_FROM_ENV or f"{socket.gethostname()}:{os.getcwd()}"
 
 # --- Konfigurasi Database ---
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'postgres').lower()
 DATABASE_URL = os.environ.get('DATABASE_URL', '') 
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'kelana.db')
 POOL_MIN_SIZE = 1
 POOL_MAX_SIZE = 10 
 RETRY_ATTEMPTS = 5
@@ -71,24 +87,59 @@ RETRY_DELAY = 3.0
 # --- Konfigurasi Lainnya ---
 BATCH_SIZE = 50
 BATCH_DELAY = 5
+SEND_MIN_INTERVAL = 2.5
+SEND_FLOOD_RETRIES = 1
+SEND_FLOOD_MAX_PARK = 600
+PROGRESS_EDIT_INTERVAL = 10
+PROGRESS_DIGEST_SAMPLES = 3
+PROGRESS_DIGEST_RETRIES = 5
+PROGRESS_RETRY_DELAY = 30
 ITEMS_PER_PAGE = 5 
+CALLBACK_DATA_MAX_BYTES = 64 # Batas data tombol inline Telegram
 ADMIN_KEYS_ITEMS_PER_PAGE = 7 
 CACHE_TTL = 300
-ENTITY_CACHE_SIZE = 100
+USER_CACHE_TTL = 6 * 60 * 60
+USER_CACHE_CHANNEL = 'user_cache_invalidate'
+# Payload NOTIFY: "<instance>:<chat_id>" untuk perubahan bot_data, "<instance>:<chat_id>:targets" bila grup target ikut berubah
+USER_CACHE_TARGETS_SCOPE = 'targets'
+USER_CACHE_MAX_ENTRIES = 5000
+USER_CACHE_MAX_BYTES = 32 * 1024 * 1024
+USER_CACHE_ENTRY_OVERHEAD = 512
+USER_CACHE_SWEEP_INTERVAL = 60
+ENTITY_CACHE_SIZE = 5000
+ENTITY_CACHE_TOTAL_SIZE = 100000
+ENTITY_FAILURE_CACHE_SIZE = 20000
+DIALOG_SNAPSHOT_TTL = 600
+DIALOG_SNAPSHOT_MIN_TARGETS = 5
+# TTL cache kegagalan validasi per kelas error; flood_wait memakai detik dari server
+ENTITY_FAILURE_TTLS = {'not_found': 6 * 60 * 60, 'private': 6 * 60 * 60, 'invalid': 6 * 60 * 60, 'transient': 60}
 KEY_CHECK_INTERVAL = 300 
+KEY_COUNT_CACHE_TTL = 60
+BULK_KEY_MAX_COUNT = 1000
+KEY_BATCHES_PER_PAGE = 10
+INVALID_KEY_CACHE_SIZE = 10000
+INVALID_KEY_CACHE_TTL = 600
+WRITE_BEHIND_DELAY = 0.5
+BROADCAST_CONCURRENCY = 8
+BROADCAST_RATE_PER_SECOND = 25
+BROADCAST_PROGRESS_INTERVAL = 5
+BROADCAST_STATUS_FLUSH_SIZE = 50
+BROADCAST_RECIPIENT_PAGE_SIZE = 500
+BROADCAST_LEASE_SECONDS = 60
+DELIVERY_REPORT_RETENTION = 7 * 24 * 60 * 60
+DELIVERY_REPORT_PRUNE_INTERVAL = 60 * 60
 
 # --- Konfigurasi Watermark Default ---
 DEFAULT_GLOBAL_WATERMARK_TEXT = "Dikirim melalui HARA11Z X BOT"
 
 # --- Default User Data ---
 DEFAULT_BOT_DATA = {
-    'saved_texts': [],
     'delay': 120, # Delay global
     'is_copying': False,
-    'target_groups': [],
     'awaiting_input_type': None,
     'awaiting_2fa': False,
     'is_registered': False, 
+    'session_owner': None, # INSTANCE_NAME yang menjalankan sesi userbot ini
     'welcome_message_sent': False,
     'current_page_context': {},
     'watermark_enabled': False, 
@@ -100,7 +151,6 @@ DEFAULT_BOT_DATA = {
     'has_valid_key': False, 
     # State untuk fitur baru
     'is_forwarding': False,
-    'forward_sets': [], # Menyimpan dict single/dual link
     'forward_expiry_timestamp': None,
     'copy_expiry_timestamp': None,
     'admin_temp_key_type': None, 
@@ -108,13 +158,249 @@ DEFAULT_BOT_DATA = {
     'admin_message_to_edit_id': None,
     'temp_dual_link_data': {}, # Untuk menyimpan data sementara saat membuat dual link
 }
+DEFAULT_BOT_DATA_JSON = json.dumps(DEFAULT_BOT_DATA, separators=(',', ':'))
+# Kunci yang wajib langsung ditulis ke DB (klaim kunci akses), tidak boleh tertahan di buffer write-behind
+DURABLE_BOT_DATA_KEYS = frozenset({'active_key_value', 'active_key_type', 'key_expiry_timestamp', 'has_valid_key', 'assigned_basic_watermark_text'})
+
+# --- State Pengguna Ringkas ---
+USER_STATE_FIELDS = tuple(DEFAULT_BOT_DATA)
+USER_STATE_FIELD_SET = frozenset(USER_STATE_FIELDS)
+
+def freeze_state_value(value):
+    """Nilai bersarang disimpan read-only agar UserState.copy() cukup menyalin referensi (copy-on-write)."""
+    if isinstance(value, (dict, MappingProxyType)): return MappingProxyType(dict(value))
+    if isinstance(value, list): return tuple(value)
+    return value
+
+def thaw_state_value(value):
+    return dict(value) if isinstance(value, MappingProxyType) else value
+
+def dump_bot_data_json(data):
+    return json.dumps(data, separators=(',', ':'), default=thaw_state_value)
+
+def estimate_state_value_size(value, nested=True):
+    """Perkiraan byte satu nilai tanpa serialisasi: panjang string, ukuran tetap untuk skalar, satu tingkat untuk nilai bersarang."""
+    if isinstance(value, str): return len(value)
+    if nested and isinstance(value, MappingProxyType): return sum(len(str(key)) + estimate_state_value_size(item, False) for key, item in value.items())
+    if nested and isinstance(value, tuple): return sum(estimate_state_value_size(item, False) for item in value)
+    return 8
+
+FROZEN_BOT_DATA_DEFAULTS = tuple(freeze_state_value(DEFAULT_BOT_DATA[field]) for field in USER_STATE_FIELDS)
+
+class UserState:
+    """Pengganti dict bot_data: satu slot per kunci DEFAULT_BOT_DATA, tetap bisa dipakai seperti dict (get/[]/items/update).
+
+    target_index adalah indeks set item_id grup target (tidak disimpan ke bot_data), dimuat saat pertama dibutuhkan.
+    """
+    __slots__ = USER_STATE_FIELDS + ('target_index',)
+
+    def __init__(self, values=None):
+        for field, default_value in zip(USER_STATE_FIELDS, FROZEN_BOT_DATA_DEFAULTS):
+            setattr(self, field, default_value)
+        self.target_index = None
+        if values: self.update(values)
+
+    @classmethod
+    def from_json(cls, raw_json):
+        return cls(json.loads(raw_json))
+
+    def to_dict(self):
+        return {field: thaw_state_value(getattr(self, field)) for field in USER_STATE_FIELDS}
+
+    def to_json(self):
+        return dump_bot_data_json(self.to_dict())
+
+    def estimated_size(self):
+        return sum(estimate_state_value_size(getattr(self, field)) for field in USER_STATE_FIELDS)
+
+    def copy(self):
+        clone = UserState.__new__(UserState)
+        for field in UserState.__slots__:
+            setattr(clone, field, getattr(self, field))
+        return clone
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in USER_STATE_FIELD_SET else default
+
+    def __getitem__(self, key):
+        if key not in USER_STATE_FIELD_SET: raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in USER_STATE_FIELD_SET: raise KeyError(key)
+        setattr(self, key, freeze_state_value(value))
+
+    def __contains__(self, key):
+        return key in USER_STATE_FIELD_SET
+
+    def keys(self):
+        return USER_STATE_FIELDS
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in USER_STATE_FIELDS]
+
+    def update(self, values):
+        for key, value in values.items():
+            if key in USER_STATE_FIELD_SET: setattr(self, key, freeze_state_value(value))
+
+    def __repr__(self):
+        return f"UserState({self.to_dict()!r})"
+
+# --- Tabel Daftar Item Pengguna ---
+# target_groups, saved_texts dan forward_sets disimpan per baris (chat_id, item_id), bukan di dalam blob bot_data
+USER_LIST_TABLES = {
+    'target_groups': 'user_target_groups',
+    'saved_texts': 'user_saved_texts',
+    'forward_sets': 'user_forward_sets',
+}
+
+# --- Cache State Pengguna ---
+class UserStateCache:
+    """Cache LRU (chat_id -> (ts, phone, session, UserState)) dengan batas entri dan byte serta TTL.
+
+    Entri pengguna yang task copy-nya sedang berjalan di-pin: tidak dibuang oleh LRU maupun sweeper TTL.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl_func, is_pinned):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_func = ttl_func
+        self.is_pinned = is_pinned
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    @staticmethod
+    def estimate_size(entry):
+        _, phone, session, bot_data = entry
+        return USER_CACHE_ENTRY_OVERHEAD + len(phone or '') + len(session or '') + bot_data.estimated_size()
+
+    def __contains__(self, chat_id):
+        return chat_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, chat_id, default=None):
+        """Entri apa adanya tanpa cek TTL (dipakai untuk merge/update lokal)."""
+        cached = self.entries.get(chat_id)
+        if cached is None: return default
+        self.entries.move_to_end(chat_id)
+        return cached[0]
+
+    def lookup(self, chat_id):
+        """Entri yang masih segar menurut TTL; dihitung sebagai hit/miss."""
+        cached = self.entries.get(chat_id)
+        if cached is None or time.time() - cached[0][0] >= self.ttl_func():
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(chat_id)
+        return cached[0]
+
+    def __getitem__(self, chat_id):
+        return self.entries[chat_id][0]
+
+    def __setitem__(self, chat_id, entry):
+        entry_size = self.estimate_size(entry)
+        previous = self.entries.pop(chat_id, None)
+        if previous: self.total_bytes -= previous[1]
+        self.entries[chat_id] = (entry, entry_size)
+        self.total_bytes += entry_size
+        self.enforce_budget()
+
+    def pop(self, chat_id, default=None):
+        cached = self.entries.pop(chat_id, None)
+        if cached is None: return default
+        self.total_bytes -= cached[1]
+        return cached[0]
+
+    def __delitem__(self, chat_id):
+        if self.pop(chat_id) is None: raise KeyError(chat_id)
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def enforce_budget(self):
+        if len(self.entries) <= self.max_entries and self.total_bytes <= self.max_bytes: return
+        for chat_id in list(self.entries):
+            if len(self.entries) <= self.max_entries and self.total_bytes <= self.max_bytes: break
+            if self.is_pinned(chat_id): continue
+            self.pop(chat_id)
+            self.evictions += 1
+
+    def sweep(self, now):
+        """Buang entri kedaluwarsa yang tidak di-pin, lalu tegakkan batas. Mengembalikan jumlah entri yang dibuang."""
+        ttl = self.ttl_func()
+        expired_ids = [chat_id for chat_id, (entry, _) in self.entries.items() if now - entry[0] >= ttl and not self.is_pinned(chat_id)]
+        for chat_id in expired_ids: self.pop(chat_id)
+        self.expirations += len(expired_ids)
+        self.enforce_budget()
+        return len(expired_ids)
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.total_bytes, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'expirations': self.expirations}
+
+def user_task_running(chat_id):
+    user_task = user_tasks.get(chat_id)
+    return user_task is not None and not user_task.done()
+
+def current_user_cache_ttl():
+    return USER_CACHE_TTL if user_cache_listener_ready else CACHE_TTL
+
+# --- Penggabungan Permintaan (Single-Flight) ---
+class SingleFlight:
+    """Pemanggil bersamaan dengan kunci yang sama berbagi satu load yang sedang berjalan.
+
+    Load dijalankan sebagai task tersendiri sehingga pembatalan satu pemanggil tidak membatalkan pemanggil lain.
+    """
+
+    def __init__(self):
+        self.in_flight = {}
+        self.coalesced = 0
+
+    async def run(self, key, loader):
+        load_task = self.in_flight.get(key)
+        if load_task is None:
+            load_task = asyncio.ensure_future(loader())
+            self.in_flight[key] = load_task
+            load_task.add_done_callback(lambda done_task: self.in_flight.pop(key, None) if self.in_flight.get(key) is done_task else None)
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(load_task)
 
 # --- State Global ---
 user_clients = {}
 user_tasks = {}
-user_data_cache = {}
-entity_cache = collections.OrderedDict()
-db_pool = None
+user_data_cache = UserStateCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_MAX_BYTES, current_user_cache_ttl, user_task_running)
+user_data_loads = SingleFlight()
+entity_resolutions = SingleFlight()
+dialog_snapshot_loads = SingleFlight()
+user_cache_listener_ready = False
+INSTANCE_ID = uuid4().hex[:12]
+pending_user_writes = {}
+pending_flush_tasks = {}
+user_flush_locks = collections.defaultdict(asyncio.Lock)
+access_key_counts = {}
+active_user_count = None # (ts, jumlah) pengguna aktif untuk paginasi admin
+invalid_key_cache = collections.OrderedDict()
+broadcast_tasks = {}
+delivery_totals = collections.defaultdict(collections.Counter)
+client_pacers = {}
+pending_progress_deliveries = set()
+compiled_payloads = {}
+media_handles = {}
+media_uploads = {}
+media_source_failures = {} # (owner_chat_id, item_id) -> pesan kegagalan
+key_expiry_heap = []
+key_expiry_wakeup = asyncio.Event()
+client_entity_caches = OrderedDict()
+client_entity_cache_size = 0
+entity_failure_cache = OrderedDict()
+resolved_target_sets = {}
+dialog_snapshots = {}
+storage = None
 warning_counts = collections.defaultdict(int)
 MAX_WARNINGS = 5
 
@@ -126,8 +412,34 @@ bot = TelegramClient(StringSession(""), API_ID, API_HASH, loop=loop, connection_
 def is_admin(chat_id):
     return chat_id in ADMIN_IDS
 
+KEY_FORMAT_PATTERN = re.compile(r'^[A-Z]{3}-[0-9A-F]{12}$')
+KEY_CLAIM_FAILURE_MESSAGES = {
+    'invalid_format': "Format kunci tidak valid. Silakan periksa kembali atau beli kunci baru.",
+    'not_found': "Kunci tidak ditemukan. Silakan periksa kembali atau beli kunci baru.",
+    'claimed': "Kunci ini telah digunakan oleh pengguna lain.",
+    'expired': "Kunci ini telah kedaluwarsa (belum pernah diklaim tapi waktunya habis).",
+}
+
 def generate_unique_key(prefix="KEY-"):
-    return prefix + uuid4().hex[:12].upper()
+    new_key = prefix + uuid4().hex[:12].upper()
+    invalid_key_cache.pop(new_key, None)
+    return new_key
+
+def lookup_invalid_key(key_value):
+    """Alasan penolakan kunci dari cache negatif, atau None bila kunci perlu dicek ke DB."""
+    if not KEY_FORMAT_PATTERN.match(key_value): return 'invalid_format'
+    cached = invalid_key_cache.get(key_value)
+    if not cached: return None
+    reason, cached_at = cached
+    if time.time() - cached_at > INVALID_KEY_CACHE_TTL:
+        del invalid_key_cache[key_value]; return None
+    invalid_key_cache.move_to_end(key_value)
+    return reason
+
+def remember_invalid_key(key_value, reason):
+    invalid_key_cache[key_value] = (reason, time.time())
+    invalid_key_cache.move_to_end(key_value)
+    while len(invalid_key_cache) > INVALID_KEY_CACHE_SIZE: invalid_key_cache.popitem(last=False)
 
 def parse_duration_to_seconds(duration_str):
     duration_str = duration_str.lower().strip()
@@ -164,177 +476,1327 @@ def dict_to_entity(entity_dict):
     return None
 
 async def init_db():
-    global db_pool
+    global storage
     for attempt in range(RETRY_ATTEMPTS):
         try:
-            db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, command_timeout=30, max_queries=1000, max_inactive_connection_lifetime=180)
-            async with db_pool.acquire() as conn:
-                await conn.execute('''
-                    CREATE TABLE IF NOT EXISTS users (
-                        chat_id BIGINT PRIMARY KEY,
-                        phone_number TEXT,
-                        session_string TEXT,
-                        bot_data JSONB
-                    )
-                ''')
-                await conn.execute('''
-                    CREATE TABLE IF NOT EXISTS access_keys (
-                        key_value TEXT PRIMARY KEY,
-                        key_type TEXT NOT NULL, 
-                        duration_seconds BIGINT NOT NULL,
-                        is_claimed BOOLEAN DEFAULT FALSE,
-                        claimed_by_chat_id BIGINT,
-                        claim_timestamp BIGINT,
-                        original_expiry_timestamp BIGINT, 
-                        generated_by_admin_id BIGINT NOT NULL,
-                        generation_timestamp BIGINT NOT NULL,
-                        assigned_watermark_text TEXT, 
-                        notes TEXT 
-                    )
-                ''')
-                await conn.execute('CREATE INDEX IF NOT EXISTS idx_access_keys_claimed_by ON access_keys(claimed_by_chat_id)')
-            logger.info("Database berhasil diinisialisasi dan tabel diperiksa/dibuat.")
+            storage = SQLiteStorage(SQLITE_PATH) if STORAGE_BACKEND == 'sqlite' else PostgresStorage(DATABASE_URL)
+            await storage.initialize()
+            logger.info(f"Database ({type(storage).__name__}) berhasil diinisialisasi dan tabel diperiksa/dibuat.")
             return
         except Exception as e:
             logger.error(f"Inisialisasi DB percobaan {attempt+1} gagal: {e}", exc_info=True)
             if attempt < RETRY_ATTEMPTS - 1: await asyncio.sleep(RETRY_DELAY)
             else: logger.critical("Semua percobaan inisialisasi DB gagal."); raise
 
+# --- Migrasi Skema Data Pengguna ---
+async def conform_bot_data_to_defaults(conn, target_version):
+    """Menambah kunci DEFAULT_BOT_DATA yang hilang dan membuang kunci usang untuk semua baris sekaligus."""
+    await conn.execute(
+        """
+        UPDATE users SET bot_data = $1::jsonb || COALESCE(
+            (SELECT jsonb_object_agg(key, value)
+             FROM jsonb_each(CASE WHEN jsonb_typeof(users.bot_data) = 'object' THEN users.bot_data END)
+             WHERE key = ANY($2::text[])),
+            '{}'::jsonb
+        )
+        WHERE schema_version < $3
+        """,
+        DEFAULT_BOT_DATA_JSON, list(DEFAULT_BOT_DATA), target_version
+    )
+
+async def run_user_schema_migrations(conn):
+    """Menjalankan sekali setiap langkah migrasi yang belum diterapkan, secara massal di SQL."""
+    async with conn.transaction():
+        await conn.execute('SELECT pg_advisory_xact_lock(hashtext($1))', 'users_schema_migration')
+        for target_version, migration_step in USER_SCHEMA_MIGRATIONS:
+            pending_rows = await conn.fetchval('SELECT count(*) FROM users WHERE schema_version < $1', target_version)
+            if not pending_rows: continue
+            logger.info(f"Menerapkan migrasi skema pengguna v{target_version} ({migration_step.__name__}) ke {pending_rows} baris.")
+            await migration_step(conn, target_version)
+            await conn.execute('UPDATE users SET schema_version = $1 WHERE schema_version < $1', target_version)
+
+async def migrate_list_blobs_to_tables(conn, target_version):
+    """Memindahkan daftar lama di dalam bot_data ke tabel item masing-masing, lalu membuang kuncinya dari blob."""
+    for list_type, list_table in USER_LIST_TABLES.items():
+        item_id_expr = "e.value #>> '{}'" if list_type == 'target_groups' else "COALESCE(e.value->>'id', md5(e.value::text))"
+        await conn.execute(f'''
+            INSERT INTO {list_table} (chat_id, item_id, item)
+            SELECT u.chat_id, {item_id_expr}, e.value
+            FROM users u CROSS JOIN LATERAL jsonb_array_elements(
+                CASE WHEN jsonb_typeof(u.bot_data->'{list_type}') = 'array' THEN u.bot_data->'{list_type}' END
+            ) WITH ORDINALITY AS e(value, ord)
+            WHERE u.schema_version < $1
+            ORDER BY u.chat_id, e.ord
+            ON CONFLICT (chat_id, item_id) DO NOTHING
+        ''', target_version)
+    await conn.execute('''
+        UPDATE users SET bot_data = bot_data - 'target_groups' - 'saved_texts' - 'forward_sets'
+        WHERE schema_version < $1 AND bot_data ?| ARRAY['target_groups', 'saved_texts', 'forward_sets']
+    ''', target_version)
+
+# Urutan langkah migrasi; tambahkan entri baru (mis. conform_bot_data_to_defaults) setiap kali DEFAULT_BOT_DATA berubah
+USER_SCHEMA_MIGRATIONS = [
+    (1, migrate_list_blobs_to_tables),
+    (2, conform_bot_data_to_defaults),
+    (3, conform_bot_data_to_defaults), # session_owner
+]
+USER_SCHEMA_VERSION = USER_SCHEMA_MIGRATIONS[-1][0]
+
+# --- Backend Penyimpanan ---
+ACCESS_KEY_BATCH_COLUMNS = ('key_value', 'key_type', 'duration_seconds', 'generated_by_admin_id', 'generation_timestamp', 'original_expiry_timestamp', 'assigned_watermark_text', 'batch_id')
+
+class StorageBackend(ABC):
+    """Antarmuka penyimpanan: state pengguna, daftar item, kunci akses, listing admin dan job broadcast.
+
+    Baris yang dikembalikan mendukung akses row['kolom']; item daftar dikembalikan sebagai teks JSON.
+    """
+    supports_notify = False
+
+    @abstractmethod
+    async def initialize(self): ...
+    @abstractmethod
+    async def close(self): ...
+    @abstractmethod
+    async def reset_userbot_sessions(self, owner): ...
+    # State pengguna
+    @abstractmethod
+    async def save_user(self, chat_id, phone_number, session_string, bot_data_patch_json, need_full_row): ...
+    @abstractmethod
+    async def load_user(self, chat_id): ...
+    @abstractmethod
+    async def expire_user_keys(self, now, chat_ids, admin_ids): ...
+    @abstractmethod
+    async def fetch_upcoming_key_expiries(self, after_ts, until_ts, admin_ids): ...
+    @abstractmethod
+    async def count_active_users(self, now, admin_ids): ...
+    @abstractmethod
+    async def fetch_active_users_page(self, now, admin_ids, limit, cursor=None): ...
+    # Daftar item pengguna
+    @abstractmethod
+    async def fetch_list_ids(self, chat_id, list_type): ...
+    @abstractmethod
+    async def add_list_items(self, chat_id, list_type, item_ids, item_jsons): ...
+    @abstractmethod
+    async def delete_list_items(self, chat_id, list_type, item_ids): ...
+    @abstractmethod
+    async def clear_list_items(self, chat_id, list_type): ...
+    @abstractmethod
+    async def count_list_items(self, chat_id, list_type): ...
+    @abstractmethod
+    async def has_list_items(self, chat_id, list_type): ...
+    @abstractmethod
+    async def fetch_list_page(self, chat_id, list_type, offset, limit): ...
+    @abstractmethod
+    async def fetch_list_items(self, chat_id, list_type): ...
+    @abstractmethod
+    async def fetch_list_item(self, chat_id, list_type, item_id): ...
+    @abstractmethod
+    async def saved_text_exists(self, chat_id, text, media_file_id): ...
+    # Kunci akses
+    @abstractmethod
+    async def claim_access_key(self, key_value, chat_id, claim_ts): ...
+    @abstractmethod
+    async def insert_access_key(self, key_value, key_type, duration_s, admin_chat_id, generation_ts, assigned_wm_text=None): ...
+    @abstractmethod
+    async def insert_key_batch(self, batch_row, key_records): ...
+    @abstractmethod
+    async def fetch_access_key(self, key_value): ...
+    @abstractmethod
+    async def delete_access_key(self, key_value): ...
+    @abstractmethod
+    async def count_access_keys(self, list_type): ...
+    @abstractmethod
+    async def fetch_access_keys_page(self, list_type, limit, cursor=None): ...
+    @abstractmethod
+    async def fetch_key_batch_stats(self, limit): ...
+    @abstractmethod
+    async def fetch_unclaimed_batch_keys(self, batch_id): ...
+    # Job broadcast
+    @abstractmethod
+    async def create_broadcast_job(self, job_id, admin_chat_id, message_text, progress_message_id, created_at, owner, lease_until): ...
+    @abstractmethod
+    async def fetch_broadcast_job(self, job_id): ...
+    @abstractmethod
+    async def fetch_broadcast_counts(self, job_id): ...
+    @abstractmethod
+    def iter_pending_broadcast_recipients(self, job_id): ...
+    @abstractmethod
+    async def update_broadcast_recipients(self, rows): ...
+    @abstractmethod
+    async def set_broadcast_progress_message(self, job_id, message_id): ...
+    @abstractmethod
+    async def finish_broadcast_job(self, job_id, finished_at): ...
+    @abstractmethod
+    async def claim_broadcast_jobs(self, owner, now, lease_until): ...
+    @abstractmethod
+    async def renew_broadcast_lease(self, job_id, owner, lease_until): ...
+    # Entitas yang sudah di-resolve per akun userbot
+    @abstractmethod
+    async def fetch_resolved_peer(self, owner_chat_id, peer_id=None, username=None): ...
+    @abstractmethod
+    async def save_resolved_peers(self, owner_chat_id, peer_rows, resolved_at): ...
+    @abstractmethod
+    async def clear_resolved_peers(self, owner_chat_id): ...
+    # Handle media item tersimpan per akun userbot
+    @abstractmethod
+    async def fetch_media_handle(self, owner_chat_id, item_id): ...
+    @abstractmethod
+    async def save_media_handle(self, owner_chat_id, item_id, handle_row, updated_at): ...
+    @abstractmethod
+    async def delete_media_handles(self, owner_chat_id, item_ids=None): ...
+    # Laporan pengiriman
+    @abstractmethod
+    async def save_delivery_report(self, report_row): ...
+    @abstractmethod
+    async def prune_delivery_reports(self, before_ts): ...
+
+class PostgresStorage(StorageBackend):
+    supports_notify = True
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.pool = None
+
+    async def connect_listener(self):
+        """Koneksi terpisah di luar pool untuk LISTEN (lihat user_cache_listener)."""
+        import asyncpg
+        return await asyncpg.connect(self.dsn)
+
+    async def initialize(self):
+        import asyncpg  # hanya dibutuhkan backend Postgres; backend SQLite jalan tanpa asyncpg
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, command_timeout=30, max_queries=1000, max_inactive_connection_lifetime=180)
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    chat_id BIGINT PRIMARY KEY,
+                    phone_number TEXT,
+                    session_string TEXT,
+                    bot_data JSONB
+                )
+            ''')
+            await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS schema_version INTEGER NOT NULL DEFAULT 0')
+            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS has_valid_key BOOLEAN GENERATED ALWAYS AS ((bot_data->>'has_valid_key')::boolean) STORED")
+            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS key_expiry_ts DOUBLE PRECISION GENERATED ALWAYS AS ((bot_data->>'key_expiry_timestamp')::double precision) STORED")
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_active_key_expiry ON users(key_expiry_ts, chat_id) WHERE has_valid_key')
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS access_keys (
+                    key_value TEXT PRIMARY KEY,
+                    key_type TEXT NOT NULL, 
+                    duration_seconds BIGINT NOT NULL,
+                    is_claimed BOOLEAN DEFAULT FALSE,
+                    claimed_by_chat_id BIGINT,
+                    claim_timestamp BIGINT,
+                    original_expiry_timestamp BIGINT, 
+                    generated_by_admin_id BIGINT NOT NULL,
+                    generation_timestamp BIGINT NOT NULL,
+                    assigned_watermark_text TEXT, 
+                    notes TEXT 
+                )
+            ''')
+            await conn.execute('ALTER TABLE access_keys ADD COLUMN IF NOT EXISTS batch_id TEXT')
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_access_keys_claimed_by ON access_keys(claimed_by_chat_id)')
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_access_keys_batch ON access_keys(batch_id) WHERE batch_id IS NOT NULL')
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS key_batches (
+                    batch_id TEXT PRIMARY KEY,
+                    key_type TEXT NOT NULL,
+                    key_count INTEGER NOT NULL,
+                    duration_seconds BIGINT NOT NULL,
+                    generated_by_admin_id BIGINT NOT NULL,
+                    generation_timestamp BIGINT NOT NULL,
+                    assigned_watermark_text TEXT
+                )
+            ''')
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_access_keys_claimed_gen ON access_keys(generation_timestamp DESC, key_value DESC) WHERE is_claimed')
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_access_keys_unclaimed_gen ON access_keys(generation_timestamp DESC, key_value DESC) WHERE NOT is_claimed')
+            for list_table in USER_LIST_TABLES.values():
+                await conn.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {list_table} (
+                        chat_id BIGINT NOT NULL,
+                        item_id TEXT NOT NULL,
+                        seq BIGSERIAL,
+                        item JSONB NOT NULL,
+                        PRIMARY KEY (chat_id, item_id)
+                    )
+                ''')
+                await conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{list_table}_order ON {list_table}(chat_id, seq)')
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    admin_chat_id BIGINT NOT NULL,
+                    message_text TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'running',
+                    progress_message_id BIGINT,
+                    created_at BIGINT NOT NULL,
+                    finished_at BIGINT,
+                    owner TEXT,
+                    lease_until BIGINT
+                )
+            ''')
+            await conn.execute('ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS owner TEXT')
+            await conn.execute('ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS lease_until BIGINT')
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                    job_id TEXT NOT NULL REFERENCES broadcast_jobs(job_id) ON DELETE CASCADE,
+                    chat_id BIGINT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    error TEXT,
+                    PRIMARY KEY (job_id, chat_id)
+                )
+            ''')
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_pending ON broadcast_recipients(job_id, chat_id) WHERE status = 'pending'")
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS resolved_entities (
+                    owner_chat_id BIGINT NOT NULL,
+                    peer_id BIGINT NOT NULL,
+                    access_hash BIGINT,
+                    peer_type TEXT NOT NULL,
+                    title TEXT,
+                    username TEXT,
+                    resolved_at BIGINT NOT NULL,
+                    PRIMARY KEY (owner_chat_id, peer_id)
+                )
+            ''')
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_resolved_entities_username ON resolved_entities(owner_chat_id, lower(username)) WHERE username IS NOT NULL')
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS media_handles (
+                    owner_chat_id BIGINT NOT NULL,
+                    item_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    media_id BIGINT NOT NULL,
+                    access_hash BIGINT NOT NULL,
+                    file_reference BYTEA NOT NULL,
+                    source_peer_id BIGINT,
+                    source_msg_id BIGINT,
+                    updated_at BIGINT NOT NULL,
+                    PRIMARY KEY (owner_chat_id, item_id)
+                )
+            ''')
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS delivery_reports (
+                    report_id BIGSERIAL PRIMARY KEY,
+                    chat_id BIGINT NOT NULL,
+                    action_name TEXT NOT NULL,
+                    started_at DOUBLE PRECISION NOT NULL,
+                    finished_at DOUBLE PRECISION NOT NULL,
+                    sent_count INTEGER NOT NULL,
+                    failed_count INTEGER NOT NULL,
+                    aborted BOOLEAN NOT NULL DEFAULT FALSE,
+                    avg_latency_ms INTEGER,
+                    error_counts JSONB NOT NULL DEFAULT '{}'::jsonb
+                )
+            ''')
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_delivery_reports_chat ON delivery_reports(chat_id, started_at DESC)')
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_delivery_reports_started ON delivery_reports(started_at)')
+            await run_user_schema_migrations(conn)
+
+    async def close(self):
+        if self.pool: await self.pool.close()
+
+    async def reset_userbot_sessions(self, owner):
+        """Reset hanya sesi milik instance ini (atau sesi lama tanpa pemilik); sesi instance lain tidak disentuh."""
+        async with self.pool.acquire() as conn:
+            reset_status = await conn.execute(
+                """
+                UPDATE users
+                SET bot_data = bot_data - 'is_registered' - 'session_string' - 'session_owner' || jsonb_build_object('is_registered', false, 'session_string', null, 'session_owner', null)
+                WHERE ((bot_data->>'is_registered')::boolean = TRUE OR bot_data->>'session_string' IS NOT NULL)
+                  AND (bot_data->>'session_owner' IS NULL OR bot_data->>'session_owner' = $1);
+                """,
+                owner)
+        return int(reset_status.split()[-1])
+
+    async def _notify_target_groups_changed(self, conn, chat_id):
+        await conn.execute("SELECT pg_notify($1, $2)", USER_CACHE_CHANNEL, f"{INSTANCE_ID}:{chat_id}:{USER_CACHE_TARGETS_SCOPE}")
+
+    async def save_user(self, chat_id, phone_number, session_string, bot_data_patch_json, need_full_row):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow(
+                """
+                WITH saved AS (
+                    INSERT INTO users (chat_id, phone_number, session_string, bot_data, schema_version)
+                    VALUES ($1, $2, $3, $5::jsonb || $4::jsonb, $7)
+                    ON CONFLICT (chat_id) DO UPDATE SET
+                        phone_number = COALESCE($2, users.phone_number),
+                        session_string = COALESCE($3, users.session_string),
+                        bot_data = COALESCE(users.bot_data, $5::jsonb) || $4::jsonb
+                    RETURNING phone_number, session_string, CASE WHEN $6 THEN bot_data END AS bot_data
+                )
+                SELECT saved.*, pg_notify($8, $9) FROM saved
+                """,
+                chat_id, phone_number, session_string, bot_data_patch_json, DEFAULT_BOT_DATA_JSON, need_full_row, USER_SCHEMA_VERSION,
+                USER_CACHE_CHANNEL, f"{INSTANCE_ID}:{chat_id}"
+            )
+
+    async def load_user(self, chat_id):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow('SELECT phone_number, session_string, bot_data FROM users WHERE chat_id = $1', chat_id)
+
+    async def expire_user_keys(self, now, chat_ids, admin_ids):
+        async with self.pool.acquire() as conn:
+            expired_rows = await conn.fetch(
+                """
+                UPDATE users SET session_string = NULL, bot_data = $2::jsonb
+                WHERE has_valid_key AND key_expiry_ts <= $1
+                  AND ($3::bigint[] IS NULL OR chat_id = ANY($3::bigint[]))
+                  AND NOT (chat_id = ANY($4::bigint[]))
+                RETURNING chat_id, pg_notify($5, $6 || chat_id::text || $7)
+                """,
+                now, DEFAULT_BOT_DATA_JSON, chat_ids, list(admin_ids), USER_CACHE_CHANNEL, f"{INSTANCE_ID}:", f":{USER_CACHE_TARGETS_SCOPE}")
+            expired_chat_ids = [row['chat_id'] for row in expired_rows]
+            if expired_chat_ids:
+                # Daftar item dulu ikut terhapus saat bot_data direset; sekarang tabelnya terpisah
+                for list_table in (*USER_LIST_TABLES.values(), 'media_handles'):
+                    await conn.execute(f"DELETE FROM {list_table} WHERE {'owner_chat_id' if list_table == 'media_handles' else 'chat_id'} = ANY($1::bigint[])", expired_chat_ids)
+        return expired_chat_ids
+
+    async def fetch_upcoming_key_expiries(self, after_ts, until_ts, admin_ids):
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(
+                "SELECT chat_id, key_expiry_ts FROM users WHERE has_valid_key AND key_expiry_ts > $1 AND key_expiry_ts <= $2 AND NOT (chat_id = ANY($3::bigint[]))",
+                after_ts, until_ts, list(admin_ids))
+
+    async def count_active_users(self, now, admin_ids):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("SELECT count(*) FROM users WHERE has_valid_key AND key_expiry_ts > $1 AND chat_id <> ALL($2::bigint[])", now, list(admin_ids))
+
+    async def fetch_active_users_page(self, now, admin_ids, limit, cursor=None):
+        active_filter = "has_valid_key AND key_expiry_ts > $1 AND chat_id <> ALL($2::bigint[])"
+        select_cols = "SELECT chat_id, key_expiry_ts, bot_data->>'active_key_type' AS key_type, bot_data->>'active_key_value' AS key_value FROM users"
+        async with self.pool.acquire() as conn:
+            if not cursor:
+                return await conn.fetch(f"{select_cols} WHERE {active_filter} ORDER BY key_expiry_ts, chat_id LIMIT $3", now, list(admin_ids), limit)
+            if cursor[0] == 'n':
+                return await conn.fetch(f"{select_cols} WHERE {active_filter} AND (key_expiry_ts, chat_id) > ($4, $5) ORDER BY key_expiry_ts, chat_id LIMIT $3", now, list(admin_ids), limit, cursor[1], cursor[2])
+            return await conn.fetch(f"{select_cols} WHERE {active_filter} AND (key_expiry_ts, chat_id) < ($4, $5) ORDER BY key_expiry_ts DESC, chat_id DESC LIMIT $3", now, list(admin_ids), limit, cursor[1], cursor[2])
+
+    async def fetch_list_ids(self, chat_id, list_type):
+        async with self.pool.acquire() as conn:
+            return [row['item_id'] for row in await conn.fetch(f'SELECT item_id FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = $1', chat_id)]
+
+    async def add_list_items(self, chat_id, list_type, item_ids, item_jsons):
+        async with self.pool.acquire() as conn:
+            added_count = await conn.fetchval(
+                f'''
+                WITH inserted AS (
+                    INSERT INTO {USER_LIST_TABLES[list_type]} (chat_id, item_id, item)
+                    SELECT $1, new_items.item_id, new_items.item::jsonb
+                    FROM unnest($2::text[], $3::text[]) WITH ORDINALITY AS new_items(item_id, item, ord)
+                    ORDER BY new_items.ord
+                    ON CONFLICT (chat_id, item_id) DO NOTHING
+                    RETURNING 1
+                )
+                SELECT count(*) FROM inserted
+                ''',
+                chat_id, item_ids, item_jsons
+            )
+            if list_type == 'target_groups' and added_count: await self._notify_target_groups_changed(conn, chat_id)
+        return added_count
+
+    async def delete_list_items(self, chat_id, list_type, item_ids):
+        async with self.pool.acquire() as conn:
+            deleted_status = await conn.execute(f'DELETE FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = $1 AND item_id = ANY($2::text[])', chat_id, item_ids)
+            if list_type == 'target_groups': await self._notify_target_groups_changed(conn, chat_id)
+        return int(deleted_status.split()[-1])
+
+    async def clear_list_items(self, chat_id, list_type):
+        async with self.pool.acquire() as conn:
+            await conn.execute(f'DELETE FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = $1', chat_id)
+            if list_type == 'target_groups': await self._notify_target_groups_changed(conn, chat_id)
+
+    async def count_list_items(self, chat_id, list_type):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(f'SELECT count(*) FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = $1', chat_id)
+
+    async def has_list_items(self, chat_id, list_type):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(f'SELECT EXISTS (SELECT 1 FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = $1)', chat_id)
+
+    async def fetch_list_page(self, chat_id, list_type, offset, limit):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(f'SELECT item_id, item FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = $1 ORDER BY seq LIMIT $2 OFFSET $3', chat_id, limit, offset)
+        return [(row['item_id'], row['item']) for row in rows]
+
+    async def fetch_list_items(self, chat_id, list_type):
+        async with self.pool.acquire() as conn:
+            return [row['item'] for row in await conn.fetch(f'SELECT item FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = $1 ORDER BY seq', chat_id)]
+
+    async def fetch_list_item(self, chat_id, list_type, item_id):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(f'SELECT item FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = $1 AND item_id = $2', chat_id, item_id)
+
+    async def saved_text_exists(self, chat_id, text, media_file_id):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(
+                """
+                SELECT EXISTS (
+                    SELECT 1 FROM user_saved_texts
+                    WHERE chat_id = $1 AND item->>'text' IS NOT DISTINCT FROM $2 AND item->>'media_file_id' IS NOT DISTINCT FROM $3
+                )
+                """,
+                chat_id, text, media_file_id
+            )
+
+    async def claim_access_key(self, key_value, chat_id, claim_ts):
+        async with self.pool.acquire() as conn:
+            key_record = await conn.fetchrow(
+                """
+                UPDATE access_keys
+                SET is_claimed = TRUE, claimed_by_chat_id = $2, claim_timestamp = $3
+                WHERE key_value = $1 AND (NOT is_claimed OR claimed_by_chat_id = $2) AND generation_timestamp + duration_seconds > $3
+                RETURNING *
+                """,
+                key_value, chat_id, claim_ts
+            )
+            if key_record: return key_record, None
+            return None, await conn.fetchrow("SELECT is_claimed, claimed_by_chat_id FROM access_keys WHERE key_value = $1", key_value)
+
+    async def insert_access_key(self, key_value, key_type, duration_s, admin_chat_id, generation_ts, assigned_wm_text=None):
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                """INSERT INTO access_keys (key_value, key_type, duration_seconds, generated_by_admin_id, generation_timestamp, original_expiry_timestamp, assigned_watermark_text)
+                   VALUES ($1, $2, $3, $4, $5, $6, $7)""",
+                key_value, key_type, duration_s, admin_chat_id, generation_ts, generation_ts + duration_s, assigned_wm_text
+            )
+
+    async def insert_key_batch(self, batch_row, key_records):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    "INSERT INTO key_batches (batch_id, key_type, key_count, duration_seconds, generated_by_admin_id, generation_timestamp, assigned_watermark_text) VALUES ($1, $2, $3, $4, $5, $6, $7)",
+                    *batch_row)
+                await conn.copy_records_to_table('access_keys', records=key_records, columns=list(ACCESS_KEY_BATCH_COLUMNS))
+
+    async def fetch_access_key(self, key_value):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow("SELECT * FROM access_keys WHERE key_value = $1", key_value)
+
+    async def delete_access_key(self, key_value):
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM access_keys WHERE key_value = $1", key_value)
+
+    async def count_access_keys(self, list_type):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(f"SELECT count(*) FROM access_keys WHERE {'is_claimed' if list_type == 'claimed' else 'NOT is_claimed'}")
+
+    async def fetch_access_keys_page(self, list_type, limit, cursor=None):
+        query = f"SELECT key_value, key_type, generation_timestamp, duration_seconds, assigned_watermark_text, claimed_by_chat_id, claim_timestamp FROM access_keys WHERE {'is_claimed' if list_type == 'claimed' else 'NOT is_claimed'}"
+        if not cursor: query_args = (); query += " ORDER BY generation_timestamp DESC, key_value DESC LIMIT $1"
+        elif cursor[0] == 'n': query_args = (cursor[1], cursor[2]); query += " AND (generation_timestamp, key_value) < ($2, $3) ORDER BY generation_timestamp DESC, key_value DESC LIMIT $1"
+        else: query_args = (cursor[1], cursor[2]); query += " AND (generation_timestamp, key_value) > ($2, $3) ORDER BY generation_timestamp ASC, key_value ASC LIMIT $1"
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(query, limit, *query_args)
+
+    async def fetch_key_batch_stats(self, limit):
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(
+                """
+                SELECT b.batch_id, b.key_type, b.key_count, b.duration_seconds, b.generation_timestamp,
+                       COUNT(k.key_value) AS remaining_count,
+                       COUNT(k.key_value) FILTER (WHERE k.is_claimed) AS claimed_count
+                FROM key_batches b LEFT JOIN access_keys k ON k.batch_id = b.batch_id
+                GROUP BY b.batch_id ORDER BY b.generation_timestamp DESC, b.batch_id DESC LIMIT $1
+                """, limit)
+
+    async def fetch_unclaimed_batch_keys(self, batch_id):
+        async with self.pool.acquire() as conn:
+            return [row['key_value'] for row in await conn.fetch("SELECT key_value FROM access_keys WHERE batch_id = $1 AND NOT is_claimed ORDER BY key_value", batch_id)]
+
+    async def create_broadcast_job(self, job_id, admin_chat_id, message_text, progress_message_id, created_at, owner, lease_until):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    "INSERT INTO broadcast_jobs (job_id, admin_chat_id, message_text, progress_message_id, created_at, owner, lease_until) VALUES ($1, $2, $3, $4, $5, $6, $7)",
+                    job_id, admin_chat_id, message_text, progress_message_id, created_at, owner, lease_until)
+                status = await conn.execute(
+                    "INSERT INTO broadcast_recipients (job_id, chat_id) SELECT $1, chat_id FROM users WHERE has_valid_key AND (key_expiry_ts IS NULL OR key_expiry_ts > $2)",
+                    job_id, time.time())
+        return int(status.split()[-1])
+
+    async def fetch_broadcast_job(self, job_id):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow("SELECT admin_chat_id, message_text, progress_message_id FROM broadcast_jobs WHERE job_id = $1 AND status = 'running'", job_id)
+
+    async def fetch_broadcast_counts(self, job_id):
+        async with self.pool.acquire() as conn:
+            return await conn.fetch("SELECT status, COUNT(*) AS total FROM broadcast_recipients WHERE job_id = $1 GROUP BY status", job_id)
+
+    async def iter_pending_broadcast_recipients(self, job_id):
+        """Penerima dibaca per halaman keyset pada chat_id; koneksi hanya dipinjam selama satu query pendek,
+        jadi jeda FloodWait tidak menahan koneksi pool atau transaksi yang terbuka."""
+        last_chat_id = None
+        while True:
+            async with self.pool.acquire() as conn:
+                if last_chat_id is None: rows = await conn.fetch("SELECT chat_id FROM broadcast_recipients WHERE job_id = $1 AND status = 'pending' ORDER BY chat_id LIMIT $2", job_id, BROADCAST_RECIPIENT_PAGE_SIZE)
+                else: rows = await conn.fetch("SELECT chat_id FROM broadcast_recipients WHERE job_id = $1 AND status = 'pending' AND chat_id > $2 ORDER BY chat_id LIMIT $3", job_id, last_chat_id, BROADCAST_RECIPIENT_PAGE_SIZE)
+            if not rows: return
+            for row in rows: yield row['chat_id']
+            last_chat_id = rows[-1]['chat_id']
+
+    async def update_broadcast_recipients(self, rows):
+        async with self.pool.acquire() as conn:
+            await conn.executemany("UPDATE broadcast_recipients SET status = $3, error = $4 WHERE job_id = $1 AND chat_id = $2", rows)
+
+    async def set_broadcast_progress_message(self, job_id, message_id):
+        async with self.pool.acquire() as conn:
+            await conn.execute("UPDATE broadcast_jobs SET progress_message_id = $2 WHERE job_id = $1", job_id, message_id)
+
+    async def finish_broadcast_job(self, job_id, finished_at):
+        async with self.pool.acquire() as conn:
+            await conn.execute("UPDATE broadcast_jobs SET status = 'done', finished_at = $2 WHERE job_id = $1", job_id, finished_at)
+
+    async def claim_broadcast_jobs(self, owner, now, lease_until):
+        """Ambil alih job yang lease-nya kosong/kedaluwarsa dalam satu UPDATE; baris yang sedang diklaim proses lain dilewati."""
+        async with self.pool.acquire() as conn:
+            return [row['job_id'] for row in await conn.fetch(
+                "UPDATE broadcast_jobs SET owner = $1, lease_until = $3 WHERE status = 'running' AND (lease_until IS NULL OR lease_until < $2) RETURNING job_id",
+                owner, now, lease_until)]
+
+    async def renew_broadcast_lease(self, job_id, owner, lease_until):
+        async with self.pool.acquire() as conn:
+            status = await conn.execute("UPDATE broadcast_jobs SET lease_until = $3 WHERE job_id = $1 AND owner = $2 AND status = 'running'", job_id, owner, lease_until)
+        return status.split()[-1] != '0'
+
+    async def fetch_resolved_peer(self, owner_chat_id, peer_id=None, username=None):
+        async with self.pool.acquire() as conn:
+            if peer_id is not None:
+                return await conn.fetchrow("SELECT peer_id, access_hash, peer_type, title, username FROM resolved_entities WHERE owner_chat_id = $1 AND peer_id = $2", owner_chat_id, peer_id)
+            return await conn.fetchrow(
+                "SELECT peer_id, access_hash, peer_type, title, username FROM resolved_entities WHERE owner_chat_id = $1 AND lower(username) = lower($2) ORDER BY resolved_at DESC LIMIT 1",
+                owner_chat_id, username)
+
+    async def save_resolved_peers(self, owner_chat_id, peer_rows, resolved_at):
+        async with self.pool.acquire() as conn:
+            await conn.executemany(
+                """
+                INSERT INTO resolved_entities (owner_chat_id, peer_id, access_hash, peer_type, title, username, resolved_at)
+                VALUES ($1, $2, $3, $4, $5, $6, $7)
+                ON CONFLICT (owner_chat_id, peer_id) DO UPDATE SET
+                    access_hash = EXCLUDED.access_hash, peer_type = EXCLUDED.peer_type, title = EXCLUDED.title,
+                    username = EXCLUDED.username, resolved_at = EXCLUDED.resolved_at
+                """,
+                [(owner_chat_id, *peer_row, resolved_at) for peer_row in peer_rows])
+
+    async def clear_resolved_peers(self, owner_chat_id):
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM resolved_entities WHERE owner_chat_id = $1", owner_chat_id)
+
+    async def fetch_media_handle(self, owner_chat_id, item_id):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow("SELECT kind, media_id, access_hash, file_reference, source_peer_id, source_msg_id FROM media_handles WHERE owner_chat_id = $1 AND item_id = $2", owner_chat_id, item_id)
+
+    async def save_media_handle(self, owner_chat_id, item_id, handle_row, updated_at):
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO media_handles (owner_chat_id, item_id, kind, media_id, access_hash, file_reference, source_peer_id, source_msg_id, updated_at)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                ON CONFLICT (owner_chat_id, item_id) DO UPDATE SET
+                    kind = EXCLUDED.kind, media_id = EXCLUDED.media_id, access_hash = EXCLUDED.access_hash, file_reference = EXCLUDED.file_reference,
+                    source_peer_id = EXCLUDED.source_peer_id, source_msg_id = EXCLUDED.source_msg_id, updated_at = EXCLUDED.updated_at
+                """,
+                owner_chat_id, item_id, *handle_row, updated_at)
+
+    async def delete_media_handles(self, owner_chat_id, item_ids=None):
+        async with self.pool.acquire() as conn:
+            if item_ids is None: await conn.execute("DELETE FROM media_handles WHERE owner_chat_id = $1", owner_chat_id)
+            else: await conn.execute("DELETE FROM media_handles WHERE owner_chat_id = $1 AND item_id = ANY($2::text[])", owner_chat_id, item_ids)
+
+    async def save_delivery_report(self, report_row):
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                "INSERT INTO delivery_reports (chat_id, action_name, started_at, finished_at, sent_count, failed_count, aborted, avg_latency_ms, error_counts) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9::jsonb)",
+                *report_row)
+
+    async def prune_delivery_reports(self, before_ts):
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM delivery_reports WHERE started_at < $1", before_ts)
+
+class SQLiteStorage(StorageBackend):
+    """Backend embedded untuk instalasi satu node; semua akses sqlite3 berjalan berurutan di satu thread executor."""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-storage')
+
+    async def _run(self, func, *args):
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def _fetchall(self, query, params=()):
+        return await self._run(lambda: self.conn.execute(query, params).fetchall())
+
+    async def _fetchone(self, query, params=()):
+        return await self._run(lambda: self.conn.execute(query, params).fetchone())
+
+    async def _execute(self, query, params=()):
+        def execute_sync():
+            with self.conn: return self.conn.execute(query, params).rowcount
+        return await self._run(execute_sync)
+
+    def _initialize_sync(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS users (
+                chat_id INTEGER PRIMARY KEY,
+                phone_number TEXT,
+                session_string TEXT,
+                bot_data TEXT,
+                schema_version INTEGER NOT NULL DEFAULT 0,
+                has_valid_key INTEGER GENERATED ALWAYS AS (json_extract(bot_data, '$.has_valid_key')) VIRTUAL,
+                key_expiry_ts REAL GENERATED ALWAYS AS (json_extract(bot_data, '$.key_expiry_timestamp')) VIRTUAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_users_active_key_expiry ON users(key_expiry_ts, chat_id) WHERE has_valid_key;
+            CREATE TABLE IF NOT EXISTS access_keys (
+                key_value TEXT PRIMARY KEY,
+                key_type TEXT NOT NULL,
+                duration_seconds INTEGER NOT NULL,
+                is_claimed INTEGER NOT NULL DEFAULT 0,
+                claimed_by_chat_id INTEGER,
+                claim_timestamp INTEGER,
+                original_expiry_timestamp INTEGER,
+                generated_by_admin_id INTEGER NOT NULL,
+                generation_timestamp INTEGER NOT NULL,
+                assigned_watermark_text TEXT,
+                notes TEXT,
+                batch_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_access_keys_claimed_by ON access_keys(claimed_by_chat_id);
+            CREATE INDEX IF NOT EXISTS idx_access_keys_batch ON access_keys(batch_id) WHERE batch_id IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS idx_access_keys_claimed_gen ON access_keys(generation_timestamp DESC, key_value DESC) WHERE is_claimed;
+            CREATE INDEX IF NOT EXISTS idx_access_keys_unclaimed_gen ON access_keys(generation_timestamp DESC, key_value DESC) WHERE NOT is_claimed;
+            CREATE TABLE IF NOT EXISTS key_batches (
+                batch_id TEXT PRIMARY KEY,
+                key_type TEXT NOT NULL,
+                key_count INTEGER NOT NULL,
+                duration_seconds INTEGER NOT NULL,
+                generated_by_admin_id INTEGER NOT NULL,
+                generation_timestamp INTEGER NOT NULL,
+                assigned_watermark_text TEXT
+            );
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                job_id TEXT PRIMARY KEY,
+                admin_chat_id INTEGER NOT NULL,
+                message_text TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                progress_message_id INTEGER,
+                created_at INTEGER NOT NULL,
+                finished_at INTEGER,
+                owner TEXT,
+                lease_until INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                job_id TEXT NOT NULL REFERENCES broadcast_jobs(job_id) ON DELETE CASCADE,
+                chat_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                error TEXT,
+                PRIMARY KEY (job_id, chat_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_pending ON broadcast_recipients(job_id, chat_id) WHERE status = 'pending';
+            CREATE TABLE IF NOT EXISTS resolved_entities (
+                owner_chat_id INTEGER NOT NULL,
+                peer_id INTEGER NOT NULL,
+                access_hash INTEGER,
+                peer_type TEXT NOT NULL,
+                title TEXT,
+                username TEXT COLLATE NOCASE,
+                resolved_at INTEGER NOT NULL,
+                PRIMARY KEY (owner_chat_id, peer_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_resolved_entities_username ON resolved_entities(owner_chat_id, username) WHERE username IS NOT NULL;
+            CREATE TABLE IF NOT EXISTS media_handles (
+                owner_chat_id INTEGER NOT NULL,
+                item_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                media_id INTEGER NOT NULL,
+                access_hash INTEGER NOT NULL,
+                file_reference BLOB NOT NULL,
+                source_peer_id INTEGER,
+                source_msg_id INTEGER,
+                updated_at INTEGER NOT NULL,
+                PRIMARY KEY (owner_chat_id, item_id)
+            );
+            CREATE TABLE IF NOT EXISTS delivery_reports (
+                report_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                action_name TEXT NOT NULL,
+                started_at REAL NOT NULL,
+                finished_at REAL NOT NULL,
+                sent_count INTEGER NOT NULL,
+                failed_count INTEGER NOT NULL,
+                aborted INTEGER NOT NULL DEFAULT 0,
+                avg_latency_ms INTEGER,
+                error_counts TEXT NOT NULL DEFAULT '{}'
+            );
+            CREATE INDEX IF NOT EXISTS idx_delivery_reports_chat ON delivery_reports(chat_id, started_at DESC);
+            CREATE INDEX IF NOT EXISTS idx_delivery_reports_started ON delivery_reports(started_at);
+        ''')
+        for list_table in USER_LIST_TABLES.values():
+            self.conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {list_table} (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    item_id TEXT NOT NULL,
+                    item TEXT NOT NULL,
+                    UNIQUE (chat_id, item_id)
+                )
+            ''')
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{list_table}_order ON {list_table}(chat_id, seq)')
+        self._conform_bot_data_sync()
+
+    def _conform_bot_data_sync(self):
+        """Padanan conform_bot_data_to_defaults: basis data SQLite selalu baru, jadi hanya penyesuaian kunci default yang perlu."""
+        with self.conn:
+            for row in self.conn.execute('SELECT chat_id, bot_data FROM users WHERE schema_version < ?', (USER_SCHEMA_VERSION,)).fetchall():
+                try: stored_bot_data = json.loads(row['bot_data']) if row['bot_data'] else {}
+                except json.JSONDecodeError: stored_bot_data = {}
+                conformed_bot_data = dict(DEFAULT_BOT_DATA)
+                if isinstance(stored_bot_data, dict): conformed_bot_data.update((key, value) for key, value in stored_bot_data.items() if key in DEFAULT_BOT_DATA)
+                self.conn.execute('UPDATE users SET bot_data = ?, schema_version = ? WHERE chat_id = ?', (json.dumps(conformed_bot_data, separators=(',', ':')), USER_SCHEMA_VERSION, row['chat_id']))
+
+    async def initialize(self):
+        await self._run(self._initialize_sync)
+
+    async def close(self):
+        if self.conn: await self._run(self.conn.close)
+        self.executor.shutdown(wait=False)
+
+    async def reset_userbot_sessions(self, owner):
+        return await self._execute(
+            "UPDATE users SET bot_data = json_set(bot_data, '$.is_registered', json('false'), '$.session_string', NULL, '$.session_owner', NULL) "
+            "WHERE (json_extract(bot_data, '$.is_registered') OR json_extract(bot_data, '$.session_string') IS NOT NULL) "
+            "AND (json_extract(bot_data, '$.session_owner') IS NULL OR json_extract(bot_data, '$.session_owner') = ?)",
+            (owner,))
+
+    def _save_user_sync(self, chat_id, phone_number, session_string, bot_data_patch_json, need_full_row):
+        with self.conn:
+            row = self.conn.execute('SELECT phone_number, session_string, bot_data FROM users WHERE chat_id = ?', (chat_id,)).fetchone()
+            stored_bot_data = json.loads(row['bot_data']) if row and row['bot_data'] else dict(DEFAULT_BOT_DATA)
+            stored_bot_data.update(json.loads(bot_data_patch_json))
+            saved_phone = phone_number if phone_number is not None else (row['phone_number'] if row else None)
+            saved_session = session_string if session_string is not None else (row['session_string'] if row else None)
+            saved_bot_data_json = json.dumps(stored_bot_data, separators=(',', ':'))
+            self.conn.execute(
+                """
+                INSERT INTO users (chat_id, phone_number, session_string, bot_data, schema_version) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (chat_id) DO UPDATE SET phone_number = excluded.phone_number, session_string = excluded.session_string, bot_data = excluded.bot_data
+                """,
+                (chat_id, saved_phone, saved_session, saved_bot_data_json, USER_SCHEMA_VERSION))
+        return {'phone_number': saved_phone, 'session_string': saved_session, 'bot_data': saved_bot_data_json if need_full_row else None}
+
+    async def save_user(self, chat_id, phone_number, session_string, bot_data_patch_json, need_full_row):
+        return await self._run(self._save_user_sync, chat_id, phone_number, session_string, bot_data_patch_json, need_full_row)
+
+    async def load_user(self, chat_id):
+        return await self._fetchone('SELECT phone_number, session_string, bot_data FROM users WHERE chat_id = ?', (chat_id,))
+
+    async def expire_user_keys(self, now, chat_ids, admin_ids):
+        query = "UPDATE users SET session_string = NULL, bot_data = ? WHERE has_valid_key AND key_expiry_ts <= ? AND chat_id NOT IN (SELECT value FROM json_each(?))"
+        params = [DEFAULT_BOT_DATA_JSON, now, json.dumps(list(admin_ids))]
+        if chat_ids is not None: query += " AND chat_id IN (SELECT value FROM json_each(?))"; params.append(json.dumps(list(chat_ids)))
+        def expire_sync():
+            with self.conn:
+                expired_chat_ids = [row['chat_id'] for row in self.conn.execute(query + " RETURNING chat_id", params).fetchall()]
+                for list_table in (*USER_LIST_TABLES.values(), 'media_handles') if expired_chat_ids else ():
+                    self.conn.execute(f"DELETE FROM {list_table} WHERE {'owner_chat_id' if list_table == 'media_handles' else 'chat_id'} IN (SELECT value FROM json_each(?))", (json.dumps(expired_chat_ids),))
+                return expired_chat_ids
+        return await self._run(expire_sync)
+
+    async def fetch_upcoming_key_expiries(self, after_ts, until_ts, admin_ids):
+        return await self._fetchall(
+            "SELECT chat_id, key_expiry_ts FROM users WHERE has_valid_key AND key_expiry_ts > ? AND key_expiry_ts <= ? AND chat_id NOT IN (SELECT value FROM json_each(?))",
+            (after_ts, until_ts, json.dumps(list(admin_ids))))
+
+    async def count_active_users(self, now, admin_ids):
+        row = await self._fetchone("SELECT count(*) FROM users WHERE has_valid_key AND key_expiry_ts > ? AND chat_id NOT IN (SELECT value FROM json_each(?))", (now, json.dumps(list(admin_ids))))
+        return row[0]
+
+    async def fetch_active_users_page(self, now, admin_ids, limit, cursor=None):
+        query = ("SELECT chat_id, key_expiry_ts, json_extract(bot_data, '$.active_key_type') AS key_type, json_extract(bot_data, '$.active_key_value') AS key_value FROM users "
+                 "WHERE has_valid_key AND key_expiry_ts > ? AND chat_id NOT IN (SELECT value FROM json_each(?))")
+        params = [now, json.dumps(list(admin_ids))]
+        if not cursor: query += " ORDER BY key_expiry_ts, chat_id LIMIT ?"
+        elif cursor[0] == 'n': query += " AND (key_expiry_ts, chat_id) > (?, ?) ORDER BY key_expiry_ts, chat_id LIMIT ?"; params += [cursor[1], cursor[2]]
+        else: query += " AND (key_expiry_ts, chat_id) < (?, ?) ORDER BY key_expiry_ts DESC, chat_id DESC LIMIT ?"; params += [cursor[1], cursor[2]]
+        return await self._fetchall(query, params + [limit])
+
+    async def fetch_list_ids(self, chat_id, list_type):
+        return [row['item_id'] for row in await self._fetchall(f'SELECT item_id FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = ?', (chat_id,))]
+
+    async def add_list_items(self, chat_id, list_type, item_ids, item_jsons):
+        def add_sync():
+            with self.conn:
+                return sum(self.conn.execute(f'INSERT OR IGNORE INTO {USER_LIST_TABLES[list_type]} (chat_id, item_id, item) VALUES (?, ?, ?)', (chat_id, item_id, item_json)).rowcount
+                           for item_id, item_json in zip(item_ids, item_jsons))
+        return await self._run(add_sync)
+
+    async def delete_list_items(self, chat_id, list_type, item_ids):
+        return await self._execute(f'DELETE FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = ? AND item_id IN (SELECT value FROM json_each(?))', (chat_id, json.dumps(item_ids)))
+
+    async def clear_list_items(self, chat_id, list_type):
+        await self._execute(f'DELETE FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = ?', (chat_id,))
+
+    async def count_list_items(self, chat_id, list_type):
+        return (await self._fetchone(f'SELECT count(*) FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = ?', (chat_id,)))[0]
+
+    async def has_list_items(self, chat_id, list_type):
+        return bool((await self._fetchone(f'SELECT EXISTS (SELECT 1 FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = ?)', (chat_id,)))[0])
+
+    async def fetch_list_page(self, chat_id, list_type, offset, limit):
+        rows = await self._fetchall(f'SELECT item_id, item FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = ? ORDER BY seq LIMIT ? OFFSET ?', (chat_id, limit, offset))
+        return [(row['item_id'], row['item']) for row in rows]
+
+    async def fetch_list_items(self, chat_id, list_type):
+        return [row['item'] for row in await self._fetchall(f'SELECT item FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = ? ORDER BY seq', (chat_id,))]
+
+    async def fetch_list_item(self, chat_id, list_type, item_id):
+        row = await self._fetchone(f'SELECT item FROM {USER_LIST_TABLES[list_type]} WHERE chat_id = ? AND item_id = ?', (chat_id, item_id))
+        return row['item'] if row else None
+
+    async def saved_text_exists(self, chat_id, text, media_file_id):
+        row = await self._fetchone(
+            """
+            SELECT EXISTS (
+                SELECT 1 FROM user_saved_texts
+                WHERE chat_id = ? AND json_extract(item, '$.text') IS ? AND CAST(json_extract(item, '$.media_file_id') AS TEXT) IS ?
+            )
+            """,
+            (chat_id, text, media_file_id))
+        return bool(row[0])
+
+    async def claim_access_key(self, key_value, chat_id, claim_ts):
+        def claim_sync():
+            with self.conn:
+                key_record = self.conn.execute(
+                    """
+                    UPDATE access_keys
+                    SET is_claimed = 1, claimed_by_chat_id = ?, claim_timestamp = ?
+                    WHERE key_value = ? AND (NOT is_claimed OR claimed_by_chat_id = ?) AND generation_timestamp + duration_seconds > ?
+                    RETURNING *
+                    """,
+                    (chat_id, claim_ts, key_value, chat_id, claim_ts)).fetchone()
+            if key_record: return key_record, None
+            return None, self.conn.execute("SELECT is_claimed, claimed_by_chat_id FROM access_keys WHERE key_value = ?", (key_value,)).fetchone()
+        return await self._run(claim_sync)
+
+    async def insert_access_key(self, key_value, key_type, duration_s, admin_chat_id, generation_ts, assigned_wm_text=None):
+        await self._execute(
+            """INSERT INTO access_keys (key_value, key_type, duration_seconds, generated_by_admin_id, generation_timestamp, original_expiry_timestamp, assigned_watermark_text)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (key_value, key_type, duration_s, admin_chat_id, generation_ts, generation_ts + duration_s, assigned_wm_text))
+
+    async def insert_key_batch(self, batch_row, key_records):
+        def insert_batch_sync():
+            with self.conn:
+                self.conn.execute("INSERT INTO key_batches (batch_id, key_type, key_count, duration_seconds, generated_by_admin_id, generation_timestamp, assigned_watermark_text) VALUES (?, ?, ?, ?, ?, ?, ?)", batch_row)
+                self.conn.executemany(f"INSERT INTO access_keys ({', '.join(ACCESS_KEY_BATCH_COLUMNS)}) VALUES ({', '.join('?' * len(ACCESS_KEY_BATCH_COLUMNS))})", key_records)
+        await self._run(insert_batch_sync)
+
+    async def fetch_access_key(self, key_value):
+        return await self._fetchone("SELECT * FROM access_keys WHERE key_value = ?", (key_value,))
+
+    async def delete_access_key(self, key_value):
+        await self._execute("DELETE FROM access_keys WHERE key_value = ?", (key_value,))
+
+    async def count_access_keys(self, list_type):
+        return (await self._fetchone(f"SELECT count(*) FROM access_keys WHERE {'is_claimed' if list_type == 'claimed' else 'NOT is_claimed'}"))[0]
+
+    async def fetch_access_keys_page(self, list_type, limit, cursor=None):
+        query = f"SELECT key_value, key_type, generation_timestamp, duration_seconds, assigned_watermark_text, claimed_by_chat_id, claim_timestamp FROM access_keys WHERE {'is_claimed' if list_type == 'claimed' else 'NOT is_claimed'}"
+        if not cursor: params = (limit,); query += " ORDER BY generation_timestamp DESC, key_value DESC LIMIT ?"
+        elif cursor[0] == 'n': params = (cursor[1], cursor[2], limit); query += " AND (generation_timestamp, key_value) < (?, ?) ORDER BY generation_timestamp DESC, key_value DESC LIMIT ?"
+        else: params = (cursor[1], cursor[2], limit); query += " AND (generation_timestamp, key_value) > (?, ?) ORDER BY generation_timestamp ASC, key_value ASC LIMIT ?"
+        return await self._fetchall(query, params)
+
+    async def fetch_key_batch_stats(self, limit):
+        return await self._fetchall(
+            """
+            SELECT b.batch_id, b.key_type, b.key_count, b.duration_seconds, b.generation_timestamp,
+                   COUNT(k.key_value) AS remaining_count,
+                   COUNT(k.key_value) FILTER (WHERE k.is_claimed) AS claimed_count
+            FROM key_batches b LEFT JOIN access_keys k ON k.batch_id = b.batch_id
+            GROUP BY b.batch_id ORDER BY b.generation_timestamp DESC, b.batch_id DESC LIMIT ?
+            """, (limit,))
+
+    async def fetch_unclaimed_batch_keys(self, batch_id):
+        return [row['key_value'] for row in await self._fetchall("SELECT key_value FROM access_keys WHERE batch_id = ? AND NOT is_claimed ORDER BY key_value", (batch_id,))]
+
+    async def create_broadcast_job(self, job_id, admin_chat_id, message_text, progress_message_id, created_at, owner, lease_until):
+        def create_job_sync():
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO broadcast_jobs (job_id, admin_chat_id, message_text, progress_message_id, created_at, owner, lease_until) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, admin_chat_id, message_text, progress_message_id, created_at, owner, lease_until))
+                return self.conn.execute(
+                    "INSERT INTO broadcast_recipients (job_id, chat_id) SELECT ?, chat_id FROM users WHERE has_valid_key AND (key_expiry_ts IS NULL OR key_expiry_ts > ?)",
+                    (job_id, time.time())).rowcount
+        return await self._run(create_job_sync)
+
+    async def fetch_broadcast_job(self, job_id):
+        return await self._fetchone("SELECT admin_chat_id, message_text, progress_message_id FROM broadcast_jobs WHERE job_id = ? AND status = 'running'", (job_id,))
+
+    async def fetch_broadcast_counts(self, job_id):
+        return await self._fetchall("SELECT status, COUNT(*) AS total FROM broadcast_recipients WHERE job_id = ? GROUP BY status", (job_id,))
+
+    async def iter_pending_broadcast_recipients(self, job_id):
+        """Sama dengan PostgresStorage: membaca penerima per halaman keyset pada chat_id."""
+        last_chat_id = None
+        while True:
+            if last_chat_id is None: rows = await self._fetchall("SELECT chat_id FROM broadcast_recipients WHERE job_id = ? AND status = 'pending' ORDER BY chat_id LIMIT ?", (job_id, BROADCAST_RECIPIENT_PAGE_SIZE))
+            else: rows = await self._fetchall("SELECT chat_id FROM broadcast_recipients WHERE job_id = ? AND status = 'pending' AND chat_id > ? ORDER BY chat_id LIMIT ?", (job_id, last_chat_id, BROADCAST_RECIPIENT_PAGE_SIZE))
+            if not rows: return
+            for row in rows: yield row['chat_id']
+            last_chat_id = rows[-1]['chat_id']
+
+    async def update_broadcast_recipients(self, rows):
+        def update_sync():
+            with self.conn: self.conn.executemany("UPDATE broadcast_recipients SET status = ?, error = ? WHERE job_id = ? AND chat_id = ?", [(status, error, job_id, chat_id) for job_id, chat_id, status, error in rows])
+        await self._run(update_sync)
+
+    async def set_broadcast_progress_message(self, job_id, message_id):
+        await self._execute("UPDATE broadcast_jobs SET progress_message_id = ? WHERE job_id = ?", (message_id, job_id))
+
+    async def finish_broadcast_job(self, job_id, finished_at):
+        await self._execute("UPDATE broadcast_jobs SET status = 'done', finished_at = ? WHERE job_id = ?", (finished_at, job_id))
+
+    async def claim_broadcast_jobs(self, owner, now, lease_until):
+        def claim_sync():
+            with self.conn:
+                return [row['job_id'] for row in self.conn.execute(
+                    "UPDATE broadcast_jobs SET owner = ?, lease_until = ? WHERE status = 'running' AND (lease_until IS NULL OR lease_until < ?) RETURNING job_id",
+                    (owner, lease_until, now)).fetchall()]
+        return await self._run(claim_sync)
+
+    async def renew_broadcast_lease(self, job_id, owner, lease_until):
+        return await self._execute("UPDATE broadcast_jobs SET lease_until = ? WHERE job_id = ? AND owner = ? AND status = 'running'", (lease_until, job_id, owner)) > 0
+
+    async def fetch_resolved_peer(self, owner_chat_id, peer_id=None, username=None):
+        if peer_id is not None:
+            return await self._fetchone("SELECT peer_id, access_hash, peer_type, title, username FROM resolved_entities WHERE owner_chat_id = ? AND peer_id = ?", (owner_chat_id, peer_id))
+        return await self._fetchone("SELECT peer_id, access_hash, peer_type, title, username FROM resolved_entities WHERE owner_chat_id = ? AND username = ? ORDER BY resolved_at DESC LIMIT 1", (owner_chat_id, username))
+
+    async def save_resolved_peers(self, owner_chat_id, peer_rows, resolved_at):
+        def save_peers_sync():
+            with self.conn:
+                self.conn.executemany(
+                    """
+                    INSERT INTO resolved_entities (owner_chat_id, peer_id, access_hash, peer_type, title, username, resolved_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (owner_chat_id, peer_id) DO UPDATE SET
+                        access_hash = excluded.access_hash, peer_type = excluded.peer_type, title = excluded.title,
+                        username = excluded.username, resolved_at = excluded.resolved_at
+                    """,
+                    [(owner_chat_id, *peer_row, resolved_at) for peer_row in peer_rows])
+        await self._run(save_peers_sync)
+
+    async def clear_resolved_peers(self, owner_chat_id):
+        await self._execute("DELETE FROM resolved_entities WHERE owner_chat_id = ?", (owner_chat_id,))
+
+    async def fetch_media_handle(self, owner_chat_id, item_id):
+        return await self._fetchone("SELECT kind, media_id, access_hash, file_reference, source_peer_id, source_msg_id FROM media_handles WHERE owner_chat_id = ? AND item_id = ?", (owner_chat_id, item_id))
+
+    async def save_media_handle(self, owner_chat_id, item_id, handle_row, updated_at):
+        await self._execute(
+            """
+            INSERT INTO media_handles (owner_chat_id, item_id, kind, media_id, access_hash, file_reference, source_peer_id, source_msg_id, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (owner_chat_id, item_id) DO UPDATE SET
+                kind = excluded.kind, media_id = excluded.media_id, access_hash = excluded.access_hash, file_reference = excluded.file_reference,
+                source_peer_id = excluded.source_peer_id, source_msg_id = excluded.source_msg_id, updated_at = excluded.updated_at
+            """,
+            (owner_chat_id, item_id, *handle_row, updated_at))
+
+    async def delete_media_handles(self, owner_chat_id, item_ids=None):
+        if item_ids is None: await self._execute("DELETE FROM media_handles WHERE owner_chat_id = ?", (owner_chat_id,))
+        else: await self._execute("DELETE FROM media_handles WHERE owner_chat_id = ? AND item_id IN (SELECT value FROM json_each(?))", (owner_chat_id, json.dumps(item_ids)))
+
+    async def save_delivery_report(self, report_row):
+        await self._execute(
+            "INSERT INTO delivery_reports (chat_id, action_name, started_at, finished_at, sent_count, failed_count, aborted, avg_latency_ms, error_counts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            report_row)
+
+    async def prune_delivery_reports(self, before_ts):
+        await self._execute("DELETE FROM delivery_reports WHERE started_at < ?", (before_ts,))
+
+
 async def save_user_data(chat_id, phone_number=None, session_string=None, bot_data=None):
+    """Menyimpan hanya kunci bot_data yang berubah sebagai patch JSON dalam satu penulisan atomik. Mengembalikan False bila semua percobaan gagal."""
+    bot_data_patch = {key: value for key, value in (bot_data or {}).items() if key in DEFAULT_BOT_DATA}
+    bot_data_patch_json = dump_bot_data_json(bot_data_patch)
+    need_full_row = chat_id not in user_data_cache
     for attempt in range(RETRY_ATTEMPTS):
         try:
-            async with db_pool.acquire() as conn:
-                existing_db_row = await conn.fetchrow('SELECT phone_number, session_string, bot_data FROM users WHERE chat_id = $1 FOR UPDATE', chat_id)
-                db_phone, db_session, db_bot_data_json = (existing_db_row['phone_number'], existing_db_row['session_string'], existing_db_row['bot_data']) if existing_db_row else (None, None, None)
-                
-                db_bot_data_dict = {}
-                if db_bot_data_json:
-                    try: db_bot_data_dict = json.loads(db_bot_data_json)
-                    except json.JSONDecodeError: logger.warning(f"JSON tidak valid di DB untuk {chat_id}")
-                
-                final_phone = phone_number if phone_number is not None else db_phone
-                final_session = session_string if session_string is not None else db_session
-                
-                final_bot_data = copy.deepcopy(DEFAULT_BOT_DATA) 
-                final_bot_data.update(db_bot_data_dict) 
-                if bot_data is not None: final_bot_data.update(bot_data)
-
-                current_keys = set(final_bot_data.keys())
-                default_keys = set(DEFAULT_BOT_DATA.keys())
-
-                for key_to_add in default_keys - current_keys:
-                    final_bot_data[key_to_add] = copy.deepcopy(DEFAULT_BOT_DATA[key_to_add])
-                
-                for key_to_remove in current_keys - default_keys:
-                    del final_bot_data[key_to_remove]
-                
-                final_bot_data_json_save = json.dumps(final_bot_data, separators=(',', ':'))
-                
-                if existing_db_row:
-                    await conn.execute(
-                        'UPDATE users SET phone_number = $2, session_string = $3, bot_data = $4 WHERE chat_id = $1',
-                        chat_id, final_phone, final_session, final_bot_data_json_save
-                    )
-                else:
-                    await conn.execute(
-                        'INSERT INTO users (chat_id, phone_number, session_string, bot_data) VALUES ($1, $2, $3, $4)',
-                        chat_id, final_phone, final_session, final_bot_data_json_save
-                    )
-                
-                user_data_cache[chat_id] = (time.time(), final_phone, final_session, final_bot_data)
-                return
+            saved_row = await storage.save_user(chat_id, phone_number, session_string, bot_data_patch_json, need_full_row)
+            break
         except Exception as e:
             logger.error(f"Simpan data percobaan {attempt+1} untuk {chat_id} gagal: {e}", exc_info=True)
             if attempt < RETRY_ATTEMPTS - 1: await asyncio.sleep(RETRY_DELAY)
-            else: logger.critical(f"Semua percobaan menyimpan data untuk {chat_id} gagal.")
-        return
+            else: logger.critical(f"Semua percobaan menyimpan data untuk {chat_id} gagal."); return False
+
+    cached_entry = user_data_cache.get(chat_id)
+    if cached_entry:
+        final_bot_data = cached_entry[3].copy()
+        final_bot_data.update(bot_data_patch)
+    elif saved_row['bot_data']:
+        try: final_bot_data = UserState.from_json(saved_row['bot_data'])
+        except json.JSONDecodeError: logger.warning(f"JSON tidak valid di DB untuk {chat_id}"); return True
+    else:
+        return True
+    # Update yang masuk buffer selama penulisan ini lebih baru dari patch yang baru ditulis; jangan ditimpa
+    final_phone, final_session, final_bot_data = apply_pending_user_writes(chat_id, saved_row['phone_number'], saved_row['session_string'], final_bot_data)
+    user_data_cache[chat_id] = (time.time(), final_phone, final_session, final_bot_data)
+    return True
 
 async def load_user_data(chat_id):
+    """Memuat data pengguna apa adanya; bentuk bot_data sudah dijamin oleh migrasi skema saat startup."""
     for attempt in range(RETRY_ATTEMPTS):
         try:
-            async with db_pool.acquire() as conn:
-                row = await conn.fetchrow('SELECT phone_number, session_string, bot_data FROM users WHERE chat_id = $1', chat_id)
-                current_bot_data = copy.deepcopy(DEFAULT_BOT_DATA)
-                phone_to_return, session_to_return = None, None
-
-                if row:
-                    phone_to_return = row['phone_number']
-                    session_to_return = row['session_string']
-                    if row['bot_data']:
-                        try: 
-                            loaded_db_data = json.loads(row['bot_data'])
-                            for key in DEFAULT_BOT_DATA:
-                                if key in loaded_db_data:
-                                    current_bot_data[key] = loaded_db_data[key]
-                        except json.JSONDecodeError: logger.error(f"Error decode JSON untuk {chat_id}. Menggunakan data default.")
-                    
-                    made_changes = False
-                    for key, default_value in DEFAULT_BOT_DATA.items():
-                        if key not in current_bot_data:
-                            current_bot_data[key] = copy.deepcopy(default_value)
-                            made_changes = True
-                    
-                    keys_in_loaded_data = list(current_bot_data.keys())
-                    for key_in_loaded in keys_in_loaded_data:
-                        if key_in_loaded not in DEFAULT_BOT_DATA:
-                            del current_bot_data[key_in_loaded]
-                            made_changes = True
-
-                    if made_changes:
-                        logger.info(f"Skema data pengguna {chat_id} diperbarui/dibersihkan. Menyimpan struktur baru.")
-                        await save_user_data(chat_id, phone_number=phone_to_return, session_string=session_to_return, bot_data=current_bot_data)
-                    
-                    return phone_to_return, session_to_return, current_bot_data
-                
-                logger.info(f"Tidak ada data untuk {chat_id}. Membuat pengguna baru dengan data default.")
-                await save_user_data(chat_id, bot_data=current_bot_data)
-                return None, None, current_bot_data
+            row = await storage.load_user(chat_id)
+            if row:
+                current_bot_data = None
+                if row['bot_data']:
+                    try: current_bot_data = UserState.from_json(row['bot_data'])
+                    except json.JSONDecodeError: logger.error(f"Error decode JSON untuk {chat_id}. Menggunakan data default.")
+                return row['phone_number'], row['session_string'], current_bot_data or UserState()
+
+            logger.info(f"Tidak ada data untuk {chat_id}. Membuat pengguna baru dengan data default.")
+            current_bot_data = UserState()
+            await save_user_data(chat_id, bot_data=current_bot_data)
+            return None, None, current_bot_data
         except Exception as e:
             logger.error(f"Muat data percobaan {attempt+1} untuk {chat_id} gagal: {e}", exc_info=True)
             if attempt < RETRY_ATTEMPTS - 1: await asyncio.sleep(RETRY_DELAY)
             else:
                 logger.critical(f"Semua percobaan memuat data untuk {chat_id} gagal. Mengembalikan default in-memory.")
-                return None, None, copy.deepcopy(DEFAULT_BOT_DATA)
+                return None, None, UserState()
 
 async def get_user_data(chat_id):
-    current_time = time.time()
-    if chat_id in user_data_cache:
-        timestamp, phone, session, bot_data_cache = user_data_cache[chat_id]
-        if current_time - timestamp < CACHE_TTL:
-            needs_refresh = False
-            temp_bot_data = bot_data_cache.copy()
-            for key, default_value in DEFAULT_BOT_DATA.items():
-                if key not in temp_bot_data:
-                    temp_bot_data[key] = copy.deepcopy(default_value)
-                    needs_refresh = True 
-            
-            cached_keys = set(temp_bot_data.keys())
-            default_keys = set(DEFAULT_BOT_DATA.keys())
-            if cached_keys - default_keys: 
-                needs_refresh = True
-
-            if not needs_refresh:
-                return phone, session, temp_bot_data
-            else:
-                logger.info(f"Cache untuk {chat_id} perlu penyegaran skema.")
+    cached_entry = user_data_cache.lookup(chat_id)
+    if cached_entry:
+        return cached_entry[1], cached_entry[2], cached_entry[3].copy()
     
+    phone, session, bot_data_db = await user_data_loads.run(chat_id, functools.partial(load_user_data_into_cache, chat_id))
+    return phone, session, bot_data_db.copy()
+
+async def load_user_data_into_cache(chat_id):
+    """Satu load DB per chat_id untuk semua pemanggil get_user_data yang miss bersamaan."""
     phone, session, bot_data_db = await load_user_data(chat_id)
+    phone, session, bot_data_db = apply_pending_user_writes(chat_id, phone, session, bot_data_db)
     user_data_cache[chat_id] = (time.time(), phone, session, bot_data_db)
     return phone, session, bot_data_db
 
-async def update_user_data_db(chat_id, phone_number=None, session_string=None, bot_data_update=None):
-    current_phone, current_session, current_bot_data = await get_user_data(chat_id)
-    final_phone = phone_number if phone_number is not None else current_phone
-    final_session = session_string if session_string is not None else current_session
-    updated_bot_data = current_bot_data.copy() 
+async def update_user_data_db(chat_id, phone_number=None, session_string=None, bot_data_update=None, flush=False):
+    bot_data_patch = {}
     if bot_data_update: 
         for key, value in bot_data_update.items():
             if key in DEFAULT_BOT_DATA: 
-                 updated_bot_data[key] = value
+                 bot_data_patch[key] = value
             else:
-                logger.warning(f"Mencoba memperbarui/menambah kunci tidak dikenal '{key}' ke bot_data untuk {chat_id}. Kunci ini akan disimpan tapi mungkin tidak digunakan oleh DEFAULT_BOT_DATA.")
-                updated_bot_data[key] = value 
-    await save_user_data(chat_id, phone_number=final_phone, session_string=final_session, bot_data=updated_bot_data)
+                logger.warning(f"Mencoba memperbarui/menambah kunci tidak dikenal '{key}' ke bot_data untuk {chat_id}. Kunci ini diabaikan karena tidak ada di DEFAULT_BOT_DATA.")
+    pending_entry = pending_user_writes.setdefault(chat_id, {'phone_number': None, 'session_string': None, 'bot_data': {}})
+    if phone_number is not None: pending_entry['phone_number'] = phone_number
+    if session_string is not None: pending_entry['session_string'] = session_string
+    pending_entry['bot_data'].update(bot_data_patch)
+
+    if chat_id in user_data_cache:
+        cache_ts, cache_phone, cache_session, cache_bot_data = user_data_cache[chat_id]
+        merged_bot_data = cache_bot_data.copy()
+        merged_bot_data.update(bot_data_patch)
+        user_data_cache[chat_id] = (
+            cache_ts,
+            phone_number if phone_number is not None else cache_phone,
+            session_string if session_string is not None else cache_session,
+            merged_bot_data
+        )
+
+    if flush or phone_number is not None or session_string is not None or DURABLE_BOT_DATA_KEYS.intersection(bot_data_patch):
+        await flush_user_data(chat_id)
+    elif chat_id not in pending_flush_tasks:
+        pending_flush_tasks[chat_id] = asyncio.create_task(debounced_flush_user_data(chat_id))
+
+# --- Write-Behind Buffer State Pengguna ---
+def apply_pending_user_writes(chat_id, phone, session, bot_data):
+    """Menimpa data hasil muat DB dengan perubahan yang masih tertahan di buffer write-behind."""
+    pending_entry = pending_user_writes.get(chat_id)
+    if not pending_entry: return phone, session, bot_data
+    merged_bot_data = bot_data.copy()
+    merged_bot_data.update(pending_entry['bot_data'])
+    return (
+        pending_entry['phone_number'] if pending_entry['phone_number'] is not None else phone,
+        pending_entry['session_string'] if pending_entry['session_string'] is not None else session,
+        merged_bot_data
+    )
+
+async def flush_user_data(chat_id):
+    """Menulis seluruh perubahan tertahan untuk chat_id ke DB dalam satu penulisan."""
+    flush_task = pending_flush_tasks.pop(chat_id, None)
+    if flush_task and flush_task is not asyncio.current_task() and not flush_task.done():
+        flush_task.cancel()
+    async with user_flush_locks[chat_id]:
+        pending_entry = pending_user_writes.pop(chat_id, None)
+        if not pending_entry: return
+        if not await save_user_data(chat_id, phone_number=pending_entry['phone_number'], session_string=pending_entry['session_string'], bot_data=pending_entry['bot_data']):
+            requeue_pending_user_write(chat_id, pending_entry)
+
+def requeue_pending_user_write(chat_id, failed_entry):
+    """Kembalikan patch yang gagal ditulis ke buffer, di bawah update yang lebih baru, lalu jadwalkan flush ulang."""
+    newer_entry = pending_user_writes.get(chat_id)
+    if newer_entry:
+        failed_entry['bot_data'].update(newer_entry['bot_data'])
+        if newer_entry['phone_number'] is not None: failed_entry['phone_number'] = newer_entry['phone_number']
+        if newer_entry['session_string'] is not None: failed_entry['session_string'] = newer_entry['session_string']
+    pending_user_writes[chat_id] = failed_entry
+    logger.warning(f"Perubahan data {chat_id} dikembalikan ke buffer write-behind untuk dicoba lagi.")
+    if chat_id not in pending_flush_tasks:
+        pending_flush_tasks[chat_id] = asyncio.create_task(debounced_flush_user_data(chat_id))
+
+async def debounced_flush_user_data(chat_id):
+    try:
+        await asyncio.sleep(WRITE_BEHIND_DELAY)
+        await flush_user_data(chat_id)
+    except asyncio.CancelledError: pass
+    except Exception as e_flush: logger.error(f"Gagal flush data tertunda untuk {chat_id}: {e_flush}", exc_info=True)
+
+async def flush_all_user_data():
+    for pending_chat_id in list(pending_user_writes.keys()):
+        await flush_user_data(pending_chat_id)
+
+def discard_pending_user_writes(chat_id):
+    flush_task = pending_flush_tasks.pop(chat_id, None)
+    if flush_task and not flush_task.done(): flush_task.cancel()
+    pending_user_writes.pop(chat_id, None)
+
+def flush_user_writes_after_event(handler):
+    """Dekorator handler: semua update state selama satu event di-flush sekali di akhir event."""
+    @functools.wraps(handler)
+    async def wrapper(event):
+        try: return await handler(event)
+        finally:
+            try: await flush_user_data(event.chat_id)
+            except Exception as e_flush_event: logger.error(f"Gagal flush data setelah event untuk {event.chat_id}: {e_flush_event}", exc_info=True)
+    return wrapper
+
+# --- Invalidasi Cache Lintas Proses ---
+def on_user_cache_notification(_connection, _pid, _channel, payload):
+    """Buang entri cache pengguna yang diubah oleh proses lain; proses ini sendiri sudah memperbarui cache-nya."""
+    instance_id, _, chat_id_str = payload.partition(':')
+    if instance_id == INSTANCE_ID: return
+    chat_id_str, _, scope = chat_id_str.partition(':')
+    try:
+        user_data_cache.pop(int(chat_id_str), None)
+        # Set target hasil resolve hanya dibuang bila grup target berubah, bukan untuk setiap patch bot_data
+        if scope == USER_CACHE_TARGETS_SCOPE: drop_resolved_targets(int(chat_id_str))
+    except ValueError: logger.warning(f"Payload notifikasi cache tidak valid: {payload}")
+
+async def user_cache_listener():
+    """Koneksi LISTEN khusus. Selama terputus, cache dikosongkan dan TTL kembali ke CACHE_TTL pendek."""
+    global user_cache_listener_ready
+    if not storage.supports_notify:
+        user_cache_listener_ready = True
+        logger.info("Backend penyimpanan satu node; listener invalidasi cache tidak diperlukan.")
+        return
+    while True:
+        listener_conn = None
+        try:
+            listener_conn = await storage.connect_listener()
+            connection_closed = asyncio.Event()
+            listener_conn.add_termination_listener(lambda _conn: connection_closed.set())
+            await listener_conn.add_listener(USER_CACHE_CHANNEL, on_user_cache_notification)
+            user_data_cache.clear()
+            user_cache_listener_ready = True
+            logger.info(f"Listener invalidasi cache aktif (instance {INSTANCE_ID}).")
+            while not connection_closed.is_set():
+                try: await asyncio.wait_for(connection_closed.wait(), timeout=CACHE_TTL / 5)
+                except asyncio.TimeoutError: await listener_conn.execute('SELECT 1')
+        except asyncio.CancelledError:
+            user_cache_listener_ready = False
+            if listener_conn and not listener_conn.is_closed(): await listener_conn.close()
+            raise
+        except Exception as e_listener: logger.error(f"Listener invalidasi cache terputus: {e_listener}")
+        user_cache_listener_ready = False
+        user_data_cache.clear()
+        if listener_conn and not listener_conn.is_closed():
+            try: await listener_conn.close()
+            except Exception: pass
+        await asyncio.sleep(RETRY_DELAY)
+
+# --- Fungsi Daftar Item Pengguna ---
+def list_item_id(list_type, item):
+    return str(item) if list_type == 'target_groups' else item.get('id')
+
+def update_cached_target_index(chat_id, added_ids=(), removed_ids=(), reset=False):
+    """Ubah set indeks di tempat: biaya sebanding jumlah item yang berubah, bukan ukuran indeks."""
+    cached_entry = user_data_cache.get(chat_id)
+    if not cached_entry or cached_entry[3].target_index is None: return
+    target_index = cached_entry[3].target_index
+    if reset: target_index.clear(); return
+    target_index.update(added_ids)
+    target_index.difference_update(removed_ids)
+
+async def get_target_index(chat_id):
+    """Set item_id grup target untuk cek duplikat O(1); dimuat sekali lalu dijaga tetap sinkron oleh fungsi daftar.
+    Set yang dikembalikan dipakai bersama (juga oleh salinan UserState); pemanggil hanya membaca, tanpa await di tengah iterasi."""
+    cached_entry = user_data_cache.get(chat_id)
+    if cached_entry and cached_entry[3].target_index is not None: return cached_entry[3].target_index
+    target_index = set(await storage.fetch_list_ids(chat_id, 'target_groups'))
+    cached_entry = user_data_cache.get(chat_id)
+    if cached_entry: cached_entry[3].target_index = target_index
+    return target_index
+
+async def add_list_items(chat_id, list_type, items):
+    """Menambahkan item baru (duplikat item_id dilewati). Mengembalikan jumlah item yang benar-benar ditambahkan."""
+    if not items: return 0
+    item_ids = [list_item_id(list_type, item) for item in items]
+    added_count = await storage.add_list_items(chat_id, list_type, item_ids, [json.dumps(item, separators=(',', ':')) for item in items])
+    if list_type == 'target_groups':
+        update_cached_target_index(chat_id, added_ids=item_ids)
+        update_resolved_targets(chat_id, added_ids=item_ids)
+    return added_count
+
+async def delete_list_items(chat_id, list_type, item_ids):
+    if not item_ids: return 0
+    item_ids = [str(i) for i in item_ids]
+    deleted_count = await storage.delete_list_items(chat_id, list_type, item_ids)
+    if list_type == 'target_groups':
+        update_cached_target_index(chat_id, removed_ids=item_ids)
+        update_resolved_targets(chat_id, removed_ids=item_ids)
+    elif list_type == 'saved_texts': await forget_media_handles(chat_id, item_ids)
+    return deleted_count
+
+async def clear_list_items(chat_id, list_type):
+    await storage.clear_list_items(chat_id, list_type)
+    if list_type == 'target_groups':
+        update_cached_target_index(chat_id, reset=True)
+        update_resolved_targets(chat_id, reset=True)
+    elif list_type == 'saved_texts': await forget_media_handles(chat_id)
+
+async def clear_user_lists(chat_id):
+    """Kosongkan semua daftar item pengguna, padanan reset bot_data ke default sebelum daftar dipindah ke tabel sendiri."""
+    for list_type in USER_LIST_TABLES: await clear_list_items(chat_id, list_type)
+
+async def count_list_items(chat_id, list_type):
+    return await storage.count_list_items(chat_id, list_type)
+
+async def has_list_items(chat_id, list_type):
+    return await storage.has_list_items(chat_id, list_type)
+
+async def fetch_list_page(chat_id, list_type, offset, limit):
+    """Mengembalikan [(item_id, item)] untuk satu halaman, terurut sesuai urutan penambahan."""
+    return [(item_id, json.loads(item_json)) for item_id, item_json in await storage.fetch_list_page(chat_id, list_type, offset, limit)]
+
+async def fetch_list_items(chat_id, list_type):
+    return [json.loads(item_json) for item_json in await storage.fetch_list_items(chat_id, list_type)]
+
+async def fetch_list_item(chat_id, list_type, item_id):
+    item_json = await storage.fetch_list_item(chat_id, list_type, str(item_id))
+    return json.loads(item_json) if item_json else None
+
+async def saved_text_exists(chat_id, text, media_file_id):
+    return await storage.saved_text_exists(chat_id, text, str(media_file_id) if media_file_id is not None else None)
 
 # --- Fungsi Menu ---
 def main_menu(bot_data):
@@ -402,6 +1864,8 @@ def admin_main_menu():
 def admin_manage_keys_menu():
     buttons = [
         [Button.inline("➕ Buat Kunci Baru", b"admin_generate_key_prompt")],
+        [Button.inline("📦 Buat Kunci Massal", b"admin_bulk_key_prompt")],
+        [Button.inline("📈 Statistik Batch Kunci", b"admin_key_batches")],
         [Button.inline("📄 Daftar Kunci Belum Diklaim", b"admin_list_unclaimed_keys")],
         [Button.inline("👤 Daftar Kunci Diklaim", b"admin_list_claimed_keys")],
         [Button.inline("🗑️ Cabut/Hapus Kunci", b"admin_revoke_key_input")],
@@ -447,23 +1911,146 @@ async def ensure_connected(client, chat_id):
         logger.error(f"Error tidak terduga saat memastikan koneksi klien untuk {chat_id}: {e}", exc_info=True)
         return False
 
-async def validate_entity(user_client, entity_identifier_orig, chat_id, group_only=False):
+# --- Cache Entitas Per Klien ---
+# access_hash bergantung pada akun userbot, jadi cache dipisah per pemilik (chat_id) dan dibuang saat nomor akun berganti
+class ResolvedPeer:
+    """Hasil resolusi entitas yang cukup untuk mengirim tanpa get_entity lagi."""
+    __slots__ = ('peer_id', 'access_hash', 'peer_type', 'title', 'username')
+
+    def __init__(self, peer_id, access_hash, peer_type, title=None, username=None):
+        self.peer_id = peer_id
+        self.access_hash = access_hash
+        self.peer_type = peer_type
+        self.title = title
+        self.username = username
+
+    @classmethod
+    def from_entity(cls, entity):
+        if isinstance(entity, Channel): peer_type = 'megagroup' if getattr(entity, 'megagroup', False) else 'channel'
+        elif isinstance(entity, Chat): peer_type = 'chat'
+        else: peer_type = 'user'
+        title = getattr(entity, 'title', None) or ' '.join(filter(None, (getattr(entity, 'first_name', None), getattr(entity, 'last_name', None)))) or None
+        return cls(get_peer_id(entity), getattr(entity, 'access_hash', None), peer_type, title, getattr(entity, 'username', None))
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['peer_id'], row['access_hash'], row['peer_type'], row['title'], row['username'])
+
+    def to_row(self):
+        return (self.peer_id, self.access_hash, self.peer_type, self.title, self.username)
+
+    @property
+    def is_group(self):
+        return self.peer_type in ('chat', 'megagroup')
+
+    @property
+    def input_peer(self):
+        real_id, _peer_cls = resolve_id(self.peer_id)
+        if self.peer_type == 'chat': return InputPeerChat(real_id)
+        if self.peer_type == 'user': return InputPeerUser(real_id, self.access_hash or 0)
+        return InputPeerChannel(real_id, self.access_hash or 0)
+
+    def __repr__(self):
+        return f"ResolvedPeer({self.peer_id}, {self.peer_type}, {self.title!r})"
+
+def entity_cache_key(identifier):
+    identifier = str(identifier).strip()
+    return identifier.lower() if identifier.startswith('@') else identifier
+
+def remember_resolved_peer(owner_chat_id, resolved_peer, identifier=None):
+    """Simpan ke cache klien (maks ENTITY_CACHE_SIZE kunci); total semua klien dibatasi ENTITY_CACHE_TOTAL_SIZE dengan LRU per pemilik."""
+    global client_entity_cache_size
+    client_cache = client_entity_caches.get(owner_chat_id)
+    if client_cache is None: client_cache = client_entity_caches[owner_chat_id] = OrderedDict()
+    client_entity_caches.move_to_end(owner_chat_id)
+    size_before = len(client_cache)
+    cache_keys = {str(resolved_peer.peer_id)}
+    if resolved_peer.username: cache_keys.add(f"@{resolved_peer.username.lower()}")
+    if isinstance(identifier, (str, int)): cache_keys.add(entity_cache_key(identifier))
+    for cache_key in cache_keys:
+        client_cache[cache_key] = resolved_peer
+        client_cache.move_to_end(cache_key)
+    while len(client_cache) > ENTITY_CACHE_SIZE: client_cache.popitem(last=False)
+    client_entity_cache_size += len(client_cache) - size_before
+    while client_entity_cache_size > ENTITY_CACHE_TOTAL_SIZE and len(client_entity_caches) > 1:
+        evicted_owner_chat_id, evicted_cache = client_entity_caches.popitem(last=False)
+        client_entity_cache_size -= len(evicted_cache)
+        logger.debug(f"Cache entitas klien {evicted_owner_chat_id} dibuang (batas total {ENTITY_CACHE_TOTAL_SIZE}).")
+
+def drop_client_entity_cache(owner_chat_id):
+    global client_entity_cache_size
+    client_cache = client_entity_caches.pop(owner_chat_id, None)
+    if client_cache: client_entity_cache_size -= len(client_cache)
+
+async def lookup_resolved_peer(owner_chat_id, identifier):
+    """Cari di cache memori klien, lalu di tabel resolved_entities; None bila belum pernah di-resolve."""
+    cache_key = entity_cache_key(identifier)
+    client_cache = client_entity_caches.get(owner_chat_id)
+    if client_cache and cache_key in client_cache:
+        client_entity_caches.move_to_end(owner_chat_id)
+        client_cache.move_to_end(cache_key)
+        return client_cache[cache_key]
+    if cache_key.startswith('@'): peer_row = await storage.fetch_resolved_peer(owner_chat_id, username=cache_key[1:])
+    elif cache_key.lstrip('-').isdigit(): peer_row = await storage.fetch_resolved_peer(owner_chat_id, peer_id=int(cache_key))
+    else: return None
+    if not peer_row: return None
+    resolved_peer = ResolvedPeer.from_row(peer_row)
+    remember_resolved_peer(owner_chat_id, resolved_peer, identifier)
+    return resolved_peer
+
+def lookup_entity_failure(failure_key):
+    """(kelas_error, pesan) kegagalan validasi yang masih berlaku, atau None."""
+    cached_failure = entity_failure_cache.get(failure_key)
+    if not cached_failure: return None
+    if time.time() >= cached_failure[0]:
+        entity_failure_cache.pop(failure_key, None)
+        return None
+    return cached_failure[1], cached_failure[2]
+
+def remember_entity_failure(failure_key, failure_class, error_message, ttl=None):
+    entity_failure_cache[failure_key] = (time.time() + (ttl if ttl is not None else ENTITY_FAILURE_TTLS[failure_class]), failure_class, error_message)
+    entity_failure_cache.move_to_end(failure_key)
+    while len(entity_failure_cache) > ENTITY_FAILURE_CACHE_SIZE: entity_failure_cache.popitem(last=False)
+
+async def forget_resolved_peers(owner_chat_id):
+    drop_client_entity_cache(owner_chat_id)
+    dialog_snapshots.pop(owner_chat_id, None)
+    drop_resolved_targets(owner_chat_id)
+    for failure_key in [key for key in entity_failure_cache if key[0] == owner_chat_id]: del entity_failure_cache[failure_key]
+    try: await storage.clear_resolved_peers(owner_chat_id)
+    except Exception as e_clear_peers: logger.error(f"Gagal menghapus cache entitas untuk {owner_chat_id}: {e_clear_peers}")
+
+async def validate_entity(user_client, entity_identifier_orig, chat_id, group_only=False, retry_failed=False):
+    """Resolve entitas menjadi ResolvedPeer; hasil disimpan per klien sehingga restart tidak memicu get_entity ulang.
+
+    Kegagalan juga di-cache per kelas error; retry_failed=True (input langsung pengguna) mengabaikannya kecuali FloodWait.
+    """
     if not user_client:
         logger.error(f"validate_entity dipanggil dengan user_client None untuk {entity_identifier_orig}, chat {chat_id}")
         return (False, "Klien userbot tidak aktif.")
-
-    validation_cache_key = f"validation_{str(entity_identifier_orig)}_{group_only}" 
-    cached_result_tuple = entity_cache.get(validation_cache_key)
-    if cached_result_tuple:
-        cached_entity, timestamp = cached_result_tuple
-        if time.time() - timestamp < CACHE_TTL:
-            if group_only:
-                is_valid_group = isinstance(cached_entity, Chat) or \
-                                 (isinstance(cached_entity, Channel) and getattr(cached_entity, 'megagroup', False))
-                if not is_valid_group: return (False, "Entitas yang di-cache bukan grup/supergrup.")
+    if not isinstance(entity_identifier_orig, (str, int)):
+        return await resolve_entity(user_client, entity_identifier_orig, chat_id, group_only, retry_failed)
+    resolution_key = (chat_id, entity_cache_key(entity_identifier_orig), group_only, retry_failed)
+    return await entity_resolutions.run(resolution_key, functools.partial(resolve_entity, user_client, entity_identifier_orig, chat_id, group_only, retry_failed))
+
+async def resolve_entity(user_client, entity_identifier_orig, chat_id, group_only, retry_failed=False):
+    failure_key = None
+    if isinstance(entity_identifier_orig, (str, int)):
+        try: cached_peer = await lookup_resolved_peer(chat_id, entity_identifier_orig)
+        except Exception as e_lookup:
+            logger.warning(f"Gagal membaca cache entitas {entity_identifier_orig} untuk {chat_id}: {e_lookup}")
+            cached_peer = None
+        if cached_peer:
+            if group_only and not cached_peer.is_group: return (False, "Entitas yang di-cache bukan grup/supergrup.")
             logger.debug(f"Menggunakan hasil validasi cache untuk {entity_identifier_orig}")
-            return (True, cached_entity) 
+            return (True, cached_peer)
+        failure_key = (chat_id, entity_cache_key(entity_identifier_orig))
+        cached_failure = lookup_entity_failure(failure_key)
+        if cached_failure and (cached_failure[0] == 'flood_wait' or not retry_failed):
+            logger.debug(f"Menggunakan kegagalan validasi cache ({cached_failure[0]}) untuk {entity_identifier_orig}")
+            return (False, cached_failure[1])
     
+    failure_class, failure_ttl = 'transient', None
     error_message = f"Tidak bisa mendapatkan informasi untuk '{str(entity_identifier_orig)[:50]}'."
     entity_to_check = None
     
@@ -476,7 +2063,6 @@ async def validate_entity(user_client, entity_identifier_orig, chat_id, group_on
             except ValueError: pass
     
     try:
-        await asyncio.sleep(0.1) 
         logger.debug(f"Validating entity: original='{entity_identifier_orig}', processed='{processed_identifier}' for chat_id={chat_id}")
         entity_to_check = await user_client.get_entity(processed_identifier)
 
@@ -489,40 +2075,218 @@ async def validate_entity(user_client, entity_identifier_orig, chat_id, group_on
             except Exception: pass
 
         if entity_to_check:
-            if len(entity_cache) >= ENTITY_CACHE_SIZE:
-                try: entity_cache.popitem(last=False)
-                except KeyError: pass
-            entity_cache[validation_cache_key] = (entity_to_check, time.time())
-
-            if group_only:
-                is_valid_group = isinstance(entity_to_check, Chat) or \
-                                 (isinstance(entity_to_check, Channel) and getattr(entity_to_check, 'megagroup', False))
-                if not is_valid_group:
-                    return (False, f"Entitas '{str(entity_identifier_orig)[:30]}' bukan grup atau supergrup publik.")
-            return (True, entity_to_check)
+            resolved_peer = ResolvedPeer.from_entity(entity_to_check)
+            remember_resolved_peer(chat_id, resolved_peer, entity_identifier_orig)
+            if failure_key: entity_failure_cache.pop(failure_key, None)
+            try: await storage.save_resolved_peers(chat_id, [resolved_peer.to_row()], int(time.time()))
+            except Exception as e_save_peer: logger.warning(f"Gagal menyimpan entitas {resolved_peer.peer_id} untuk {chat_id}: {e_save_peer}")
+
+            if group_only and not resolved_peer.is_group:
+                return (False, f"Entitas '{str(entity_identifier_orig)[:30]}' bukan grup atau supergrup publik.")
+            return (True, resolved_peer)
         else:
+            failure_class = 'not_found'
             error_message = f"Entitas '{str(entity_identifier_orig)[:30]}' tidak ditemukan (get_entity mengembalikan None)."
             
     except ValueError as e_val: 
+        failure_class = 'not_found'
         error_message = f"Entitas '{str(entity_identifier_orig)[:30]}' tidak ditemukan atau format tidak valid: {e_val}"
     except TypeError as e_type: 
+         failure_class = 'invalid'
          error_message = f"Tipe input tidak valid untuk '{str(entity_identifier_orig)[:30]}': {e_type}"
     except FloodWaitError as e_flood:
+        failure_class, failure_ttl = 'flood_wait', e_flood.seconds
         error_message = f"Kena FloodWait saat validasi '{str(entity_identifier_orig)[:30]}': {e_flood.seconds} detik. Coba beberapa saat lagi."
         logger.warning(f"FloodWait {e_flood.seconds}s validasi entitas {entity_identifier_orig} untuk {chat_id}.")
     except (UsernameNotOccupiedError, UsernameInvalidError):
+        failure_class = 'not_found'
         error_message = f"Username '{str(entity_identifier_orig)[:30]}' tidak ditemukan atau tidak valid."
-    except ChannelPrivateError: error_message = f"Channel/Grup '{str(entity_identifier_orig)[:30]}' privat."
-    except ChatAdminRequiredError: error_message = f"Memerlukan hak admin di '{str(entity_identifier_orig)[:30]}'."
+    except ChannelPrivateError: failure_class, error_message = 'private', f"Channel/Grup '{str(entity_identifier_orig)[:30]}' privat."
+    except ChatAdminRequiredError: failure_class, error_message = 'private', f"Memerlukan hak admin di '{str(entity_identifier_orig)[:30]}'."
     except RpcCallFailError as e_rpc: error_message = f"Gagal RPC Telegram untuk '{str(entity_identifier_orig)[:30]}': {e_rpc}"
     except UserChannelsTooMuchError: error_message = f"Pengguna telah bergabung terlalu banyak channel/grup."
     except Exception as e_gen:
         error_message = f"Error validasi tidak terduga untuk '{str(entity_identifier_orig)[:30]}': {type(e_gen).__name__}"
         logger.error(f"Error validasi entitas tidak terduga '{entity_identifier_orig}' untuk {chat_id}: {e_gen}", exc_info=True)
     
-    logger.warning(f"Validasi gagal untuk '{entity_identifier_orig}' (Pengguna: {chat_id}): {error_message}")
+    if failure_key: remember_entity_failure(failure_key, failure_class, error_message, failure_ttl)
+    logger.warning(f"Validasi gagal untuk '{entity_identifier_orig}' (Pengguna: {chat_id}, kelas: {failure_class}): {error_message}")
     return (False, error_message)
 
+# --- Snapshot Dialog ---
+def can_send_to_group(entity):
+    """Izin kirim dari data entitas di daftar dialog (keanggotaan, ban pribadi, dan default banned rights)."""
+    if getattr(entity, 'left', False) or getattr(entity, 'deactivated', False): return False
+    if getattr(entity, 'creator', False) or getattr(entity, 'admin_rights', None): return True
+    banned_rights = getattr(entity, 'banned_rights', None)
+    if banned_rights and banned_rights.send_messages: return False
+    default_banned_rights = getattr(entity, 'default_banned_rights', None)
+    return not (default_banned_rights and default_banned_rights.send_messages)
+
+class DialogSnapshot:
+    """Grup/channel yang diikuti akun dari satu kali iter_dialogs: peer_id -> (ResolvedPeer, boleh_kirim)."""
+    __slots__ = ('taken_at', 'entries', 'usernames')
+
+    def __init__(self):
+        self.taken_at = time.time()
+        self.entries = {}
+        self.usernames = {}
+
+    def add(self, entity):
+        resolved_peer = ResolvedPeer.from_entity(entity)
+        self.entries[resolved_peer.peer_id] = (resolved_peer, can_send_to_group(entity))
+        if resolved_peer.username: self.usernames[resolved_peer.username.lower()] = resolved_peer.peer_id
+        return resolved_peer
+
+    def lookup(self, identifier):
+        cache_key = entity_cache_key(identifier)
+        if cache_key.startswith('@'): peer_id = self.usernames.get(cache_key[1:])
+        elif cache_key.lstrip('-').isdigit():
+            peer_id = int(cache_key)
+            if peer_id > 0 and peer_id not in self.entries: peer_id = int(f"-100{peer_id}")
+        else: return None
+        return self.entries.get(peer_id)
+
+async def take_dialog_snapshot(chat_id, user_client):
+    """iter_dialogs mengambil dialog per halaman (100 per request), jadi ratusan grup cukup beberapa request."""
+    snapshot = DialogSnapshot()
+    async for dialog in user_client.iter_dialogs():
+        if isinstance(dialog.entity, (Chat, Channel)): remember_resolved_peer(chat_id, snapshot.add(dialog.entity))
+    dialog_snapshots[chat_id] = snapshot
+    try: await storage.save_resolved_peers(chat_id, [resolved_peer.to_row() for resolved_peer, _ in snapshot.entries.values()], int(snapshot.taken_at))
+    except Exception as e_save_snapshot: logger.warning(f"Gagal menyimpan entitas snapshot dialog untuk {chat_id}: {e_save_snapshot}")
+    logger.info(f"Snapshot dialog {chat_id}: {len(snapshot.entries)} grup/channel.")
+    return snapshot
+
+async def get_dialog_snapshot(chat_id, user_client, max_age=DIALOG_SNAPSHOT_TTL):
+    snapshot = dialog_snapshots.get(chat_id)
+    if snapshot and time.time() - snapshot.taken_at < max_age: return snapshot
+    return await dialog_snapshot_loads.run(chat_id, functools.partial(take_dialog_snapshot, chat_id, user_client))
+
+# --- Set Target Siap Kirim ---
+class ResolvedTargetSet:
+    """Grup target pengguna yang sudah di-resolve ke ResolvedPeer (InputPeer siap kirim).
+
+    pending berisi target yang belum di-resolve, blocked berisi target yang diikuti tetapi saat ini tanpa izin kirim
+    (dicek ulang setelah snapshot kedaluwarsa), removals berisi target yang gagal permanen beserta alasannya dan
+    dihapus dari daftar sekaligus di akhir siklus. peer_targets memetakan peer_id kembali ke string target asli.
+    """
+    __slots__ = ('peers', 'peer_targets', 'pending', 'removals', 'blocked', 'blocked_at', 'refresh_task')
+
+    def __init__(self, target_ids=()):
+        self.peers = OrderedDict()
+        self.peer_targets = {}
+        self.pending = OrderedDict.fromkeys(target_ids)
+        self.removals = OrderedDict()
+        self.blocked = {}
+        self.blocked_at = 0
+        self.refresh_task = None
+
+    def add(self, target_ids):
+        for target_id in target_ids:
+            if target_id not in self.peers: self.pending[target_id] = None
+
+    def set_peer(self, target_id, resolved_peer):
+        self.peers[target_id] = resolved_peer
+        self.peer_targets[resolved_peer.peer_id] = target_id
+
+    def remove(self, target_ids):
+        for target_id in target_ids:
+            resolved_peer = self.peers.pop(target_id, None)
+            if resolved_peer and self.peer_targets.get(resolved_peer.peer_id) == target_id: del self.peer_targets[resolved_peer.peer_id]
+            self.pending.pop(target_id, None)
+            self.removals.pop(target_id, None)
+            self.blocked.pop(target_id, None)
+
+    def mark_removed(self, target_id, reason):
+        """Keluarkan target dari pengiriman sekarang; penghapusan dari daftar ditunda sampai apply_target_removals."""
+        resolved_peer = self.peers.pop(target_id, None)
+        if resolved_peer and self.peer_targets.get(resolved_peer.peer_id) == target_id: del self.peer_targets[resolved_peer.peer_id]
+        self.pending.pop(target_id, None)
+        self.removals[target_id] = reason
+
+async def resolve_pending_targets(chat_id, user_client, target_set):
+    """Resolve target pending; kegagalan sementara tetap pending, FloodWait menghentikan putaran ini.
+
+    Bila banyak target belum dikenal, semuanya dicek dari satu snapshot dialog; RPC per entitas hanya untuk yang tidak ada di snapshot.
+    """
+    known_keys = client_entity_caches.get(chat_id, {})
+    unknown_count = sum(1 for target_id in target_set.pending if entity_cache_key(target_id) not in known_keys)
+    snapshot = None
+    if unknown_count >= DIALOG_SNAPSHOT_MIN_TARGETS:
+        try: snapshot = await get_dialog_snapshot(chat_id, user_client)
+        except Exception as e_snapshot: logger.warning(f"Snapshot dialog gagal untuk {chat_id}, validasi per entitas: {e_snapshot}")
+    for target_id in list(target_set.pending):
+        if target_id not in target_set.pending: continue
+        snapshot_entry = snapshot.lookup(target_id) if snapshot else None
+        if snapshot_entry:
+            resolved_peer, can_send = snapshot_entry
+            del target_set.pending[target_id]
+            if not resolved_peer.is_group: target_set.removals[target_id] = f"Entitas '{target_id[:30]}' bukan grup atau supergrup publik."
+            elif not can_send:
+                target_set.blocked[target_id] = resolved_peer
+                target_set.blocked_at = snapshot.taken_at
+            else: target_set.set_peer(target_id, resolved_peer)
+            continue
+        is_valid, peer_or_error = await validate_entity(user_client, target_id, chat_id, group_only=True)
+        if target_id not in target_set.pending: continue
+        if is_valid:
+            del target_set.pending[target_id]
+            target_set.set_peer(target_id, peer_or_error)
+            continue
+        cached_failure = lookup_entity_failure((chat_id, entity_cache_key(target_id)))
+        if cached_failure and cached_failure[0] == 'flood_wait': break
+        if cached_failure and cached_failure[0] == 'transient': continue
+        del target_set.pending[target_id]
+        target_set.removals[target_id] = peer_or_error
+
+async def refresh_resolved_targets(chat_id):
+    target_set, user_client = resolved_target_sets.get(chat_id), user_clients.get(chat_id)
+    if not target_set or not user_client: return
+    try: await resolve_pending_targets(chat_id, user_client, target_set)
+    except asyncio.CancelledError: raise
+    except Exception as e_refresh_targets: logger.error(f"Gagal me-resolve target baru untuk {chat_id}: {e_refresh_targets}", exc_info=True)
+
+def schedule_target_refresh(chat_id):
+    target_set = resolved_target_sets.get(chat_id)
+    if not target_set or not target_set.pending or chat_id not in user_clients: return
+    if target_set.refresh_task and not target_set.refresh_task.done(): return
+    target_set.refresh_task = asyncio.create_task(refresh_resolved_targets(chat_id))
+
+def drop_resolved_targets(chat_id):
+    target_set = resolved_target_sets.pop(chat_id, None)
+    if target_set and target_set.refresh_task and not target_set.refresh_task.done(): target_set.refresh_task.cancel()
+
+def update_resolved_targets(chat_id, added_ids=(), removed_ids=(), reset=False):
+    """Dipanggil oleh fungsi daftar target_groups agar set tetap sinkron tanpa dibangun ulang."""
+    if reset: drop_resolved_targets(chat_id); return
+    target_set = resolved_target_sets.get(chat_id)
+    if not target_set: return
+    target_set.remove(removed_ids)
+    target_set.add(added_ids)
+    schedule_target_refresh(chat_id)
+
+async def apply_target_removals(chat_id, target_set, progress):
+    """Satu penghapusan batch untuk semua target yang gagal permanen selama siklus ini; notifikasinya masuk ke digest progress."""
+    if not target_set.removals: return
+    removed_target_ids = list(target_set.removals)
+    if await delete_list_items(chat_id, 'target_groups', removed_target_ids):
+        removed_targets_text = ", ".join(removed_target_ids[:5]) + ("..." if len(removed_target_ids) > 5 else "")
+        progress.note(f"{len(removed_target_ids)} grup target dihapus dari daftar Anda (tidak valid atau akses ditolak): {removed_targets_text}.")
+    target_set.remove(removed_target_ids)
+
+async def get_resolved_targets(chat_id, user_client):
+    """Build pertama me-resolve semua target; setelah itu target baru di-resolve di latar belakang."""
+    target_set = resolved_target_sets.get(chat_id)
+    if target_set is None:
+        target_set = ResolvedTargetSet(await fetch_list_items(chat_id, 'target_groups'))
+        resolved_target_sets[chat_id] = target_set
+        await resolve_pending_targets(chat_id, user_client, target_set)
+    elif target_set.blocked and time.time() - target_set.blocked_at >= DIALOG_SNAPSHOT_TTL:
+        target_set.add(list(target_set.blocked))
+        target_set.blocked.clear()
+    schedule_target_refresh(chat_id)
+    return target_set
 
 async def verify_session(user_client, chat_id): 
     if not user_client: return False 
@@ -555,6 +2319,18 @@ async def verify_session(user_client, chat_id):
     if warning_counts[chat_id] >= MAX_WARNINGS: await logout_user(chat_id, "MAX_WARNINGS_REACHED"); return False
     return False
 
+def release_user_runtime_state(chat_id):
+    """Buang state memori per pengguna (cache entitas, snapshot dialog, set target, pacer, payload, handle media) saat logout/kunci kedaluwarsa.
+    Pacer yang masih menahan FloodWait dipertahankan: batas itu milik akun Telegram, bukan sesi bot."""
+    drop_client_entity_cache(chat_id)
+    dialog_snapshots.pop(chat_id, None)
+    drop_resolved_targets(chat_id)
+    compiled_payloads.pop(chat_id, None)
+    drop_media_handle_cache(chat_id)
+    for failure_key in [key for key in entity_failure_cache if key[0] == chat_id]: del entity_failure_cache[failure_key]
+    pacer = client_pacers.get(chat_id)
+    if pacer and pacer.hold_until <= time.monotonic(): del client_pacers[chat_id]
+
 async def logout_user(chat_id, reason="MANUAL_LOGOUT"):
     try:
         logger.info(f"Memulai proses logout untuk pengguna {chat_id}. Alasan: {reason}")
@@ -568,9 +2344,9 @@ async def logout_user(chat_id, reason="MANUAL_LOGOUT"):
             task_to_cancel.cancel()
         
         _phone, _session, old_bot_data = await get_user_data(chat_id) 
-        fresh_bot_data = copy.deepcopy(DEFAULT_BOT_DATA)
+        discard_pending_user_writes(chat_id)
+        fresh_bot_data = UserState()
         fresh_bot_data['is_registered'] = False 
-        fresh_bot_data['session_string'] = None 
         
         if reason != "KEY_EXPIRED":
             fresh_bot_data['active_key_value'] = old_bot_data.get('active_key_value')
@@ -584,6 +2360,8 @@ async def logout_user(chat_id, reason="MANUAL_LOGOUT"):
         await save_user_data(chat_id, phone_number=_phone, session_string=None, bot_data=fresh_bot_data)
         if chat_id in user_data_cache: del user_data_cache[chat_id]
         if chat_id in warning_counts: del warning_counts[chat_id]
+        await clear_user_lists(chat_id)
+        release_user_runtime_state(chat_id)
         logger.info(f"Pengguna {chat_id} berhasil logout.")
         return True
     except Exception as e: logger.error(f"Error saat logout pengguna {chat_id}: {e}", exc_info=True); return False
@@ -625,11 +2403,10 @@ async def login_user(event_or_chat_id, phone_number_ext=None):
             if chat_id in user_clients: del user_clients[chat_id]
     else:
         new_session_string = user_client.session.save()
+        login_patch = {'is_registered': True, 'session_owner': INSTANCE_NAME, 'awaiting_input_type': None, 'awaiting_2fa': False}
+        await update_user_data_db(chat_id, phone_number=phone_number_to_use, session_string=new_session_string, bot_data_update=login_patch)
         bot_data_login_update = bot_data_login.copy()
-        bot_data_login_update['is_registered'] = True
-        bot_data_login_update['awaiting_input_type'] = None
-        bot_data_login_update['awaiting_2fa'] = False
-        await update_user_data_db(chat_id, phone_number=phone_number_to_use, session_string=new_session_string, bot_data_update=bot_data_login_update)
+        bot_data_login_update.update(login_patch)
         
         status_text, buttons = main_menu(bot_data_login_update)
         await bot.send_message(chat_id, f"Berhasil masuk userbot dengan sesi yang sudah ada!\n\n{status_text}", buttons=buttons)
@@ -650,23 +2427,10 @@ async def manage_forward_copy_task(chat_id, bot_data):
 
 # --- Handler Bot Utama ---
 @bot.on(events.NewMessage(pattern='/start'))
+@flush_user_writes_after_event
 async def start(event):
     chat_id = event.chat_id
     _phone, _session, bot_data = await get_user_data(chat_id) 
-    
-    made_changes_schema = False
-    temp_data_check = bot_data.copy()
-    for key, default_value in DEFAULT_BOT_DATA.items():
-        if key not in temp_data_check:
-            temp_data_check[key] = copy.deepcopy(default_value); made_changes_schema = True
-    keys_to_remove = [k for k in temp_data_check if k not in DEFAULT_BOT_DATA]
-    if keys_to_remove:
-        for k_rem in keys_to_remove: del temp_data_check[k_rem]; made_changes_schema = True
-
-    if made_changes_schema:
-        bot_data = temp_data_check
-        await save_user_data(chat_id, phone_number=_phone, session_string=_session, bot_data=bot_data)
-        _phone, _session, bot_data = await get_user_data(chat_id) 
 
     bot_data_update = {'awaiting_input_type': None, 'current_page_context': {}, 'admin_message_to_edit_id': None} 
 
@@ -721,6 +2485,7 @@ async def start(event):
         else: await event.respond(prompt_text, buttons=prompt_buttons)
 
 @bot.on(events.NewMessage(func=lambda e: e.contact))
+@flush_user_writes_after_event
 async def handle_contact(event):
     chat_id = event.chat_id
     _phone, _session, bot_data = await get_user_data(chat_id)
@@ -729,6 +2494,7 @@ async def handle_contact(event):
         await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': None})
         phone_number_admin = event.contact.phone_number
         if not phone_number_admin.startswith('+'): phone_number_admin = '+' + phone_number_admin
+        if _phone and _phone != phone_number_admin: await forget_resolved_peers(chat_id); await forget_media_handles(chat_id)
         await update_user_data_db(chat_id, phone_number=phone_number_admin)
         await login_user(event) 
         text_adm, btns_adm = admin_main_menu()
@@ -739,12 +2505,14 @@ async def handle_contact(event):
         await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': None})
         phone_number_user = event.contact.phone_number
         if not phone_number_user.startswith('+'): phone_number_user = '+' + phone_number_user
+        if _phone and _phone != phone_number_user: await forget_resolved_peers(chat_id); await forget_media_handles(chat_id)
         await update_user_data_db(chat_id, phone_number=phone_number_user)
         await login_user(event) 
     else:
         await event.respond("Silakan aktifkan kunci dahulu sebelum membagikan kontak, atau pastikan Anda mengklik tombol yang benar.")
 
 @bot.on(events.NewMessage())
+@flush_user_writes_after_event
 async def handle_any_message(event):
     chat_id = event.chat_id
     text = event.message.text.strip() if event.message.text else ""
@@ -757,40 +2525,22 @@ async def handle_any_message(event):
 
     if awaiting_type == 'enter_key_input' and text:
         try:
-            async with db_pool.acquire() as conn:
-                key_record = await conn.fetchrow("SELECT * FROM access_keys WHERE key_value = $1", text)
+            failure_reason = lookup_invalid_key(text)
+            if failure_reason:
+                await event.respond(KEY_CLAIM_FAILURE_MESSAGES[failure_reason]); return
+
+            claim_ts = int(time.time())
+            key_record, miss_record = await storage.claim_access_key(text, chat_id, claim_ts)
             
             if not key_record:
-                await event.respond("Kunci tidak ditemukan. Silakan periksa kembali atau beli kunci baru."); return
-            
-            if key_record['is_claimed'] and key_record['claimed_by_chat_id'] != chat_id :
-                await event.respond("Kunci ini telah digunakan oleh pengguna lain."); return
-            
-            key_generation_ts = key_record['generation_timestamp']
-            key_duration_s = key_record['duration_seconds']
-            key_inherent_expiry_ts = key_generation_ts + key_duration_s
-            
-            if time.time() > key_inherent_expiry_ts:
-                await event.respond("Kunci ini telah kedaluwarsa (belum pernah diklaim tapi waktunya habis)."); return
+                if not miss_record: failure_reason = 'not_found'
+                elif miss_record['is_claimed'] and miss_record['claimed_by_chat_id'] != chat_id: failure_reason = 'claimed'
+                else: failure_reason = 'expired'
+                if failure_reason != 'claimed': remember_invalid_key(text, failure_reason)
+                await event.respond(KEY_CLAIM_FAILURE_MESSAGES[failure_reason]); return
 
-            claim_ts = int(time.time())
             user_key_expiry_ts = claim_ts + key_record['duration_seconds']
-
-            async with db_pool.acquire() as conn:
-                async with conn.transaction():
-                    locked_key_record = await conn.fetchrow("SELECT * FROM access_keys WHERE key_value = $1 FOR UPDATE", text)
-                    if not locked_key_record or locked_key_record['is_claimed'] and locked_key_record['claimed_by_chat_id'] != chat_id :
-                        await event.respond("Kunci ini baru saja digunakan atau tidak valid lagi. Coba kunci lain.")
-                        return 
-
-                    await conn.execute(
-                        """
-                        UPDATE access_keys 
-                        SET is_claimed = TRUE, claimed_by_chat_id = $1, claim_timestamp = $2
-                        WHERE key_value = $3
-                        """, 
-                        chat_id, claim_ts, text
-                    )
+            invalidate_access_key_counts()
 
             user_data_update = {
                 'active_key_value': text,
@@ -810,6 +2560,8 @@ async def handle_any_message(event):
                 user_data_update['watermark_enabled'] = bot_data.get('watermark_enabled', False)
 
             await update_user_data_db(chat_id, bot_data_update=user_data_update)
+            invalidate_active_user_count()
+            schedule_key_expiry(chat_id, user_key_expiry_ts)
             await event.respond(f"Kunci {key_record['key_type'].upper()} berhasil diaktifkan! 🎉\nKadaluwarsa pada: {datetime.datetime.fromtimestamp(user_key_expiry_ts).strftime('%Y-%m-%d %H:%M')}\n\nSilakan bagikan kontak Anda untuk melanjutkan.",
                                 buttons=[Button.request_phone("✔️ Bagikan Kontak untuk Login Userbot")])
         except Exception as e_key_claim:
@@ -832,12 +2584,10 @@ async def handle_any_message(event):
                 await user_client_code.sign_in(phone=phone_to_sign_in, code=code_input)
                 session_new_code = user_client_code.session.save()
                 
+                login_patch = {'is_registered': True, 'session_owner': INSTANCE_NAME, 'awaiting_input_type': None, 'awaiting_2fa': False}
+                await update_user_data_db(chat_id, session_string=session_new_code, bot_data_update=login_patch)
                 bot_data_update_login = bot_data_code.copy()
-                bot_data_update_login['is_registered'] = True
-                bot_data_update_login['awaiting_input_type'] = None
-                bot_data_update_login['awaiting_2fa'] = False
-                
-                await update_user_data_db(chat_id, session_string=session_new_code, bot_data_update=bot_data_update_login)
+                bot_data_update_login.update(login_patch)
                 status_text_login, buttons_login = main_menu(bot_data_update_login)
                 await event.respond(f"Login userbot berhasil!\n\n{status_text_login}", buttons=buttons_login)
                 await manage_forward_copy_task(chat_id, bot_data_update_login)
@@ -858,11 +2608,10 @@ async def handle_any_message(event):
                 session_2fa_new = user_client_2fa.session.save()
                 _ph_2fa, _ss_2fa, bot_data_2fa = await get_user_data(chat_id)
 
+                login_patch = {'is_registered': True, 'session_owner': INSTANCE_NAME, 'awaiting_input_type': None, 'awaiting_2fa': False}
+                await update_user_data_db(chat_id, session_string=session_2fa_new, bot_data_update=login_patch)
                 bot_data_update_2fa = bot_data_2fa.copy()
-                bot_data_update_2fa['is_registered'] = True
-                bot_data_update_2fa['awaiting_input_type'] = None
-                bot_data_update_2fa['awaiting_2fa'] = False
-                await update_user_data_db(chat_id, session_string=session_2fa_new, bot_data_update=bot_data_update_2fa)
+                bot_data_update_2fa.update(login_patch)
                 status_text_2fa, buttons_2fa = main_menu(bot_data_update_2fa)
                 await event.respond(f"Login userbot 2FA berhasil!\n\n{status_text_2fa}", buttons=buttons_2fa)
                 await manage_forward_copy_task(chat_id, bot_data_update_2fa)
@@ -890,10 +2639,8 @@ async def handle_any_message(event):
 
         # Penanganan untuk link
         elif awaiting_type == 'awaiting_single_link' and text:
-            _p, _s, bd_link = await get_user_data(chat_id)
-            fwd_sets = bd_link.get('forward_sets', [])
-            fwd_sets.append({'type': 'single', 'link': text, 'id': str(uuid4())})
-            await update_user_data_db(chat_id, bot_data_update={'forward_sets': fwd_sets, 'awaiting_input_type': None})
+            await add_list_items(chat_id, 'forward_sets', [{'type': 'single', 'link': text, 'id': str(uuid4())}])
+            await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': None})
             await event.respond("Link single berhasil disimpan!")
             return
 
@@ -908,7 +2655,7 @@ async def handle_any_message(event):
             if not temp_data.get('link1'):
                 await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': None, 'temp_dual_link_data': {}})
                 await event.respond("Error: Link pertama tidak ditemukan. Ulangi proses."); return
-            temp_data['delay'] = int(text)
+            temp_data = {**temp_data, 'delay': int(text)}
             await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': 'awaiting_dual_link_2', 'temp_dual_link_data': temp_data})
             await event.respond("Delay disimpan. Sekarang kirim link kedua:")
             return
@@ -918,14 +2665,10 @@ async def handle_any_message(event):
             if not temp_data.get('link1') or 'delay' not in temp_data:
                 await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': None, 'temp_dual_link_data': {}})
                 await event.respond("Error: Data link atau delay tidak lengkap. Ulangi proses."); return
-            temp_data['link2'] = text
-            temp_data['type'] = 'dual'
-            temp_data['id'] = str(uuid4())
+            temp_data = {**temp_data, 'link2': text, 'type': 'dual', 'id': str(uuid4())}
             
-            _p, _s, bd_link2 = await get_user_data(chat_id)
-            fwd_sets = bd_link2.get('forward_sets', [])
-            fwd_sets.append(temp_data)
-            await update_user_data_db(chat_id, bot_data_update={'forward_sets': fwd_sets, 'awaiting_input_type': None, 'temp_dual_link_data': {}})
+            await add_list_items(chat_id, 'forward_sets', [temp_data])
+            await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': None, 'temp_dual_link_data': {}})
             await event.respond("Set link ganda (dual link) berhasil disimpan!")
             return
 
@@ -946,8 +2689,6 @@ async def handle_any_message(event):
                 return
 
             elif awaiting_type == 'save_text_media':
-                _p, _s, bd_stm = await get_user_data(chat_id)
-                saved_texts_list = bd_stm.get('saved_texts', [])
                 current_text_to_save = event.message.text 
                 current_media_id_to_save = None; current_media_type_to_save = None
                 if event.message.media:
@@ -955,15 +2696,12 @@ async def handle_any_message(event):
                     elif hasattr(event.message.media, 'document'): current_media_id_to_save = event.message.media.document.id; current_media_type_to_save = 'document'
                     elif hasattr(event.message.media, 'video'): current_media_id_to_save = event.message.media.video.id; current_media_type_to_save = 'video'
                 
-                is_duplicate_stm = any(
-                    item.get('text') == current_text_to_save and item.get('media_file_id') == current_media_id_to_save 
-                    for item in saved_texts_list
-                )
                 if not current_text_to_save and not event.message.media: await event.respond("Tidak ada yang disimpan."); return
+                is_duplicate_stm = await saved_text_exists(chat_id, current_text_to_save, current_media_id_to_save)
                 if not is_duplicate_stm:
-                    new_item_stm = {'id': str(uuid4()), 'text': current_text_to_save, 'entities': [entity_to_dict(e) for e in event.message.entities or []], 'media_file_id': current_media_id_to_save, 'media_file_type': current_media_type_to_save, 'timestamp': time.time()}
-                    saved_texts_list.append(new_item_stm)
-                    await update_user_data_db(chat_id, bot_data_update={'saved_texts': saved_texts_list, 'awaiting_input_type': None})
+                    new_item_stm = {'id': str(uuid4()), 'text': current_text_to_save, 'entities': [entity_to_dict(e) for e in event.message.entities or []], 'media_file_id': current_media_id_to_save, 'media_file_type': current_media_type_to_save, 'media_source': {'chat_id': chat_id, 'message_id': event.message.id} if current_media_id_to_save else None, 'timestamp': time.time()}
+                    await add_list_items(chat_id, 'saved_texts', [new_item_stm])
+                    await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': None})
                     _p2, _s2, bd_menu = await get_user_data(chat_id); st_menu, _ = main_menu(bd_menu);
                     btns_confirm = [[Button.inline("Tes Kirim ke Disimpan", f"send_to_me_{new_item_stm['id']}")], [Button.inline("Kembali", b"main_menu")]]
                     
@@ -1005,36 +2743,29 @@ async def handle_any_message(event):
                     except Exception as e_join: 
                         await event.respond(f"Gagal bergabung melalui link: {e_join}"); return
                 
-                is_valid_grp, resolved_entity_or_error = await validate_entity(user_client_grp, entity_to_process, chat_id, group_only=True)
+                is_valid_grp, resolved_entity_or_error = await validate_entity(user_client_grp, entity_to_process, chat_id, group_only=True, retry_failed=True)
                 
                 if is_valid_grp and resolved_entity_or_error: 
                     resolved_entity_obj_final = resolved_entity_or_error 
-                    _p, _s, bd_grp = await get_user_data(chat_id); target_groups_list = bd_grp.get('target_groups', [])
-                    id_to_store_grp = str(get_peer_id(resolved_entity_obj_final)) 
+                    id_to_store_grp = str(resolved_entity_obj_final.peer_id) 
                     
-                    is_duplicate_strong = False
-                    for existing_target_str in target_groups_list:
-                        try:
-                            existing_peer_id_int = int(existing_target_str) 
-                            if existing_peer_id_int == get_peer_id(resolved_entity_obj_final): 
-                                is_duplicate_strong = True; break
-                        except ValueError: 
-                             if existing_target_str == id_to_store_grp or (hasattr(resolved_entity_obj_final, 'username') and existing_target_str == f"@{resolved_entity_obj_final.username}"):
-                                is_duplicate_strong = True; break
-                        except Exception: continue
+                    username_grp = resolved_entity_obj_final.username
+                    target_index_grp = await get_target_index(chat_id)
+                    is_duplicate_strong = id_to_store_grp in target_index_grp or (bool(username_grp) and f"@{username_grp}" in target_index_grp)
+                    if not is_duplicate_strong:
+                        is_duplicate_strong = await add_list_items(chat_id, 'target_groups', [id_to_store_grp]) == 0
                     
                     if not is_duplicate_strong:
-                        target_groups_list.append(id_to_store_grp) 
-                        await update_user_data_db(chat_id, bot_data_update={'target_groups': target_groups_list, 'awaiting_input_type': None})
+                        await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': None})
                         _p2, _s2, bd_menu = await get_user_data(chat_id); st_menu, btns_menu = main_menu(bd_menu);
                         
-                        response_text_add_group = f"Grup '{getattr(resolved_entity_obj_final, 'title', id_to_store_grp)}' (ID: {id_to_store_grp}) ditambahkan!\n\n{st_menu}"
+                        response_text_add_group = f"Grup '{resolved_entity_obj_final.title or id_to_store_grp}' (ID: {id_to_store_grp}) ditambahkan!\n\n{st_menu}"
                         try:
                             if msg_id_add_group_flow: await bot.edit_message(chat_id, msg_id_add_group_flow, response_text_add_group, buttons=btns_menu)
                             else: await event.respond(response_text_add_group, buttons=btns_menu)
                         except Exception as e_edit_add_group: logger.error(f"Gagal edit/respond add_group: {e_edit_add_group}"); await event.respond(response_text_add_group, buttons=btns_menu)
                         await update_user_data_db(chat_id, bot_data_update={'admin_message_to_edit_id': None})
-                    else: await event.respond(f"Grup '{getattr(resolved_entity_obj_final, 'title', id_to_store_grp)}' (ID: {id_to_store_grp}) sudah ada.")
+                    else: await event.respond(f"Grup '{resolved_entity_obj_final.title or id_to_store_grp}' (ID: {id_to_store_grp}) sudah ada.")
                 else: 
                     await event.respond(f"Entitas {group_identifier_input} tidak valid: {resolved_entity_or_error}"); return
                 
@@ -1057,26 +2788,15 @@ async def handle_any_message(event):
     
     if is_admin(chat_id):
         if awaiting_type == 'admin_broadcast_message' and text:
-            await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': None})
-            await event.respond("Memulai proses broadcast...")
-            sent_count, failed_count = 0, 0
-            async with db_pool.acquire() as conn_bc:
-                all_users_for_bc = await conn_bc.fetch("SELECT chat_id, bot_data FROM users") 
-            for user_row in all_users_for_bc:
-                target_user_id = user_row['chat_id']
-                target_bot_data = json.loads(user_row['bot_data']) if user_row['bot_data'] else {}
-                if target_bot_data.get('has_valid_key') and (not target_bot_data.get('key_expiry_timestamp') or time.time() < target_bot_data.get('key_expiry_timestamp', 0)):
-                    try: await bot.send_message(target_user_id, text); sent_count += 1; await asyncio.sleep(0.1)
-                    except Exception: failed_count +=1
-            
+            await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': None, 'admin_message_to_edit_id': None})
             msg_id_bc = bot_data.get('admin_message_to_edit_id')
-            response_text_bc = f"Broadcast selesai. Terkirim: {sent_count}, Gagal: {failed_count}."
-            _t_bc, btns_bc_panel = admin_main_menu()
-            try:
-                if msg_id_bc: await bot.edit_message(chat_id, msg_id_bc, response_text_bc, buttons=btns_bc_panel) 
-                else: await event.respond(response_text_bc, buttons=btns_bc_panel)
-            except Exception as e_edit_bc: logger.error(f"Gagal edit/respond broadcast: {e_edit_bc}"); await event.respond(response_text_bc, buttons=btns_bc_panel)
-            await update_user_data_db(chat_id, bot_data_update={'admin_message_to_edit_id': None})
+            try: job_id_bc, recipient_count_bc = await create_broadcast_job(chat_id, text, msg_id_bc)
+            except Exception as e_create_bc:
+                logger.error(f"Gagal membuat job broadcast: {e_create_bc}", exc_info=True)
+                _t_bc, btns_bc_panel = admin_main_menu()
+                await event.respond("Gagal memulai broadcast.", buttons=btns_bc_panel); return
+            if not msg_id_bc: await event.respond(f"Memulai broadcast ke {recipient_count_bc} pengguna...")
+            start_broadcast_job(job_id_bc)
             return
         
         elif awaiting_type == 'admin_generate_key_duration' and text:
@@ -1098,14 +2818,8 @@ async def handle_any_message(event):
             elif key_type_to_gen == 'vip':
                 new_key_val = generate_unique_key("VIP-")
                 generation_ts = int(time.time())
-                original_expiry = generation_ts + duration_s 
-                
-                async with db_pool.acquire() as conn:
-                    await conn.execute(
-                        """INSERT INTO access_keys (key_value, key_type, duration_seconds, generated_by_admin_id, generation_timestamp, original_expiry_timestamp)
-                           VALUES ($1, 'vip', $2, $3, $4, $5)""",
-                        new_key_val, duration_s, chat_id, generation_ts, original_expiry
-                    )
+                await storage.insert_access_key(new_key_val, 'vip', duration_s, chat_id, generation_ts)
+                invalidate_access_key_counts()
                 await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': None, 'admin_temp_key_type': None, 'admin_temp_key_duration_s': None, 'admin_message_to_edit_id': None})
                 _t_km_vip,btns_km_vip = admin_manage_keys_menu() 
                 msg_content_vip = f"Kunci VIP baru digenerate:\n`{new_key_val}`\nDurasi: {text.strip()}" 
@@ -1128,14 +2842,8 @@ async def handle_any_message(event):
 
             new_key_val = generate_unique_key("BSC-")
             generation_ts = int(time.time())
-            original_expiry = generation_ts + key_duration_s
-
-            async with db_pool.acquire() as conn:
-                await conn.execute(
-                    """INSERT INTO access_keys (key_value, key_type, duration_seconds, generated_by_admin_id, generation_timestamp, original_expiry_timestamp, assigned_watermark_text)
-                       VALUES ($1, 'basic', $2, $3, $4, $5, $6)""",
-                    new_key_val, key_duration_s, chat_id, generation_ts, original_expiry, assigned_wm_text
-                )
+            await storage.insert_access_key(new_key_val, 'basic', key_duration_s, chat_id, generation_ts, assigned_wm_text)
+            invalidate_access_key_counts()
             await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': None, 'admin_temp_key_type': None, 'admin_temp_key_duration_s': None, 'admin_message_to_edit_id': None})
             wm_info = f"Watermark: {assigned_wm_text}" if assigned_wm_text else "Watermark: (Default Global)"
             dur_text = f"{key_duration_s // 86400}d" if key_duration_s % 86400 == 0 and key_duration_s >= 86400 else f"{key_duration_s // 3600}h" if key_duration_s % 3600 == 0 and key_duration_s >= 3600 else f"{key_duration_s // 60}m"
@@ -1147,51 +2855,81 @@ async def handle_any_message(event):
             else: await event.respond(msg_content_basic, buttons=btns_km_basic, parse_mode='md')
             return
         
+        elif awaiting_type == 'admin_bulk_key_spec' and text:
+            key_type_to_gen = bot_data.get('admin_temp_key_type')
+            await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': None, 'admin_temp_key_type': None, 'admin_message_to_edit_id': None})
+            if key_type_to_gen not in ('basic', 'vip'):
+                await event.respond("Error: Tipe kunci tidak ditemukan. Ulangi dari menu admin."); return
+
+            spec_parts = text.strip().split(maxsplit=2)
+            key_count = int(spec_parts[0]) if spec_parts and spec_parts[0].isdigit() else 0
+            duration_s = parse_duration_to_seconds(spec_parts[1]) if len(spec_parts) > 1 else None
+            if not 0 < key_count <= BULK_KEY_MAX_COUNT or duration_s is None:
+                await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': 'admin_bulk_key_spec', 'admin_temp_key_type': key_type_to_gen, 'admin_message_to_edit_id': admin_msg_id_to_edit})
+                await event.respond(f"Format tidak valid. Kirim: <jumlah 1-{BULK_KEY_MAX_COUNT}> <durasi>{' [watermark]' if key_type_to_gen == 'basic' else ''} (contoh: 100 7d). Coba lagi:"); return
+            assigned_wm_text = spec_parts[2].strip() if key_type_to_gen == 'basic' and len(spec_parts) > 2 else None
+
+            _t_km_bulk, btns_km_bulk = admin_manage_keys_menu()
+            try: batch_id, new_keys = await generate_key_batch(chat_id, key_type_to_gen, key_count, duration_s, assigned_wm_text)
+            except Exception as e_bulk:
+                logger.error(f"Gagal generate kunci massal untuk admin {chat_id}: {e_bulk}", exc_info=True)
+                await event.respond("Gagal membuat kunci massal. Coba lagi nanti.", buttons=btns_km_bulk); return
+
+            summary_bulk = f"Batch `{batch_id}`: {len(new_keys)} kunci {key_type_to_gen.upper()} digenerate, durasi {spec_parts[1]}."
+            if assigned_wm_text: summary_bulk += f"\nWatermark: {assigned_wm_text}"
+            await send_key_batch_file(chat_id, batch_id, new_keys, summary_bulk)
+            if admin_msg_id_to_edit:
+                try: await bot.edit_message(chat_id, admin_msg_id_to_edit, f"{summary_bulk}\n\n{_t_km_bulk}", buttons=btns_km_bulk, parse_mode='md')
+                except Exception as e_edit: logger.error(f"Gagal edit pesan admin kunci massal: {e_edit}"); await event.respond(_t_km_bulk, buttons=btns_km_bulk)
+            else: await event.respond(_t_km_bulk, buttons=btns_km_bulk)
+            return
+
         elif awaiting_type == 'admin_revoke_key_value_input' and text:
             key_to_revoke = text.strip()
             msg_to_edit_revoke = bot_data.get('admin_message_to_edit_id')
             try:
-                async with db_pool.acquire() as conn:
-                    key_record = await conn.fetchrow("SELECT * FROM access_keys WHERE key_value = $1", key_to_revoke)
-                    _t_km_revoke,btns_km_revoke = admin_manage_keys_menu() 
+                key_record = await storage.fetch_access_key(key_to_revoke)
+                _t_km_revoke,btns_km_revoke = admin_manage_keys_menu() 
 
-                    if not key_record:
-                        err_msg_revoke = f"Kunci `{key_to_revoke}` tidak ditemukan."
-                        if msg_to_edit_revoke: await bot.edit_message(chat_id, msg_to_edit_revoke, err_msg_revoke, buttons=btns_km_revoke, parse_mode='md')
-                        else: await event.respond(err_msg_revoke, buttons=btns_km_revoke, parse_mode='md')
-                        return
+                if not key_record:
+                    err_msg_revoke = f"Kunci `{key_to_revoke}` tidak ditemukan."
+                    if msg_to_edit_revoke: await bot.edit_message(chat_id, msg_to_edit_revoke, err_msg_revoke, buttons=btns_km_revoke, parse_mode='md')
+                    else: await event.respond(err_msg_revoke, buttons=btns_km_revoke, parse_mode='md')
+                    return
 
-                    claimed_by = key_record['claimed_by_chat_id']
+                claimed_by = key_record['claimed_by_chat_id']
+                
+                await storage.delete_access_key(key_to_revoke)
+                invalidate_access_key_counts()
+                
+                if claimed_by:
+                    _uphone, _usession, user_bot_data_revoke = await get_user_data(claimed_by)
+                    user_bot_data_revoke_update = {
+                        'active_key_value': None, 'active_key_type': None,
+                        'key_expiry_timestamp': None, 'has_valid_key': False,
+                        'assigned_basic_watermark_text': None,
+                        'is_registered': False, 
+                        'session_string': None
+                    }
+                    await update_user_data_db(claimed_by, bot_data_update=user_bot_data_revoke_update)
+                    invalidate_active_user_count()
                     
-                    await conn.execute("DELETE FROM access_keys WHERE key_value = $1", key_to_revoke)
+                    client_to_logout_revoked = user_clients.pop(claimed_by, None)
+                    if client_to_logout_revoked and client_to_logout_revoked.is_connected():
+                        try: await client_to_logout_revoked.disconnect()
+                        except Exception as e_disc_revoke: logger.error(f"Gagal disconnect klien {claimed_by} saat cabut kunci: {e_disc_revoke}")
                     
-                    if claimed_by:
-                        _uphone, _usession, user_bot_data_revoke = await get_user_data(claimed_by)
-                        user_bot_data_revoke_update = {
-                            'active_key_value': None, 'active_key_type': None,
-                            'key_expiry_timestamp': None, 'has_valid_key': False,
-                            'assigned_basic_watermark_text': None,
-                            'is_registered': False, 
-                            'session_string': None
-                        }
-                        await update_user_data_db(claimed_by, bot_data_update=user_bot_data_revoke_update)
-                        
-                        client_to_logout_revoked = user_clients.pop(claimed_by, None)
-                        if client_to_logout_revoked and client_to_logout_revoked.is_connected():
-                            try: await client_to_logout_revoked.disconnect()
-                            except Exception as e_disc_revoke: logger.error(f"Gagal disconnect klien {claimed_by} saat cabut kunci: {e_disc_revoke}")
-                        
-                        task_to_cancel_revoked = user_tasks.pop(claimed_by, None)
-                        if task_to_cancel_revoked and not task_to_cancel_revoked.done():
-                            task_to_cancel_revoked.cancel()
-                        
-                        try: await bot.send_message(claimed_by, f"Kunci akses Anda (`{key_to_revoke}`) telah dicabut oleh Admin. Akses Anda ke fitur bot telah dinonaktifkan. Silakan hubungi admin untuk informasi lebih lanjut atau untuk mendapatkan kunci baru.")
-                        except Exception as e_notify_revoke: logger.warning(f"Gagal mengirim notifikasi cabut kunci ke {claimed_by}: {e_notify_revoke}")
+                    task_to_cancel_revoked = user_tasks.pop(claimed_by, None)
+                    if task_to_cancel_revoked and not task_to_cancel_revoked.done():
+                        task_to_cancel_revoked.cancel()
                     
-                    await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': None, 'admin_message_to_edit_id': None})
-                    success_msg_revoke = f"Kunci `{key_to_revoke}` berhasil dicabut/dihapus."
-                    if msg_to_edit_revoke: await bot.edit_message(chat_id, msg_to_edit_revoke, success_msg_revoke, buttons=btns_km_revoke, parse_mode='md')
-                    else: await event.respond(success_msg_revoke, buttons=btns_km_revoke, parse_mode='md')
+                    try: await bot.send_message(claimed_by, f"Kunci akses Anda (`{key_to_revoke}`) telah dicabut oleh Admin. Akses Anda ke fitur bot telah dinonaktifkan. Silakan hubungi admin untuk informasi lebih lanjut atau untuk mendapatkan kunci baru.")
+                    except Exception as e_notify_revoke: logger.warning(f"Gagal mengirim notifikasi cabut kunci ke {claimed_by}: {e_notify_revoke}")
+                
+                await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': None, 'admin_message_to_edit_id': None})
+                success_msg_revoke = f"Kunci `{key_to_revoke}` berhasil dicabut/dihapus."
+                if msg_to_edit_revoke: await bot.edit_message(chat_id, msg_to_edit_revoke, success_msg_revoke, buttons=btns_km_revoke, parse_mode='md')
+                else: await event.respond(success_msg_revoke, buttons=btns_km_revoke, parse_mode='md')
 
             except Exception as e_revoke:
                 logger.error(f"Error saat mencabut kunci {key_to_revoke}: {e_revoke}", exc_info=True)
@@ -1204,6 +2942,7 @@ async def handle_any_message(event):
             return
 
 @bot.on(events.CallbackQuery)
+@flush_user_writes_after_event
 async def callback(event):
     chat_id = event.chat_id
     data = event.data.decode()
@@ -1260,7 +2999,7 @@ async def callback(event):
             return
 
         elif data == "forward_on":
-            if not bot_data_cb.get('forward_sets'): await event.answer("Tidak ada link forward yang disimpan!", alert=True); return
+            if not await has_list_items(chat_id, 'forward_sets'): await event.answer("Tidak ada link forward yang disimpan!", alert=True); return
             await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': 'awaiting_forward_duration'})
             await event.edit("Masukkan durasi untuk mode Forward (contoh: 1h, 30m, 2d). Kirim 'skip' atau 'selamanya' untuk berjalan terus.", buttons=[[Button.inline("Batal", "forward_copy_menu")]])
             return
@@ -1282,7 +3021,7 @@ async def callback(event):
                 if not await client_for_copy_on.connect(): await event.answer("Gagal menghubungkan userbot admin!", alert=True); return
                 user_clients[chat_id] = client_for_copy_on
             elif not client_for_copy_on : await event.answer("Klien userbot tidak aktif!", alert=True); return
-            if not bot_data_cb.get('saved_texts') or not bot_data_cb.get('target_groups'): await event.answer("Simpan teks/media dan grup target dahulu!", alert=True); return
+            if not await has_list_items(chat_id, 'saved_texts') or not await has_list_items(chat_id, 'target_groups'): await event.answer("Simpan teks/media dan grup target dahulu!", alert=True); return
             
             await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': 'awaiting_copy_duration'})
             await event.edit("Masukkan durasi untuk mode Copy (contoh: 1h, 30m, 2d). Kirim 'skip' atau 'selamanya' untuk berjalan terus.", buttons=[[Button.inline("Batal", "forward_copy_menu")]])
@@ -1355,16 +3094,13 @@ async def callback(event):
             
             await event.answer("Memproses..."); 
             user_client_aamg = client_for_aamg
-            current_targets = bot_data_cb.get('target_groups',[]); added=0;
-            async for d in user_client_aamg.iter_dialogs():
-                if d.is_group:
-                    try: 
-                        entity_aamg = await user_client_aamg.get_entity(d.id)
-                        eid = str(get_peer_id(entity_aamg)) 
-                    except: continue 
-                    if eid not in current_targets: current_targets.append(eid); added+=1
-            if added > 0: await update_user_data_db(chat_id, bot_data_update={'target_groups': current_targets})
-            try: await event.edit(f"{added} grup baru ditambahkan. Total: {len(current_targets)}", buttons=[[Button.inline("Kembali",b"main_menu")]])
+            snapshot_aamg = await get_dialog_snapshot(chat_id, user_client_aamg, max_age=0)
+            dialog_group_ids = [str(peer_id) for peer_id, (resolved_peer, _can_send) in snapshot_aamg.entries.items() if resolved_peer.is_group]
+            target_index_aamg = await get_target_index(chat_id)
+            new_group_ids = list(dict.fromkeys(eid for eid in dialog_group_ids if eid not in target_index_aamg))
+            added = await add_list_items(chat_id, 'target_groups', new_group_ids)
+            total_targets = len(await get_target_index(chat_id))
+            try: await event.edit(f"{added} grup baru ditambahkan. Total: {total_targets}", buttons=[[Button.inline("Kembali",b"main_menu")]])
             except MessageNotModifiedError:pass; await event.answer()
             except Exception as e: logger.error(f"Error add_all_my_groups edit: {e}")
             finally: 
@@ -1374,7 +3110,7 @@ async def callback(event):
         elif data == "delete_group": 
             await display_paginated_list(event, chat_id, bot_data_cb, 'target_groups', 0, 'main_menu', edit_mode=True); return
         elif data == "delete_all_target_groups": 
-            await update_user_data_db(chat_id, bot_data_update={'target_groups':[]}); await event.answer("Semua grup target dihapus.")
+            await clear_list_items(chat_id, 'target_groups'); await event.answer("Semua grup target dihapus.")
             _p, _s, bd_upd = await get_user_data(chat_id); st,btns = main_menu(bd_upd); 
             try: await event.edit(f"Menu Utama\n\n{st}", buttons=btns)
             except MessageNotModifiedError:pass; await event.answer()
@@ -1383,12 +3119,14 @@ async def callback(event):
         
         elif data.startswith("delete:"): 
             try:
-                _, list_type, _, item_idx_str = data.split(':'); item_idx = int(item_idx_str)
-                items = bot_data_cb.get(list_type, [])
-                if 0 <= item_idx < len(items): del items[item_idx]; await update_user_data_db(chat_id, bot_data_update={list_type: items}); await event.answer("Item dihapus.")
-                else: await event.answer("Indeks tidak valid.")
-                _p, _s, bd_upd = await get_user_data(chat_id) 
-                await display_paginated_list(event, chat_id, bd_upd, list_type, bot_data_cb.get('current_page_context',{}).get('page',0), 'main_menu', edit_mode=True)
+                _, list_type, ref_kind, item_ref = data.split(':', 3)
+                if list_type not in USER_LIST_TABLES: await event.answer("Daftar tidak valid."); return
+                if ref_kind == 'idx':
+                    page_rows = await fetch_list_page(chat_id, list_type, int(item_ref), 1)
+                    item_ref = page_rows[0][0] if page_rows else None
+                if item_ref is not None and await delete_list_items(chat_id, list_type, [item_ref]): await event.answer("Item dihapus.")
+                else: await event.answer("Item tidak ditemukan.")
+                await display_paginated_list(event, chat_id, bot_data_cb, list_type, bot_data_cb.get('current_page_context',{}).get('page',0), 'main_menu', edit_mode=True)
             except Exception as e_del: logger.error(f"Error delete item: {e_del}"); await event.answer("Gagal hapus.")
             return
 
@@ -1401,7 +3139,7 @@ async def callback(event):
         
         elif data.startswith("send_to_me_"): 
             item_id_stm = data.replace("send_to_me_", "")
-            saved_item = next((i for i in bot_data_cb.get('saved_texts', []) if i.get('id') == item_id_stm), None)
+            saved_item = await fetch_list_item(chat_id, 'saved_texts', item_id_stm)
             if not saved_item: await event.answer("Item tidak ditemukan."); return
             
             client_to_use_sendme = user_clients.get(chat_id)
@@ -1416,7 +3154,7 @@ async def callback(event):
             try:
                 if media_id_sendme: 
                     try:
-                        await client_to_use_sendme.send_file('me', media_id_sendme, caption=text_sendme, formatting_entities=entities_sendme if entities_sendme else None)
+                        await send_saved_media(client_to_use_sendme, chat_id, 'me', saved_item, text_sendme, formatting_entities=entities_sendme if entities_sendme else None)
                     except TypeError as te: 
                          logger.error(f"TypeError saat send_to_me (media): {te}. Mencoba mengirim teks saja.")
                          if text_sendme: await client_to_use_sendme.send_message('me', f"[Media Gagal Dikirim, Teks Asli]:\n{text_sendme}", formatting_entities=entities_sendme if entities_sendme else None)
@@ -1501,6 +3239,26 @@ async def callback(event):
             except Exception as e: logger.error(f"Error admin_gen_key_vip edit: {e}")
             return
         
+        elif data == "admin_bulk_key_prompt":
+            btns_bulk_type = [[Button.inline("🔑 Basic Key", b"admin_bulk_key_basic")], [Button.inline("👑 VIP Key", b"admin_bulk_key_vip")], [Button.inline("Kembali", b"admin_manage_keys")]]
+            try: await event.edit("Pilih tipe kunci untuk generate massal:", buttons=btns_bulk_type)
+            except MessageNotModifiedError:pass; await event.answer()
+            except Exception as e: logger.error(f"Error admin_bulk_key_prompt edit: {e}")
+            return
+        elif data in ("admin_bulk_key_basic", "admin_bulk_key_vip"):
+            bulk_key_type = 'basic' if data == "admin_bulk_key_basic" else 'vip'
+            await update_user_data_db(chat_id, bot_data_update={'awaiting_input_type': 'admin_bulk_key_spec', 'admin_temp_key_type': bulk_key_type, 'admin_message_to_edit_id': message_id_cb})
+            bulk_prompt = f"Kirim jumlah dan durasi Kunci {bulk_key_type.upper()} (maks {BULK_KEY_MAX_COUNT}), contoh: `100 7d`"
+            if bulk_key_type == 'basic': bulk_prompt += "\nTambahkan teks watermark di belakang bila perlu, contoh: `50 30d Watermark Toko`"
+            try: await event.edit(bulk_prompt, parse_mode='md')
+            except MessageNotModifiedError:pass; await event.answer()
+            except Exception as e: logger.error(f"Error {data} edit: {e}")
+            return
+        elif data == "admin_key_batches":
+            await display_key_batches(event); return
+        elif data.startswith("adm_batch_export:"):
+            await export_key_batch(event, chat_id, data.split(':', 1)[1]); return
+        
         elif data == "admin_list_unclaimed_keys" or data == "admin_list_claimed_keys":
             list_type = "unclaimed" if data == "admin_list_unclaimed_keys" else "claimed"
             page = 0 
@@ -1508,8 +3266,13 @@ async def callback(event):
             return
         elif data.startswith("adm_keys_page:"):
             try:
-                _, list_type, page_str = data.split(':')
-                await display_admin_keys_list(event, chat_id, list_type, int(page_str))
+                keys_page_parts = data.split(':', 5)
+                list_type = keys_page_parts[1]
+                if len(keys_page_parts) == 6:
+                    _, _, page_str, direction_key, gen_ts_cursor, key_value_cursor = keys_page_parts
+                    await display_admin_keys_list(event, chat_id, list_type, int(page_str), (direction_key, int(gen_ts_cursor), key_value_cursor))
+                else:
+                    await display_admin_keys_list(event, chat_id, list_type, 0)
             except Exception as e_pg_key: logger.error(f"Error navigasi halaman kunci admin: {e_pg_key}"); await event.answer("Gagal navigasi.")
             return
         elif data == "admin_revoke_key_input":
@@ -1530,8 +3293,12 @@ async def callback(event):
             return
         elif data.startswith("adm_users_page:"):
             try:
-                _, page_str = data.split(':')
-                await display_active_users_list(event, chat_id, int(page_str))
+                users_page_parts = data.split(':')
+                if len(users_page_parts) == 5:
+                    _, page_str, direction_usr, expiry_cursor, chat_id_cursor = users_page_parts
+                    await display_active_users_list(event, chat_id, int(page_str), (direction_usr, float(expiry_cursor), int(chat_id_cursor)))
+                else:
+                    await display_active_users_list(event, chat_id, 0)
             except Exception as e_pg_usr: logger.error(f"Error navigasi halaman pengguna admin: {e_pg_usr}"); await event.answer("Gagal navigasi.")
             return
 
@@ -1547,13 +3314,16 @@ async def display_paginated_list(event, chat_id, bot_data_param, list_type_key,
             if not await user_client.connect(): user_client = None 
         except: user_client = None
 
+    total_items_dpl = await count_list_items(chat_id, list_type_key)
+    total_pages_dpl = max(1, (total_items_dpl + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE)
+    page = max(0, min(page, total_pages_dpl - 1)) 
+    start_idx_dpl = page * ITEMS_PER_PAGE
     await update_user_data_db(chat_id, bot_data_update={'current_page_context': {'list_type': list_type_key, 'page': page, 'back_menu': back_menu_callback_data}})
-    _ph_dpl, _ss_dpl, bot_data_param = await get_user_data(chat_id) 
-    
-    items_all_dpl = bot_data_param.get(list_type_key, [])
-    display_items_info_dpl = []
 
-    for idx, item_val in enumerate(items_all_dpl):
+    page_rows_dpl = await fetch_list_page(chat_id, list_type_key, start_idx_dpl, ITEMS_PER_PAGE) if total_items_dpl else []
+    current_page_items_info_dpl = []
+
+    for item_id_dpl, item_val in page_rows_dpl:
         display_text_dpl = ""
         if list_type_key == 'saved_texts':
             text_content_dpl = item_val.get('text', ''); media_type_dpl = item_val.get('media_file_type')
@@ -1590,12 +3360,12 @@ async def display_paginated_list(event, chat_id, bot_data_param, list_type_key,
                 display_text_dpl = str(item_val)[:30]+"..." if len(str(item_val)) > 30 else str(item_val)
         else: 
             display_text_dpl = str(item_val)[:30]+"..." if len(str(item_val)) > 30 else str(item_val)
-        display_items_info_dpl.append({'original_item': item_val, 'display_text': display_text_dpl, 'global_idx': idx})
+        current_page_items_info_dpl.append({'original_item': item_val, 'display_text': display_text_dpl, 'item_id': item_id_dpl})
 
     if is_admin(chat_id) and user_client and chat_id not in user_clients and user_client.is_connected(): 
         await user_client.disconnect()
 
-    if not display_items_info_dpl:
+    if not current_page_items_info_dpl:
         empty_message_dpl = "Tidak ada item."
         if list_type_key == 'saved_texts': empty_message_dpl = "Tidak ada teks/media yang disimpan."
         elif list_type_key == 'target_groups': empty_message_dpl = "Tidak ada grup target yang ditambahkan."
@@ -1614,11 +3384,6 @@ async def display_paginated_list(event, chat_id, bot_data_param, list_type_key,
         except Exception as e: logger.error(f"Error menampilkan daftar kosong '{list_type_key}': {e}", exc_info=True); await event.answer("Gagal menampilkan daftar.", alert=True)
         return
 
-    total_items_dpl, total_pages_dpl = len(display_items_info_dpl), (len(display_items_info_dpl) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
-    page = max(0, min(page, total_pages_dpl - 1)) 
-    start_idx_dpl, end_idx_dpl = page * ITEMS_PER_PAGE, min((page + 1) * ITEMS_PER_PAGE, total_items_dpl)
-    current_page_items_info_dpl = display_items_info_dpl[start_idx_dpl:end_idx_dpl]
-    
     buttons_main_rows_dpl = []
     title_display_map = {
         'saved_texts': "Teks/Media Tersimpan",
@@ -1629,10 +3394,13 @@ async def display_paginated_list(event, chat_id, bot_data_param, list_type_key,
 
     list_text_content_dpl = f"Daftar {title_display_dpl} (Halaman {page + 1}/{total_pages_dpl}):\n"
 
-    for item_info_dpl in current_page_items_info_dpl:
-        item_display_text_dpl, global_idx_dpl = item_info_dpl['display_text'], item_info_dpl['global_idx']
-        list_text_content_dpl += f"\n{start_idx_dpl + current_page_items_info_dpl.index(item_info_dpl) + 1}. {item_display_text_dpl}"
-        buttons_main_rows_dpl.append([Button.inline("Hapus", f"delete:{list_type_key}:idx:{global_idx_dpl}".encode())])
+    for position_dpl, item_info_dpl in enumerate(current_page_items_info_dpl, start=start_idx_dpl + 1):
+        item_display_text_dpl, item_id_dpl = item_info_dpl['display_text'], item_info_dpl['item_id']
+        list_text_content_dpl += f"\n{position_dpl}. {item_display_text_dpl}"
+        delete_data_dpl = f"delete:{list_type_key}:id:{item_id_dpl}".encode()
+        # item_id hasil migrasi grup target lama bisa berupa username/link panjang; pakai posisi bila melewati batas Telegram
+        if len(delete_data_dpl) > CALLBACK_DATA_MAX_BYTES: delete_data_dpl = f"delete:{list_type_key}:idx:{position_dpl - 1}".encode()
+        buttons_main_rows_dpl.append([Button.inline("Hapus", delete_data_dpl)])
     
     nav_buttons_row_dpl = []
     if page > 0: nav_buttons_row_dpl.append(Button.inline("<< Sebelumnya", f"page:{list_type_key}:{page-1}:{back_menu_callback_data}".encode()))
@@ -1646,7 +3414,7 @@ async def display_paginated_list(event, chat_id, bot_data_param, list_type_key,
     elif list_type_key == 'forward_sets': final_buttons_assembly_dpl.append([Button.inline("Tambah Link Forward", b"save_link")])
 
 
-    if list_type_key == 'target_groups' and items_all_dpl: final_buttons_assembly_dpl.append([Button.inline("Hapus Semua Grup Target", b"delete_all_target_groups")])
+    if list_type_key == 'target_groups' and total_items_dpl: final_buttons_assembly_dpl.append([Button.inline("Hapus Semua Grup Target", b"delete_all_target_groups")])
     final_buttons_assembly_dpl.append([Button.inline("Kembali", back_menu_callback_data.encode())])
     
     try:
@@ -1657,31 +3425,104 @@ async def display_paginated_list(event, chat_id, bot_data_param, list_type_key,
     except ValueError as ve: logger.error(f"ValueError (tombol terlalu panjang) menampilkan daftar: {ve}", exc_info=True); await event.answer("Error: Data tombol terlalu panjang.", alert=True)
     except Exception as e: logger.error(f"Error tidak terduga saat menampilkan daftar berpaginasi: {e}", exc_info=True); await event.answer("Gagal menampilkan daftar.", alert=True)
 
+# --- Kunci Massal (Batch) ---
+async def generate_key_batch(admin_chat_id, key_type, key_count, duration_s, assigned_wm_text=None):
+    """Generate key_count kunci sekaligus dan simpan dalam satu transaksi (COPY di Postgres)."""
+    batch_id = uuid4().hex[:10].upper()
+    key_prefix = "VIP-" if key_type == 'vip' else "BSC-"
+    new_keys = set()
+    while len(new_keys) < key_count: new_keys.add(generate_unique_key(key_prefix))
+    new_keys = sorted(new_keys)
+    generation_ts = int(time.time())
+    key_records = [(key_value, key_type, duration_s, admin_chat_id, generation_ts, generation_ts + duration_s, assigned_wm_text, batch_id) for key_value in new_keys]
+    await storage.insert_key_batch((batch_id, key_type, key_count, duration_s, admin_chat_id, generation_ts, assigned_wm_text), key_records)
+    invalidate_access_key_counts()
+    logger.info(f"Admin {admin_chat_id} membuat batch {batch_id}: {key_count} kunci {key_type}.")
+    return batch_id, new_keys
+
+async def send_key_batch_file(chat_id, batch_id, key_values, caption):
+    batch_file = io.BytesIO("\n".join(key_values).encode('utf-8'))
+    batch_file.name = f"keys_{batch_id}.txt"
+    await bot.send_file(chat_id, batch_file, caption=caption, parse_mode='md', force_document=True)
+
+async def display_key_batches(event):
+    try:
+        batch_rows = await storage.fetch_key_batch_stats(KEY_BATCHES_PER_PAGE)
+    except Exception as e_batches:
+        logger.error(f"Gagal mendapatkan statistik batch kunci: {e_batches}")
+        _t, btns_km = admin_manage_keys_menu(); await event.edit(f"Gagal mendapatkan statistik batch.\n{_t}", buttons=btns_km); return
+
+    if not batch_rows:
+        _t, btns_km = admin_manage_keys_menu(); await event.edit(f"Belum ada batch kunci.\n{_t}", buttons=btns_km); return
+
+    text_content = f"Statistik {len(batch_rows)} Batch Kunci Terakhir:\n"
+    buttons = []
+    for batch_row in batch_rows:
+        gen_time = datetime.datetime.fromtimestamp(batch_row['generation_timestamp']).strftime('%y-%m-%d %H:%M')
+        dur_s = batch_row['duration_seconds']
+        dur_text = f"{dur_s // 86400}d" if dur_s % 86400 == 0 and dur_s >= 86400 else f"{dur_s // 3600}h" if dur_s % 3600 == 0 and dur_s >=3600 else f"{dur_s // 60}m"
+        revoked_count = batch_row['key_count'] - batch_row['remaining_count']
+        unclaimed_count = batch_row['remaining_count'] - batch_row['claimed_count']
+        text_content += (f"\n- `{batch_row['batch_id']}` ({batch_row['key_type'].upper()}), Dur: {dur_text}, Gen: {gen_time}"
+                         f"\n  Total: {batch_row['key_count']}, Diklaim: {batch_row['claimed_count']}, Belum: {unclaimed_count}, Dicabut: {revoked_count}")
+        if unclaimed_count: buttons.append([Button.inline(f"📥 Ekspor {batch_row['batch_id']} (belum diklaim)", f"adm_batch_export:{batch_row['batch_id']}")])
+    buttons.append([Button.inline("Kembali ke Kelola Kunci", b"admin_manage_keys")])
+
+    try: await event.edit(text_content, buttons=buttons, parse_mode='md')
+    except MessageNotModifiedError: await event.answer()
+    except Exception as e_edit_batches: logger.error(f"Error edit statistik batch kunci: {e_edit_batches}"); await event.answer("Gagal menampilkan statistik.")
+
+async def export_key_batch(event, admin_chat_id, batch_id):
+    try:
+        key_values = await storage.fetch_unclaimed_batch_keys(batch_id)
+        if not key_values: await event.answer("Tidak ada kunci belum diklaim di batch ini.", alert=True); return
+        await send_key_batch_file(admin_chat_id, batch_id, key_values, f"Batch `{batch_id}`: {len(key_values)} kunci belum diklaim.")
+        await event.answer()
+    except Exception as e_export:
+        logger.error(f"Gagal ekspor batch kunci {batch_id}: {e_export}", exc_info=True); await event.answer("Gagal mengekspor batch.", alert=True)
+
 # --- Fungsi Tampilan Paginasi untuk Admin ---
-async def display_admin_keys_list(event, admin_chat_id, list_type, page):
+async def get_access_key_count(list_type):
+    """Jumlah kunci claimed/unclaimed dari cache singkat; hanya dihitung ulang saat kedaluwarsa atau diinvalidasi."""
+    cached_count = access_key_counts.get(list_type)
+    if cached_count and time.time() - cached_count[0] < KEY_COUNT_CACHE_TTL: return cached_count[1]
+    key_count = await storage.count_access_keys(list_type)
+    access_key_counts[list_type] = (time.time(), key_count)
+    return key_count
+
+def invalidate_access_key_counts():
+    access_key_counts.clear()
+
+def format_keys_cursor(list_type, page, direction, record):
+    return f"adm_keys_page:{list_type}:{page}:{direction}:{record['generation_timestamp']}:{record['key_value']}"
+
+async def display_admin_keys_list(event, admin_chat_id, list_type, page, cursor=None):
+    """Daftar kunci per halaman via keyset (generation_timestamp DESC, key_value DESC) di atas indeks parsial.
+
+    cursor = (arah, generation_timestamp, key_value): 'n' mengambil kunci yang lebih lama, 'p' yang lebih baru.
+    """
     items_per_page_admin = ADMIN_KEYS_ITEMS_PER_PAGE 
-    
-    query = "SELECT key_value, key_type, generation_timestamp, duration_seconds, assigned_watermark_text, claimed_by_chat_id, claim_timestamp FROM access_keys WHERE "
-    query += "is_claimed = FALSE" if list_type == "unclaimed" else "is_claimed = TRUE"
-    query += " ORDER BY generation_timestamp DESC" 
+    direction = cursor[0] if cursor else 'n'
 
     try:
-        async with db_pool.acquire() as conn:
-            all_keys_records = await conn.fetch(query)
+        page_records = await storage.fetch_access_keys_page(list_type, items_per_page_admin + 1, cursor)
+        total_items = await get_access_key_count(list_type)
     except Exception as e_fetch_keys:
         logger.error(f"Gagal mendapatkan daftar kunci admin ({list_type}): {e_fetch_keys}")
         _t, btns_km = admin_manage_keys_menu(); await event.edit(f"Gagal mendapatkan daftar kunci ({list_type}).\n{_t}", buttons=btns_km); return
 
-    if not all_keys_records:
+    has_more = len(page_records) > items_per_page_admin
+    page_items = list(page_records[:items_per_page_admin])
+    if direction == 'p': page_items.reverse()
+
+    if not page_items:
+        if cursor: await display_admin_keys_list(event, admin_chat_id, list_type, 0); return
         _t, btns_km = admin_manage_keys_menu(); await event.edit(f"Tidak ada kunci yang {list_type} ditemukan.\n{_t}", buttons=btns_km); return
 
-    total_items = len(all_keys_records)
-    total_pages = (total_items + items_per_page_admin - 1) // items_per_page_admin
+    total_pages = max(1, (total_items + items_per_page_admin - 1) // items_per_page_admin)
     page = max(0, min(page, total_pages - 1))
-    start_idx = page * items_per_page_admin
-    end_idx = min((page + 1) * items_per_page_admin, total_items)
-    
-    page_items = all_keys_records[start_idx:end_idx]
+    has_prev = has_more if direction == 'p' else page > 0
+    has_next = True if direction == 'p' else has_more
     
     text_content = f"Daftar Kunci {list_type.capitalize()} (Halaman {page + 1}/{total_pages}):\n"
     for item in page_items:
@@ -1701,8 +3542,8 @@ async def display_admin_keys_list(event, admin_chat_id, list_type, page):
     
     buttons = []
     nav_row = []
-    if page > 0: nav_row.append(Button.inline("<< Sebelumnya", f"adm_keys_page:{list_type}:{page-1}"))
-    if page < total_pages - 1: nav_row.append(Button.inline("Berikutnya >>", f"adm_keys_page:{list_type}:{page+1}"))
+    if has_prev: nav_row.append(Button.inline("<< Sebelumnya", format_keys_cursor(list_type, max(page - 1, 0), 'p', page_items[0])))
+    if has_next: nav_row.append(Button.inline("Berikutnya >>", format_keys_cursor(list_type, page + 1, 'n', page_items[-1])))
     if nav_row: buttons.append(nav_row)
     buttons.append([Button.inline("Kembali ke Kelola Kunci", b"admin_manage_keys")])
     
@@ -1710,53 +3551,62 @@ async def display_admin_keys_list(event, admin_chat_id, list_type, page):
     except MessageNotModifiedError: await event.answer()
     except Exception as e_edit_keys: logger.error(f"Error edit daftar kunci admin: {e_edit_keys}"); await event.answer("Gagal menampilkan daftar.")
 
-async def display_active_users_list(event, admin_chat_id, page):
+async def get_active_user_count():
+    """Jumlah pengguna aktif dari cache singkat; dihitung ulang saat kedaluwarsa atau saat kunci diaktifkan/dicabut/kedaluwarsa."""
+    global active_user_count
+    if active_user_count and time.time() - active_user_count[0] < KEY_COUNT_CACHE_TTL: return active_user_count[1]
+    user_count = await storage.count_active_users(time.time(), ADMIN_IDS)
+    active_user_count = (time.time(), user_count)
+    return user_count
+
+def invalidate_active_user_count():
+    global active_user_count
+    active_user_count = None
+
+def format_users_cursor(page, direction, record):
+    return f"adm_users_page:{page}:{direction}:{format(record['key_expiry_ts'], '.17g')}:{record['chat_id']}"
+
+async def display_active_users_list(event, admin_chat_id, page, cursor=None):
+    """Daftar pengguna aktif dengan filter, urutan dan jendela halaman di SQL (keyset pada key_expiry_ts, chat_id).
+
+    cursor = (arah, key_expiry_ts, chat_id): 'n' mengambil baris setelah cursor, 'p' baris sebelum cursor.
+    """
     items_per_page_admin = ADMIN_KEYS_ITEMS_PER_PAGE 
-    current_ts = int(time.time())
+    current_ts = time.time()
+    direction = cursor[0] if cursor else 'n'
     
     try:
-        async with db_pool.acquire() as conn:
-            all_users_records = await conn.fetch("SELECT chat_id, bot_data FROM users")
+        total_items = await get_active_user_count()
+        page_records = await storage.fetch_active_users_page(current_ts, ADMIN_IDS, items_per_page_admin + 1, cursor)
     except Exception as e_fetch_users:
         logger.error(f"Gagal mendapatkan daftar pengguna: {e_fetch_users}")
         _t,btns_am = admin_main_menu(); await event.edit(f"Gagal mendapatkan daftar pengguna.\n{_t}", buttons=btns_am); return
 
-    active_users_info = []
-    for record in all_users_records:
-        chat_id = record['chat_id']
-        if is_admin(chat_id): continue 
-
-        bot_data = json.loads(record['bot_data']) if record['bot_data'] else {}
-        if bot_data.get('has_valid_key') and bot_data.get('key_expiry_timestamp', 0) > current_ts:
-            active_users_info.append({
-                'chat_id': chat_id,
-                'key_type': bot_data.get('active_key_type', 'N/A'),
-                'key_value': bot_data.get('active_key_value', 'N/A')[:10]+"...",
-                'expiry_ts': bot_data.get('key_expiry_timestamp')
-            })
-    
-    active_users_info.sort(key=lambda x: x['expiry_ts'])
+    has_more = len(page_records) > items_per_page_admin
+    page_items = list(page_records[:items_per_page_admin])
+    if direction == 'p': page_items.reverse()
 
-    if not active_users_info:
+    if not page_items:
+        if cursor: await display_active_users_list(event, admin_chat_id, 0); return
         _t,btns_am = admin_main_menu(); await event.edit(f"Tidak ada pengguna aktif (dengan kunci valid) yang ditemukan.\n{_t}", buttons=btns_am); return
 
-    total_items = len(active_users_info)
-    total_pages = (total_items + items_per_page_admin - 1) // items_per_page_admin
+    total_pages = max(1, (total_items + items_per_page_admin - 1) // items_per_page_admin)
+    # Arah 'p': baris ekstra dari over-fetch menandakan masih ada halaman sebelumnya; tanpa itu ini halaman pertama
+    if direction == 'p' and not has_more: page = 0
     page = max(0, min(page, total_pages - 1))
-    start_idx = page * items_per_page_admin
-    end_idx = min((page + 1) * items_per_page_admin, total_items)
-    
-    page_items = active_users_info[start_idx:end_idx]
+    has_prev = has_more if direction == 'p' else page > 0
+    has_next = True if direction == 'p' else has_more
     
     text_content = f"Pengguna Aktif (Halaman {page + 1}/{total_pages}):\n"
     for item in page_items:
-        expiry_str = datetime.datetime.fromtimestamp(item['expiry_ts']).strftime('%Y-%m-%d %H:%M')
-        text_content += f"\n- ID: {item['chat_id']}\n  Tipe: {item['key_type'].upper()}, Kunci: `{item['key_value']}`\n  Kadaluwarsa: {expiry_str}\n"
+        expiry_str = datetime.datetime.fromtimestamp(item['key_expiry_ts']).strftime('%Y-%m-%d %H:%M')
+        key_value_short = (item['key_value'] or 'N/A')[:10] + "..."
+        text_content += f"\n- ID: {item['chat_id']}\n  Tipe: {(item['key_type'] or 'N/A').upper()}, Kunci: `{key_value_short}`\n  Kadaluwarsa: {expiry_str}\n"
     
     buttons = []
     nav_row = []
-    if page > 0: nav_row.append(Button.inline("<< Sebelumnya", f"adm_users_page:{page-1}"))
-    if page < total_pages - 1: nav_row.append(Button.inline("Berikutnya >>", f"adm_users_page:{page+1}"))
+    if has_prev: nav_row.append(Button.inline("<< Sebelumnya", format_users_cursor(max(page - 1, 0), 'p', page_items[0])))
+    if has_next: nav_row.append(Button.inline("Berikutnya >>", format_users_cursor(page + 1, 'n', page_items[-1])))
     if nav_row: buttons.append(nav_row)
     buttons.append([Button.inline("Kembali ke Panel Admin", b"admin_panel")])
     
@@ -1764,148 +3614,447 @@ async def display_active_users_list(event, admin_chat_id, page):
     except MessageNotModifiedError: await event.answer()
     except Exception as e_edit_users: logger.error(f"Error edit daftar pengguna aktif: {e_edit_users}"); await event.answer("Gagal menampilkan daftar.")
 
+# --- Pelapor Progres Bot ---
+class ProgressReporter:
+    """Satu pesan status bot yang diedit: maksimal satu edit per min_interval, tanpa edit bila teks sama,
+    dan FloodWait bot tidak ditunggu (update dilewati sampai jedanya habis). Hasil per target dilipat ke satu digest di finish()."""
+    __slots__ = ('chat_id', 'title', 'message_id', 'min_interval', 'last_text', 'last_edit', 'hold_until', 'reports', 'notes')
+
+    def __init__(self, chat_id, title, message_id=None, min_interval=PROGRESS_EDIT_INTERVAL):
+        self.chat_id = chat_id
+        self.title = title
+        self.message_id = message_id
+        self.min_interval = min_interval
+        self.last_text = None
+        self.last_edit = 0
+        self.hold_until = 0
+        self.reports = []
+        self.notes = []
+
+    def add_report(self, report): self.reports.append(report)
+
+    def note(self, text): self.notes.append(text)
+
+    async def update(self, text):
+        if text == self.last_text or time.monotonic() - self.last_edit < self.min_interval: return
+        await self.publish(text)
+
+    async def publish(self, text, buttons=None):
+        """Kirim/edit pesan status sekarang (tetap menghormati FloodWait bot); True bila berhasil atau teks tidak berubah."""
+        now = time.monotonic()
+        if text == self.last_text and buttons is None: return True
+        if now < self.hold_until: return False
+        self.last_text, self.last_edit = text, now
+        try:
+            if self.message_id: await bot.edit_message(self.chat_id, self.message_id, text, buttons=buttons)
+            else: self.message_id = (await bot.send_message(self.chat_id, text, buttons=buttons)).id
+            return True
+        except MessageNotModifiedError: return True
+        except FloodWaitError as e_flood_progress:
+            self.hold_until = now + e_flood_progress.seconds
+            logger.warning(f"FloodWait {e_flood_progress.seconds}s pada pesan progres {self.chat_id}. Update dilewati sampai jeda habis.")
+        except Exception as e_progress:
+            logger.warning(f"Gagal memperbarui pesan progres {self.chat_id}: {e_progress}")
+            self.message_id = None
+        self.last_text = None
+        return False
+
+    def digest_text(self):
+        lines = [f"{self.title}:"]
+        error_counts, error_samples = collections.Counter(), []
+        flood_waits = flood_wait_seconds = 0
+        for report in self.reports:
+            lines.append(report.summary_line())
+            error_counts.update(report.error_class_counts())
+            flood_waits += report.flood_waits
+            flood_wait_seconds += report.flood_wait_seconds
+            for peer_id, (_error_class, error_message) in report.failed.items():
+                if len(error_samples) >= PROGRESS_DIGEST_SAMPLES: break
+                error_samples.append(f"- {peer_id}: {error_message[:50]}")
+        if flood_waits: lines.append(f"FloodWait/SlowMode: {flood_waits} kali (total {flood_wait_seconds} detik).")
+        if error_counts: lines.append("Error: " + ", ".join(f"{error_class} x{count}" for error_class, count in error_counts.most_common()))
+        if error_samples: lines.append(f"Rincian Gagal (max {PROGRESS_DIGEST_SAMPLES}):"); lines.extend(error_samples)
+        lines.extend(self.notes)
+        return "\n".join(lines)
+
+    async def finish(self, text=None, buttons=None):
+        """Publikasikan digest akhir; bila edit gagal dikirim sebagai pesan baru sekali. Digest yang tertahan FloodWait
+        tidak dibuang: pengiriman dijadwalkan ulang di latar belakang setelah jedanya habis."""
+        text = text or self.digest_text()
+        if await self.publish(text, buttons=buttons): return
+        if self.message_id is None and time.monotonic() >= self.hold_until and await self.publish(text, buttons=buttons): return
+        logger.warning(f"Digest progres untuk {self.chat_id} belum terkirim, dijadwalkan ulang.")
+        delivery_task = asyncio.create_task(self.deliver_later(text, buttons))
+        pending_progress_deliveries.add(delivery_task)
+        delivery_task.add_done_callback(pending_progress_deliveries.discard)
+
+    async def deliver_later(self, text, buttons=None):
+        for _attempt in range(PROGRESS_DIGEST_RETRIES):
+            await asyncio.sleep(max(self.hold_until - time.monotonic(), PROGRESS_RETRY_DELAY))
+            if await self.publish(text, buttons=buttons): return
+        logger.error(f"Digest progres untuk {self.chat_id} tidak terkirim setelah {PROGRESS_DIGEST_RETRIES} percobaan.")
+
+# --- Cache Handle Media ---
+class MediaHandle:
+    """InputPhoto/InputDocument milik satu akun userbot untuk media item tersimpan (id, access_hash dan file_reference berlaku per akun),
+    plus pesan asal tempat file_reference bisa di-refresh dengan satu get_messages."""
+    __slots__ = ('kind', 'media_id', 'access_hash', 'file_reference', 'source_peer_id', 'source_msg_id')
+
+    def __init__(self, kind, media_id, access_hash, file_reference, source_peer_id=None, source_msg_id=None):
+        self.kind = kind
+        self.media_id = media_id
+        self.access_hash = access_hash
+        self.file_reference = file_reference
+        self.source_peer_id = source_peer_id
+        self.source_msg_id = source_msg_id
+
+    @classmethod
+    def from_message(cls, message):
+        if message is None: return None
+        if message.photo: media, kind = message.photo, 'photo'
+        elif message.document: media, kind = message.document, 'document'
+        else: return None
+        return cls(kind, media.id, media.access_hash, media.file_reference, message.chat_id, message.id)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['kind'], row['media_id'], row['access_hash'], bytes(row['file_reference']), row['source_peer_id'], row['source_msg_id'])
+
+    def to_row(self):
+        return (self.kind, self.media_id, self.access_hash, self.file_reference, self.source_peer_id, self.source_msg_id)
+
+    def input_media(self):
+        if self.kind == 'photo': return InputPhoto(self.media_id, self.access_hash, self.file_reference)
+        return InputDocument(self.media_id, self.access_hash, self.file_reference)
+
+async def lookup_media_handle(owner_chat_id, item_id):
+    """Cari di memori lalu di tabel media_handles; hasil kosong juga diingat sampai handle pertama disimpan."""
+    handle_key = (owner_chat_id, item_id)
+    if handle_key in media_handles: return media_handles[handle_key]
+    try: handle_row = await storage.fetch_media_handle(owner_chat_id, item_id)
+    except Exception as e_fetch_handle:
+        logger.error(f"Gagal memuat handle media {item_id} untuk {owner_chat_id}: {e_fetch_handle}"); return None
+    media_handle = media_handles[handle_key] = MediaHandle.from_row(handle_row) if handle_row else None
+    return media_handle
+
+async def remember_media_handle(owner_chat_id, item_id, media_handle):
+    media_handles[(owner_chat_id, item_id)] = media_handle
+    media_uploads.pop((owner_chat_id, item_id), None)
+    try: await storage.save_media_handle(owner_chat_id, item_id, media_handle.to_row(), int(time.time()))
+    except Exception as e_save_handle: logger.error(f"Gagal menyimpan handle media {item_id} untuk {owner_chat_id}: {e_save_handle}")
+
+def drop_media_handle_cache(owner_chat_id, item_ids=None):
+    for handle_key in [key for key in {*media_handles, *media_uploads, *media_source_failures} if key[0] == owner_chat_id and (item_ids is None or key[1] in item_ids)]:
+        media_handles.pop(handle_key, None); media_uploads.pop(handle_key, None); media_source_failures.pop(handle_key, None)
+
+async def forget_media_handles(owner_chat_id, item_ids=None):
+    """Buang handle media satu akun (semua, atau hanya item_ids); dipanggil saat item dihapus atau nomor userbot berganti."""
+    drop_media_handle_cache(owner_chat_id, item_ids)
+    try: await storage.delete_media_handles(owner_chat_id, item_ids)
+    except Exception as e_clear_handles: logger.error(f"Gagal menghapus handle media untuk {owner_chat_id}: {e_clear_handles}")
+
+async def refresh_media_handle(client, owner_chat_id, item_id, media_handle):
+    """Satu get_messages ke pesan asal untuk file_reference baru; None (handle dibuang) bila pesan asal sudah tidak ada."""
+    source_peer = await lookup_resolved_peer(owner_chat_id, media_handle.source_peer_id) if media_handle.source_peer_id else None
+    try: refreshed_handle = MediaHandle.from_message(await client.get_messages(source_peer.input_peer if source_peer else media_handle.source_peer_id, ids=media_handle.source_msg_id))
+    except Exception as e_refresh:
+        logger.warning(f"Gagal refresh file_reference item {item_id} untuk {owner_chat_id}: {e_refresh}"); refreshed_handle = None
+    if refreshed_handle is None or refreshed_handle.media_id != media_handle.media_id:
+        logger.info(f"Handle media item {item_id} untuk {owner_chat_id} tidak bisa di-refresh, media akan di-upload ulang.")
+        await forget_media_handles(owner_chat_id, [item_id])
+        return None
+    await remember_media_handle(owner_chat_id, item_id, refreshed_handle)
+    return refreshed_handle
+
+async def upload_saved_media(client, owner_chat_id, item):
+    """Unduh media asli lewat bot (pesan yang dikirim pengguna ke bot) dan upload sekali ke akun userbot.
+    Mengembalikan (InputFile, parameter send_file) atau None untuk item lama tanpa media_source."""
+    item_id = item.get('id')
+    upload_key = (owner_chat_id, item_id)
+    if upload_key in media_uploads: return media_uploads[upload_key]
+    media_source = item.get('media_source')
+    if not media_source: return None
+    # Pesan asal yang sudah dihapus tidak akan kembali: gagal sekali, tidak di-get_messages ulang untuk setiap target
+    # Kegagalan dicatat per (akun, item): item_id teks tersimpan bisa sama antar pengguna (id turunan md5)
+    if upload_key in media_source_failures: raise ValueError(media_source_failures[upload_key])
+    source_message = await bot.get_messages(media_source['chat_id'], ids=media_source['message_id'])
+    if not source_message or not source_message.media:
+        media_source_failures[upload_key] = f"Pesan media asal untuk item {item_id} tidak ditemukan. Simpan ulang media ini."
+        raise ValueError(media_source_failures[upload_key])
+    if source_message.photo: file_name, upload_params = 'photo.jpg', {}
+    else:
+        file_name = os.path.basename(source_message.file.name or '') or f"file{source_message.file.ext or ''}"
+        upload_params = {'force_document': True, 'attributes': source_message.document.attributes, 'mime_type': source_message.document.mime_type}
+    # Dokumen bisa sampai 2 GB: unduh ke file sementara di disk, upload_file membacanya per bagian
+    with tempfile.TemporaryDirectory(prefix='kelana-media-') as media_temp_dir:
+        media_path = await bot.download_media(source_message, file=os.path.join(media_temp_dir, file_name))
+        logger.info(f"Upload media item {item_id} ke akun userbot {owner_chat_id} ({os.path.getsize(media_path)} byte).")
+        uploaded_media = media_uploads[upload_key] = (await client.upload_file(media_path, file_name=file_name), upload_params)
+    return uploaded_media
+
+async def send_saved_media(client, owner_chat_id, to_chat_id, item, caption, **send_params):
+    """Kirim media item tersimpan lewat handle akun ini. FileReferenceExpired diperbaiki dengan satu refresh;
+    bytes hanya di-upload bila belum ada handle, dan pesan hasil kirim pertama menjadi handle berikutnya."""
+    item_id = item.get('id')
+    media_handle = await lookup_media_handle(owner_chat_id, item_id)
+    if media_handle:
+        try: return await client.send_file(to_chat_id, media_handle.input_media(), caption=caption, **send_params)
+        except FileReferenceExpiredError:
+            media_handle = await refresh_media_handle(client, owner_chat_id, item_id, media_handle)
+            if media_handle: return await client.send_file(to_chat_id, media_handle.input_media(), caption=caption, **send_params)
+    uploaded_media = await upload_saved_media(client, owner_chat_id, item)
+    if uploaded_media is None: return await client.send_file(to_chat_id, item.get('media_file_id'), caption=caption, **send_params)
+    input_file, upload_params = uploaded_media
+    sent_message = await client.send_file(to_chat_id, input_file, caption=caption, **upload_params, **send_params)
+    media_handle = MediaHandle.from_message(sent_message)
+    if media_handle: await remember_media_handle(owner_chat_id, item_id, media_handle)
+    return sent_message
+
 # --- Fungsi Inti (Copy) dengan Watermark ---
-async def send_messages_in_batches(user_client, groups_to_send_to, message_func, chat_id, action_name, item_to_send=None):
+def copy_watermark_text(chat_id, bot_data):
+    key_type = bot_data.get('active_key_type')
+    if key_type == 'vip' and bot_data.get('watermark_enabled', False): return bot_data.get('watermark_text', DEFAULT_GLOBAL_WATERMARK_TEXT)
+    if key_type == 'basic' and bot_data.get('assigned_basic_watermark_text'): return bot_data.get('assigned_basic_watermark_text')
+    if is_admin(chat_id) and bot_data.get('watermark_enabled', False): return bot_data.get('watermark_text', DEFAULT_GLOBAL_WATERMARK_TEXT)
+    return ""
+
+class CompiledPayload:
+    """Item copy yang sudah dirender sekali: teks akhir + watermark, entitas atau parse mode, dan media.
+    Dipakai ulang untuk semua target sampai item, watermark atau tipe kunci berubah (lihat fingerprint)."""
+    __slots__ = ('fingerprint', 'owner_chat_id', 'item', 'item_id', 'text', 'media', 'send_params')
+
+    def __init__(self, fingerprint, owner_chat_id, item, watermark_to_apply):
+        self.fingerprint = fingerprint
+        self.owner_chat_id = owner_chat_id
+        self.item = item
+        self.item_id = item.get('id')
+        text_to_send = item.get('text', "")
+        entities_original = item.get('entities', [])
+        self.media = item.get('media_file_id')
+
+        if watermark_to_apply:
+            if text_to_send: text_to_send = f"{text_to_send}\n\n{watermark_to_apply}"
+            elif self.media: text_to_send = watermark_to_apply
+        self.text = text_to_send
+
+        self.send_params = {'link_preview': False}
+        if watermark_to_apply and entities_original:
+            if re.search(r"[*_`~[\]()]", text_to_send): self.send_params['parse_mode'] = 'md'
+        elif not watermark_to_apply and entities_original:
+            final_entities = [entity for entity in map(dict_to_entity, filter(None, entities_original)) if entity is not None]
+            if final_entities: self.send_params['formatting_entities'] = final_entities
+        elif text_to_send and re.search(r"\[.*?\]\(https?://.*?\)", text_to_send): self.send_params['parse_mode'] = 'md'
+
+    def is_empty(self): return not (self.media or self.text)
+
+    async def send(self, client, to_chat_id):
+        if self.media: await send_saved_media(client, self.owner_chat_id, to_chat_id, self.item, self.text, **self.send_params)
+        else: await client.send_message(to_chat_id, self.text, **self.send_params)
+
+def get_compiled_payload(chat_id, item, bot_data):
+    """Payload per pengguna dikompilasi ulang hanya bila fingerprint (item, tipe kunci, watermark) berubah."""
+    watermark_to_apply = copy_watermark_text(chat_id, bot_data)
+    fingerprint = (item.get('id'), item.get('text'), item.get('media_file_id'), bot_data.get('active_key_type'), watermark_to_apply)
+    payload = compiled_payloads.get(chat_id)
+    if payload is None or payload.fingerprint != fingerprint:
+        payload = compiled_payloads[chat_id] = CompiledPayload(fingerprint, chat_id, item, watermark_to_apply)
+    return payload
+
+class ClientPacer:
+    """Jadwal kirim satu klien userbot: jeda minimum antar request, jeda setelah setiap burst BATCH_SIZE,
+    dan penahanan seluruh klien selama FloodWait (batas akun, bukan per chat) sejak FloodWait pertama."""
+    __slots__ = ('min_interval', 'burst_size', 'burst_pause', 'next_send_at', 'sent_in_burst', 'hold_until')
+
+    def __init__(self, min_interval=SEND_MIN_INTERVAL, burst_size=BATCH_SIZE, burst_pause=BATCH_DELAY):
+        self.min_interval = min_interval
+        self.burst_size = burst_size
+        self.burst_pause = burst_pause
+        self.next_send_at = 0
+        self.sent_in_burst = 0
+        self.hold_until = 0
+
+    async def wait_turn(self):
+        delay = max(self.next_send_at, self.hold_until) - time.monotonic()
+        if delay > 0: await asyncio.sleep(delay)
+
+    def on_request(self, flood_seconds=None):
+        """Catat satu request; slot berikutnya dihitung dari waktu selesai, bukan ditambah sleep tetap."""
+        now = time.monotonic()
+        if flood_seconds is not None: self.hold_until = max(self.hold_until, now + flood_seconds)
+        self.sent_in_burst += 1
+        if self.sent_in_burst >= self.burst_size:
+            self.sent_in_burst = 0
+            self.next_send_at = now + self.burst_pause
+        else: self.next_send_at = now + self.min_interval
+
+class DeliveryReport:
+    """Hasil satu pemanggilan send_messages_in_batches, dipakai untuk ringkasan, metrik dan penyimpanan.
+
+    succeeded adalah set peer_id, failed memetakan peer_id -> (kelas_error, pesan) untuk kegagalan pertama,
+    latencies memetakan peer_id -> detik untuk percobaan kirim terakhir.
+    """
+    __slots__ = ('chat_id', 'action_name', 'started_at', 'finished_at', 'succeeded', 'failed', 'latencies', 'aborted', 'flood_waits', 'flood_wait_seconds')
+
+    def __init__(self, chat_id, action_name):
+        self.chat_id = chat_id
+        self.action_name = action_name
+        self.started_at = time.time()
+        self.finished_at = None
+        self.succeeded = set()
+        self.failed = {}
+        self.latencies = {}
+        self.aborted = False
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+
+    def record_success(self, peer_id, latency):
+        self.succeeded.add(peer_id)
+        self.failed.pop(peer_id, None)
+        self.latencies[peer_id] = latency
+
+    def record_failure(self, peer_id, error, latency=None):
+        if latency is not None: self.latencies[peer_id] = latency
+        if peer_id not in self.failed: self.failed[peer_id] = (type(error).__name__, str(error))
+
+    def record_flood_wait(self, seconds):
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+
+    def error_class_counts(self):
+        return collections.Counter(error_class for error_class, _ in self.failed.values())
+
+    def average_latency_ms(self):
+        return int(sum(self.latencies.values()) * 1000 / len(self.latencies)) if self.latencies else None
+
+    def summary_line(self):
+        return f"{self.action_name}: {len(self.succeeded)} berhasil, {len(self.failed)} gagal{', dihentikan' if self.aborted else ''}."
+
+    def to_row(self):
+        return (self.chat_id, self.action_name, self.started_at, self.finished_at, len(self.succeeded), len(self.failed),
+                self.aborted, self.average_latency_ms(), json.dumps(self.error_class_counts(), separators=(',', ':')))
+
+async def finish_delivery_report(report, aborted=False):
+    """Tutup laporan: tambahkan ke total per aksi, catat ke log, dan simpan ke DB."""
+    report.finished_at = time.time()
+    report.aborted = aborted
+    action_totals = delivery_totals[report.action_name]
+    action_totals['sent'] += len(report.succeeded)
+    action_totals['failed'] += len(report.failed)
+    action_totals['runs'] += 1
+    logger.info(f"Laporan {report.action_name} untuk {report.chat_id}: {len(report.succeeded)} berhasil, {len(report.failed)} gagal, "
+                f"rata-rata {report.average_latency_ms()} ms, error {dict(report.error_class_counts())}{', dihentikan' if aborted else ''}.")
+    try: await storage.save_delivery_report(report.to_row())
+    except Exception as e_save_report: logger.error(f"Gagal menyimpan laporan pengiriman untuk {report.chat_id}: {e_save_report}")
+    return report
+
+async def send_messages_in_batches(user_client, resolved_targets, message_func, chat_id, action_name, progress, item_to_send=None):
+    """Mengirim ke semua target siap kirim; mengembalikan DeliveryReport (aborted=True bila sesi tidak bisa dipulihkan).
+    Status dan error per target dilaporkan lewat progress (ProgressReporter), bukan pesan bot terpisah."""
+    report = DeliveryReport(chat_id, action_name)
+    progress.add_report(report)
     if not user_client: 
         logger.error(f"send_messages_in_batches dipanggil dengan user_client None untuk {chat_id}")
-        await bot.send_message(chat_id, "Error internal: Klien pengguna tidak tersedia untuk mengirim pesan.")
-        return False 
+        progress.note("Error internal: Klien pengguna tidak tersedia untuk mengirim pesan.")
+        return await finish_delivery_report(report, aborted=True) 
 
-    successful_groups, failed_groups_details, groups_to_remove_runtime = [], [], []
-    
-    valid_targets_peer_ids, invalid_target_details = [], [] 
-    if not groups_to_send_to: 
+    if not resolved_targets.peers and not resolved_targets.removals: 
         logger.info(f"Tidak ada grup target disediakan untuk {action_name} oleh {chat_id}")
-        await bot.send_message(chat_id, f"Tidak ada grup target yang disetel untuk {action_name.lower()}.")
-        return True 
+        progress.note(f"Tidak ada grup target yang disetel untuk {action_name.lower()}.")
+        return report 
 
-    for target_id_val_orig_str in groups_to_send_to: 
-        is_valid_val, entity_or_error_msg = await validate_entity(user_client, target_id_val_orig_str, chat_id, group_only=True)
-        if is_valid_val and entity_or_error_msg: 
-            try:
-                peer_id_int = get_peer_id(entity_or_error_msg)
-                valid_targets_peer_ids.append(peer_id_int) 
-            except Exception as e_get_peer:
-                logger.error(f"Gagal mendapatkan peer_id dari entitas {entity_or_error_msg} untuk {target_id_val_orig_str}: {e_get_peer}")
-                invalid_target_details.append((target_id_val_orig_str, "Gagal mendapatkan Peer ID"))
-        else: 
-            invalid_target_details.append((target_id_val_orig_str, entity_or_error_msg if isinstance(entity_or_error_msg, str) else "Validasi Gagal"))
-            logger.warning(f"Target tidak valid {target_id_val_orig_str} untuk {chat_id}: {entity_or_error_msg if isinstance(entity_or_error_msg, str) else 'Objek entitas tidak kembali'}")
-
-    if invalid_target_details:
-        _ph_inv, _ss_inv, bot_data_inv_rem = await get_user_data(chat_id)
-        current_target_groups_db_inv = list(bot_data_inv_rem.get('target_groups', []))
-        ids_invalid_orig = [inv_tg[0] for inv_tg in invalid_target_details] 
-        
-        updated_target_groups_list_inv = [tg for tg in current_target_groups_db_inv if tg not in ids_invalid_orig]
-        
-        if len(updated_target_groups_list_inv) < len(current_target_groups_db_inv):
-            await update_user_data_db(chat_id, bot_data_update={'target_groups': updated_target_groups_list_inv})
-            await bot.send_message(chat_id, f"{len(invalid_target_details)} target tidak valid dihapus dari daftar Anda: {', '.join(map(str,ids_invalid_orig[:3]))}{'...' if len(ids_invalid_orig)>3 else ''}")
+    target_input_peers = {resolved_peer.peer_id: resolved_peer.input_peer for resolved_peer in resolved_targets.peers.values()}
+    valid_targets_peer_ids = list(target_input_peers)
 
     if not valid_targets_peer_ids: 
-        await bot.send_message(chat_id, f"Tidak ada grup target valid yang ditemukan untuk {action_name.lower()}. Pastikan Anda telah menambahkan grup yang benar.")
-        return True
-
-    progress_msg_obj = None
-    try: progress_msg_obj = await bot.send_message(chat_id, f"Memulai {action_name.lower()} ke {len(valid_targets_peer_ids)} target...")
-    except Exception as e: logger.error(f"Gagal mengirim pesan progres: {e}", exc_info=True)
-
-    total_batches = (len(valid_targets_peer_ids) + BATCH_SIZE - 1) // BATCH_SIZE
-
-    for batch_idx in range(total_batches):
-        start_idx_batch, end_idx_batch = batch_idx * BATCH_SIZE, min((batch_idx + 1) * BATCH_SIZE, len(valid_targets_peer_ids))
-        current_batch_targets_peer_ids = valid_targets_peer_ids[start_idx_batch:end_idx_batch] 
-        try: 
-            if progress_msg_obj: await progress_msg_obj.edit(f"Batch {batch_idx+1}/{total_batches} ({len(current_batch_targets_peer_ids)} target)... {action_name}")
-        except MessageNotModifiedError: pass
-        except FloodWaitError as e_flood_edit: await asyncio.sleep(e_flood_edit.seconds + 1) 
-        except Exception as e_edit_prog: logger.error(f"Gagal mengedit pesan progres: {e_edit_prog}", exc_info=True)
-
-        for target_peer_id_int in current_batch_targets_peer_ids: 
-            if not user_client.is_connected():
-                logger.warning(f"Klien pengguna {chat_id} terputus. Memeriksa sesi.")
-                if not await verify_session(user_client, chat_id):
-                    logger.error(f"Klien pengguna {chat_id} gagal diverifikasi. Menghentikan pengiriman.")
-                    return False 
-                logger.info(f"Klien pengguna {chat_id} terhubung kembali.")
-
-            try:
-                logger.info(f"Mencoba {action_name} ke ID peer {target_peer_id_int} untuk {chat_id}")
-                await message_func(user_client, target_peer_id_int, item_to_send) 
-                successful_groups.append(target_peer_id_int)
-                logger.info(f"Berhasil {action_name} ke ID peer {target_peer_id_int} untuk {chat_id}")
-                await asyncio.sleep(2.5) 
-            except FloodWaitError as e_flood_send:
-                wait_duration = e_flood_send.seconds * 1.5 
-                logger.warning(f"FloodWait ke {target_peer_id_int} untuk {chat_id}. Menunggu {wait_duration:.0f}s...")
-                await bot.send_message(chat_id, f"Kena FloodWait saat mengirim ke {target_peer_id_int}. Menunggu {wait_duration:.0f} detik...")
-                await asyncio.sleep(wait_duration)
-                try: 
-                    await message_func(user_client, target_peer_id_int, item_to_send)
-                    successful_groups.append(target_peer_id_int)
-                except Exception as e_retry_flood:
-                    logger.error(f"Gagal retry pengiriman setelah FloodWait ke {target_peer_id_int} untuk {chat_id}: {e_retry_flood}", exc_info=True)
-                    if target_peer_id_int not in [fg[0] for fg in failed_groups_details]: failed_groups_details.append((target_peer_id_int, str(e_retry_flood)))
-            except (ChatWriteForbiddenError, ChatRestrictedError, UserBannedInChannelError) as e_perm_send:
-                error_msg_for_user = f"Gagal mengirim ke {target_peer_id_int}: {type(e_perm_send).__name__}. Pastikan userbot Anda memiliki izin."
-                logger.warning(f"{error_msg_for_user} (Pengguna: {chat_id})")
-                await bot.send_message(chat_id, error_msg_for_user)
-                if target_peer_id_int not in [fg[0] for fg in failed_groups_details]: failed_groups_details.append((target_peer_id_int, str(e_perm_send)))
-            except (ChannelPrivateError, ChatAdminRequiredError, UserIsBlockedError, UserNotMutualContactError, UserPrivacyRestrictedError) as e_fatal_access:
-                error_msg_for_user = f"Gagal mengakses {target_peer_id_int}: {type(e_fatal_access).__name__}. Grup ini akan dihapus dari daftar Anda."
-                logger.error(f"{error_msg_for_user} (Pengguna: {chat_id})")
-                await bot.send_message(chat_id, error_msg_for_user)
-                if target_peer_id_int not in [fg[0] for fg in failed_groups_details]: failed_groups_details.append((target_peer_id_int, str(e_fatal_access)))
-                
-                _p_temp, _s_temp, bd_temp = await get_user_data(chat_id)
-                original_target_str_to_remove = None
-                for tg_str in bd_temp.get('target_groups', []):
-                    try:
-                        resolved_tg_entity = await user_client.get_entity(int(tg_str) if tg_str.lstrip('-').isdigit() else tg_str)
-                        if get_peer_id(resolved_tg_entity) == target_peer_id_int:
-                            original_target_str_to_remove = tg_str
-                            break
-                    except: continue
-                if original_target_str_to_remove and original_target_str_to_remove not in groups_to_remove_runtime:
-                     groups_to_remove_runtime.append(original_target_str_to_remove)
-
-            except ConnectionError as e_conn_send:
-                logger.warning(f"ConnectionError saat mengirim ke {target_peer_id_int} untuk {chat_id}: {e_conn_send}. Memeriksa sesi.")
-                if not await verify_session(user_client, chat_id):
-                    logger.error(f"Klien untuk {chat_id} gagal diverifikasi. Sesi tidak dapat dipulihkan.")
-                    return False 
-                continue 
-            except ValueError as ve: 
-                logger.error(f"ValueError saat mengirim ke {target_peer_id_int} untuk {chat_id}: {ve}", exc_info=True)
-                if target_peer_id_int not in [fg[0] for fg in failed_groups_details]: failed_groups_details.append((target_peer_id_int, str(ve)))
-            except Exception as e_general_send:
-                logger.error(f"Error umum saat mengirim ke {target_peer_id_int} untuk {chat_id}: {e_general_send}", exc_info=True)
-                if target_peer_id_int not in [fg[0] for fg in failed_groups_details]: failed_groups_details.append((target_peer_id_int, str(e_general_send)))
-        
-        if batch_idx < total_batches - 1: await asyncio.sleep(BATCH_DELAY) 
-
-    if groups_to_remove_runtime: 
-        _ph_rem_run, _ss_rem_run, bot_data_rem_run = await get_user_data(chat_id)
-        current_targets_db_run = list(bot_data_rem_run.get('target_groups', []))
-        updated_targets_run = [tg for tg in current_targets_db_run if tg not in groups_to_remove_runtime]
-        
-        if len(updated_targets_run) < len(current_targets_db_run):
-            await update_user_data_db(chat_id, bot_data_update={'target_groups': updated_targets_run})
-            removed_groups_str_run = ", ".join(map(str, groups_to_remove_runtime[:5])) + ("..." if len(groups_to_remove_runtime) > 5 else "")
-            await bot.send_message(chat_id, f"{len(groups_to_remove_runtime)} grup dihapus karena masalah akses fundamental. Grup: {removed_groups_str_run}.")
-
-    summary_text_final = f"{action_name} selesai.\nBerhasil: {len(successful_groups)}.\nGagal (percobaan kirim): {len(failed_groups_details)}.\n"
-    if failed_groups_details:
-        summary_text_final += "Rincian Gagal (max 3):\n"
-        for i, (grp, err) in enumerate(failed_groups_details[:3]):
-            summary_text_final += f"- {grp}: {str(err)[:50]}\n"
-
-    if progress_msg_obj:
-        try: await progress_msg_obj.edit(summary_text_final)
-        except Exception: await bot.send_message(chat_id, summary_text_final)
-    else: await bot.send_message(chat_id, summary_text_final)
-    return True
+        progress.note(f"Tidak ada grup target valid yang ditemukan untuk {action_name.lower()}. Pastikan Anda telah menambahkan grup yang benar.")
+        return report
+
+    await progress.update(f"Memulai {action_name.lower()} ke {len(valid_targets_peer_ids)} target...")
+
+    pacer = client_pacers.setdefault(chat_id, ClientPacer())
+    ready_targets = collections.deque(valid_targets_peer_ids)
+    parked_targets = []
+    flood_retries = collections.Counter()
+    attempted_count = 0
+
+    while ready_targets or parked_targets:
+        now_mono = time.monotonic()
+        while parked_targets and parked_targets[0][0] <= now_mono: ready_targets.append(heapq.heappop(parked_targets)[1])
+        if not ready_targets:
+            await asyncio.sleep(parked_targets[0][0] - now_mono)
+            continue
+        target_peer_id_int = ready_targets.popleft()
+
+        if not user_client.is_connected():
+            logger.warning(f"Klien pengguna {chat_id} terputus. Memeriksa sesi.")
+            if not await verify_session(user_client, chat_id):
+                logger.error(f"Klien pengguna {chat_id} gagal diverifikasi. Menghentikan pengiriman.")
+                return await finish_delivery_report(report, aborted=True) 
+            logger.info(f"Klien pengguna {chat_id} terhubung kembali.")
+
+        await pacer.wait_turn()
+        send_started, flood_seconds = time.monotonic(), None
+        try:
+            logger.info(f"Mencoba {action_name} ke ID peer {target_peer_id_int} untuk {chat_id}")
+            await message_func(user_client, target_input_peers[target_peer_id_int], item_to_send) 
+            report.record_success(target_peer_id_int, time.monotonic() - send_started)
+            logger.info(f"Berhasil {action_name} ke ID peer {target_peer_id_int} untuk {chat_id}")
+        except SlowModeWaitError as e_slow_mode:
+            # Slow mode berlaku per chat: hanya target ini yang ditunda, target lain tetap jalan
+            report.record_flood_wait(e_slow_mode.seconds)
+            if flood_retries[target_peer_id_int] < SEND_FLOOD_RETRIES and e_slow_mode.seconds <= SEND_FLOOD_MAX_PARK:
+                flood_retries[target_peer_id_int] += 1
+                heapq.heappush(parked_targets, (time.monotonic() + e_slow_mode.seconds, target_peer_id_int))
+                logger.warning(f"SlowModeWait {e_slow_mode.seconds}s ke {target_peer_id_int} untuk {chat_id}. Target ditunda, lanjut ke target lain.")
+            else:
+                logger.error(f"SlowModeWait {e_slow_mode.seconds}s ke {target_peer_id_int} untuk {chat_id}; tidak dicoba lagi di siklus ini.")
+                report.record_failure(target_peer_id_int, e_slow_mode, time.monotonic() - send_started)
+        except FloodWaitError as e_flood_send:
+            # FloodWait berlaku untuk seluruh akun: pacer menahan semua request sampai jedanya habis
+            report.record_flood_wait(e_flood_send.seconds)
+            flood_seconds = e_flood_send.seconds
+            if e_flood_send.seconds > SEND_FLOOD_MAX_PARK:
+                skipped_count = 1 + len(ready_targets) + len(parked_targets)
+                logger.error(f"FloodWait {e_flood_send.seconds}s untuk akun {chat_id}; {skipped_count} target tersisa dilewati di siklus ini.")
+                progress.note(f"{action_name}: FloodWait {e_flood_send.seconds} detik dari Telegram, {skipped_count} target tersisa dilewati di siklus ini.")
+                break
+            if flood_retries[target_peer_id_int] < SEND_FLOOD_RETRIES:
+                flood_retries[target_peer_id_int] += 1
+                ready_targets.appendleft(target_peer_id_int)
+                logger.warning(f"FloodWait {e_flood_send.seconds}s ke {target_peer_id_int} untuk {chat_id}. Semua pengiriman akun ditahan sampai jeda habis.")
+            else:
+                logger.error(f"FloodWait {e_flood_send.seconds}s ke {target_peer_id_int} untuk {chat_id}; tidak dicoba lagi di siklus ini.")
+                report.record_failure(target_peer_id_int, e_flood_send, time.monotonic() - send_started)
+        except (ChatWriteForbiddenError, ChatRestrictedError, UserBannedInChannelError) as e_perm_send:
+            logger.warning(f"Gagal mengirim ke {target_peer_id_int}: {type(e_perm_send).__name__}. Userbot tidak punya izin. (Pengguna: {chat_id})")
+            report.record_failure(target_peer_id_int, e_perm_send, time.monotonic() - send_started)
+        except (ChannelPrivateError, ChatAdminRequiredError, UserIsBlockedError, UserNotMutualContactError, UserPrivacyRestrictedError) as e_fatal_access:
+            logger.error(f"Gagal mengakses {target_peer_id_int}: {type(e_fatal_access).__name__}. Grup akan dihapus dari daftar. (Pengguna: {chat_id})")
+            report.record_failure(target_peer_id_int, e_fatal_access, time.monotonic() - send_started)
+            
+            original_target_str_to_remove = resolved_targets.peer_targets.get(target_peer_id_int)
+            if original_target_str_to_remove: resolved_targets.mark_removed(original_target_str_to_remove, str(e_fatal_access))
+
+        except ConnectionError as e_conn_send:
+            logger.warning(f"ConnectionError saat mengirim ke {target_peer_id_int} untuk {chat_id}: {e_conn_send}. Memeriksa sesi.")
+            if not await verify_session(user_client, chat_id):
+                logger.error(f"Klien untuk {chat_id} gagal diverifikasi. Sesi tidak dapat dipulihkan.")
+                return await finish_delivery_report(report, aborted=True) 
+            continue 
+        except ValueError as ve: 
+            logger.error(f"ValueError saat mengirim ke {target_peer_id_int} untuk {chat_id}: {ve}", exc_info=True)
+            report.record_failure(target_peer_id_int, ve, time.monotonic() - send_started)
+        except Exception as e_general_send:
+            logger.error(f"Error umum saat mengirim ke {target_peer_id_int} untuk {chat_id}: {e_general_send}", exc_info=True)
+            report.record_failure(target_peer_id_int, e_general_send, time.monotonic() - send_started)
+        finally:
+            pacer.on_request(flood_seconds)
+
+        attempted_count += 1
+        if ready_targets or parked_targets:
+            await progress.update(f"{action_name}: {attempted_count} percobaan, {len(report.succeeded)}/{len(valid_targets_peer_ids)} berhasil, {len(parked_targets)} ditunda...")
+
+    return await finish_delivery_report(report)
 
 async def forward_and_copy_task(chat_id):
     """Tugas latar belakang untuk meneruskan dan menyalin pesan."""
@@ -1926,36 +4075,35 @@ async def forward_and_copy_task(chat_id):
 
             # --- Cek Kedaluwarsa Mode ---
             now = int(time.time())
-            made_changes = False
+            expired_modes = {} # Hanya field yang berubah; snapshot bot_data bisa memuat kunci yang sudah dicabut/kedaluwarsa
             if bot_data.get('is_forwarding') and bot_data.get('forward_expiry_timestamp') and now >= bot_data.get('forward_expiry_timestamp'):
-                bot_data['is_forwarding'] = False
-                bot_data['forward_expiry_timestamp'] = None
-                made_changes = True
+                expired_modes.update({'is_forwarding': False, 'forward_expiry_timestamp': None})
                 await bot.send_message(chat_id, "Waktu untuk mode Forward telah berakhir.")
             
             if bot_data.get('is_copying') and bot_data.get('copy_expiry_timestamp') and now >= bot_data.get('copy_expiry_timestamp'):
-                bot_data['is_copying'] = False
-                bot_data['copy_expiry_timestamp'] = None
-                made_changes = True
+                expired_modes.update({'is_copying': False, 'copy_expiry_timestamp': None})
                 await bot.send_message(chat_id, "Waktu untuk mode Copy telah berakhir.")
             
-            if made_changes:
-                await update_user_data_db(chat_id, bot_data_update=bot_data)
+            if expired_modes:
+                await update_user_data_db(chat_id, bot_data_update=expired_modes)
+                bot_data.update(expired_modes)
             
             # --- Periksa Kondisi Loop ---
             if not (bot_data.get('is_forwarding') or bot_data.get('is_copying')):
                 logger.info(f"Tidak ada mode aktif untuk {chat_id}. Menghentikan task.")
                 break
 
-            target_groups = bot_data.get('target_groups', [])
-            if not target_groups:
+            resolved_targets = await get_resolved_targets(chat_id, current_client)
+            if not (resolved_targets.peers or resolved_targets.removals):
                 logger.info(f"Tidak ada grup target untuk {chat_id}, menunggu.")
                 await asyncio.sleep(bot_data.get('delay', 120))
                 continue
+            progress = ProgressReporter(chat_id, "Ringkasan siklus")
 
             # --- Logika Forward ---
-            if bot_data.get('is_forwarding') and bot_data.get('forward_sets'):
-                for fwd_set in bot_data.get('forward_sets'):
+            forward_sets = await fetch_list_items(chat_id, 'forward_sets') if bot_data.get('is_forwarding') else []
+            if bot_data.get('is_forwarding') and forward_sets:
+                for fwd_set in forward_sets:
                     if fwd_set.get('type') == 'single':
                         link = fwd_set.get('link')
                         if not link: continue
@@ -1965,9 +4113,9 @@ async def forward_and_copy_task(chat_id):
                             msg_id = int(msg_parts[-1])
                             async def do_forward(client, to_chat_id, _): # _ adalah placeholder untuk item_to_send
                                 await client.forward_messages(to_chat_id, msg_id, from_chat)
-                            if not await send_messages_in_batches(current_client, target_groups, do_forward, chat_id, "Forward Single Link", item_to_send=None):
+                            if (await send_messages_in_batches(current_client, resolved_targets, do_forward, chat_id, "Forward Single Link", progress)).aborted:
                                 await update_user_data_db(chat_id, bot_data_update={'is_forwarding': False}); break
-                        except Exception as e: await bot.send_message(chat_id, f"Error memproses single link {link}: {e}")
+                        except Exception as e: progress.note(f"Error memproses single link {link}: {e}")
                     
                     elif fwd_set.get('type') == 'dual':
                         link1, link2, local_delay = fwd_set.get('link1'), fwd_set.get('link2'), fwd_set.get('delay', 1)
@@ -1979,55 +4127,24 @@ async def forward_and_copy_task(chat_id):
                                 await client.forward_messages(to_chat_id, msg_id1, from_chat1)
                                 await asyncio.sleep(local_delay)
                                 await client.forward_messages(to_chat_id, msg_id2, from_chat2)
-                            if not await send_messages_in_batches(current_client, target_groups, do_dual_forward, chat_id, "Forward Dual Link", item_to_send=None):
+                            if (await send_messages_in_batches(current_client, resolved_targets, do_dual_forward, chat_id, "Forward Dual Link", progress)).aborted:
                                 await update_user_data_db(chat_id, bot_data_update={'is_forwarding': False}); break
-                        except Exception as e: await bot.send_message(chat_id, f"Error memproses dual link: {e}")
+                        except Exception as e: progress.note(f"Error memproses dual link: {e}")
                     await asyncio.sleep(1) # Jeda kecil antar set link
                 
             # --- Logika Copy ---
-            if bot_data.get('is_copying') and bot_data.get('saved_texts'):
-                item_to_copy = bot_data['saved_texts'][0]
-                
-                async def do_copy_actual(client, to_chat_id, item_to_process_original):
-                    item_to_process = copy.deepcopy(item_to_process_original) 
-                    text_to_send = item_to_process.get('text', "") 
-                    entities_original = item_to_process.get('entities', [])
-                    media_id_to_send = item_to_process.get('media_file_id')
-                    
-                    watermark_to_apply = ""
-                    key_type = bot_data.get('active_key_type')
-
-                    if key_type == 'vip' and bot_data.get('watermark_enabled', False):
-                        watermark_to_apply = bot_data.get('watermark_text', DEFAULT_GLOBAL_WATERMARK_TEXT)
-                    elif key_type == 'basic' and bot_data.get('assigned_basic_watermark_text'):
-                        watermark_to_apply = bot_data.get('assigned_basic_watermark_text')
-                    elif is_admin(chat_id) and bot_data.get('watermark_enabled', False): 
-                         watermark_to_apply = bot_data.get('watermark_text', DEFAULT_GLOBAL_WATERMARK_TEXT)
-
-                    if watermark_to_apply:
-                        if text_to_send: text_to_send = f"{text_to_send}\n\n{watermark_to_apply}"
-                        elif media_id_to_send: text_to_send = watermark_to_apply 
-                    
-                    final_entities = None; final_parse_mode = None
-                    if watermark_to_apply and entities_original:
-                        if re.search(r"[*_`~[\]()]", text_to_send): final_parse_mode = 'md'
-                    elif not watermark_to_apply and entities_original:
-                        final_entities = [dict_to_entity(e) for e in entities_original if e]; final_entities = [e for e in final_entities if e is not None]
-                    elif text_to_send and re.search(r"\[.*?\]\(https?://.*?\)", text_to_send): final_parse_mode = 'md'
-                    
-                    send_params = {'link_preview': False}
-                    if final_entities: send_params['formatting_entities'] = final_entities
-                    if final_parse_mode: send_params['parse_mode'] = final_parse_mode
-                    
-                    if media_id_to_send:
-                        await client.send_file(to_chat_id, media_id_to_send, caption=text_to_send, **send_params)
-                    elif text_to_send: 
-                        await client.send_message(to_chat_id, text_to_send, **send_params)
-                    else: logger.warning(f"Tidak ada yang dikirim ke {to_chat_id} untuk item: {item_to_process.get('id')}")
-
-                if not await send_messages_in_batches(current_client, target_groups, do_copy_actual, chat_id, "Copy Konten", item_to_send=item_to_copy):
-                    await update_user_data_db(chat_id, bot_data_update={'is_copying': False}); break
-
+            first_saved_rows = await fetch_list_page(chat_id, 'saved_texts', 0, 1) if bot_data.get('is_copying') else []
+            if bot_data.get('is_copying') and first_saved_rows:
+                copy_payload = get_compiled_payload(chat_id, first_saved_rows[0][1], bot_data)
+                async def do_copy_actual(client, to_chat_id, payload): await payload.send(client, to_chat_id)
+
+                if copy_payload.is_empty(): logger.warning(f"Tidak ada yang dikirim untuk item: {copy_payload.item_id} ({chat_id})")
+                elif (await send_messages_in_batches(current_client, resolved_targets, do_copy_actual, chat_id, "Copy Konten", progress, item_to_send=copy_payload)).aborted:
+                    await update_user_data_db(chat_id, bot_data_update={'is_copying': False})
+                    await progress.finish(); break
+
+            await apply_target_removals(chat_id, resolved_targets, progress)
+            if progress.reports or progress.notes: await progress.finish()
             gc.collect()
             await asyncio.sleep(bot_data.get('delay', 120))
         except asyncio.CancelledError:
@@ -2046,66 +4163,244 @@ async def forward_and_copy_task(chat_id):
     logger.info(f"Tugas untuk {chat_id} telah berakhir.")
 
 
+# --- Broadcast Admin ---
+class BroadcastRateLimiter:
+    """Membatasi laju kirim broadcast dan menahan semua pengiriman saat FloodWait."""
+    def __init__(self, rate_per_second):
+        self.interval = 1.0 / rate_per_second
+        self.next_slot = 0.0
+        self.paused_until = 0.0
+
+    async def wait(self):
+        now = loop.time()
+        slot = max(now, self.next_slot, self.paused_until)
+        self.next_slot = slot + self.interval
+        if slot > now: await asyncio.sleep(slot - now)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, loop.time() + seconds)
+
+async def create_broadcast_job(admin_chat_id, message_text, progress_message_id=None):
+    job_id = uuid4().hex[:16]
+    created_at = int(time.time())
+    recipient_count = await storage.create_broadcast_job(job_id, admin_chat_id, message_text, progress_message_id, created_at, INSTANCE_ID, created_at + BROADCAST_LEASE_SECONDS)
+    logger.info(f"Job broadcast {job_id} dibuat oleh admin {admin_chat_id} untuk {recipient_count} penerima.")
+    return job_id, recipient_count
+
+async def fetch_broadcast_counts(job_id):
+    counts = {'pending': 0, 'sent': 0, 'failed': 0}
+    for row in await storage.fetch_broadcast_counts(job_id):
+        counts[row['status']] = row['total']
+    return counts
+
+async def persist_broadcast_results(job_id, results):
+    if not results: return
+    rows = [(job_id, recipient_id, status, error) for recipient_id, status, error in results]
+    results.clear()
+    await storage.update_broadcast_recipients(rows)
+
+def format_broadcast_progress(counts, finished=False):
+    done = counts['sent'] + counts['failed']
+    total = done + counts['pending']
+    if finished: return f"Broadcast selesai. Terkirim: {counts['sent']}, Gagal: {counts['failed']}."
+    return f"Broadcast berjalan... {done}/{total} (Terkirim: {counts['sent']}, Gagal: {counts['failed']})"
+
+async def keep_broadcast_lease(job_id, job_task):
+    """Perpanjang lease job selama berjalan; bila lease hilang (diambil proses lain atau tidak bisa diperpanjang
+    sebelum kedaluwarsa) job di proses ini dihentikan agar penerima tidak dikirimi dua kali."""
+    lease_until = int(time.time()) + BROADCAST_LEASE_SECONDS
+    while True:
+        await asyncio.sleep(BROADCAST_LEASE_SECONDS / 3)
+        try:
+            if not await storage.renew_broadcast_lease(job_id, INSTANCE_ID, int(time.time()) + BROADCAST_LEASE_SECONDS):
+                logger.warning(f"Lease job broadcast {job_id} tidak lagi dimiliki instance {INSTANCE_ID}. Menghentikan job di sini.")
+                job_task.cancel(); return
+            lease_until = int(time.time()) + BROADCAST_LEASE_SECONDS
+        except Exception as e_lease:
+            logger.error(f"Gagal memperpanjang lease job broadcast {job_id}: {e_lease}")
+            if time.time() >= lease_until: job_task.cancel(); return
+
+async def run_broadcast_job(job_id):
+    job = await storage.fetch_broadcast_job(job_id)
+    if not job: return
+    lease_task = asyncio.create_task(keep_broadcast_lease(job_id, asyncio.current_task()))
+    counts = await fetch_broadcast_counts(job_id)
+    admin_chat_id, message_text = job['admin_chat_id'], job['message_text']
+    progress = ProgressReporter(admin_chat_id, "Broadcast", message_id=job['progress_message_id'], min_interval=BROADCAST_PROGRESS_INTERVAL)
+    limiter = BroadcastRateLimiter(BROADCAST_RATE_PER_SECOND)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    results, in_flight = [], set()
+
+    async def report_progress(force=False):
+        previous_message_id = progress.message_id
+        if force: await progress.finish(format_broadcast_progress(counts, finished=True), buttons=admin_main_menu()[1])
+        else: await progress.update(format_broadcast_progress(counts))
+        if progress.message_id and progress.message_id != previous_message_id:
+            try: await storage.set_broadcast_progress_message(job_id, progress.message_id)
+            except Exception as e_progress: logger.warning(f"Gagal menyimpan pesan progres broadcast {job_id}: {e_progress}")
+
+    async def send_to_recipient(recipient_id):
+        try:
+            while True:
+                await limiter.wait()
+                try:
+                    await bot.send_message(recipient_id, message_text)
+                    results.append((recipient_id, 'sent', None)); counts['sent'] += 1
+                    break
+                except FloodWaitError as e_flood:
+                    logger.warning(f"FloodWait {e_flood.seconds} detik pada broadcast {job_id}. Menjeda pengiriman.")
+                    limiter.pause(e_flood.seconds + 1)
+                except Exception as e_send:
+                    results.append((recipient_id, 'failed', f"{type(e_send).__name__}: {e_send}"[:200])); counts['failed'] += 1
+                    break
+            counts['pending'] -= 1
+            if len(results) >= BROADCAST_STATUS_FLUSH_SIZE: await persist_broadcast_results(job_id, results)
+            await report_progress()
+        finally: semaphore.release()
+
+    logger.info(f"Menjalankan job broadcast {job_id} ({counts['pending']} penerima tersisa).")
+    try:
+        async for recipient_id in storage.iter_pending_broadcast_recipients(job_id):
+            await semaphore.acquire()
+            send_task = asyncio.create_task(send_to_recipient(recipient_id))
+            in_flight.add(send_task); send_task.add_done_callback(in_flight.discard)
+        if in_flight: await asyncio.gather(*in_flight)
+        await persist_broadcast_results(job_id, results)
+        await storage.finish_broadcast_job(job_id, int(time.time()))
+        counts = await fetch_broadcast_counts(job_id)
+        logger.info(f"Job broadcast {job_id} selesai. Terkirim: {counts['sent']}, Gagal: {counts['failed']}.")
+        await report_progress(force=True)
+    except asyncio.CancelledError:
+        for send_task in list(in_flight): send_task.cancel()
+        try: await persist_broadcast_results(job_id, results)
+        except Exception: pass
+        raise
+    except Exception as e_job:
+        logger.error(f"Error pada job broadcast {job_id}, akan dilanjutkan saat restart: {e_job}", exc_info=True)
+        try: await persist_broadcast_results(job_id, results)
+        except Exception: pass
+    finally:
+        lease_task.cancel()
+        broadcast_tasks.pop(job_id, None)
+
+def start_broadcast_job(job_id):
+    if job_id in broadcast_tasks and not broadcast_tasks[job_id].done(): return
+    broadcast_tasks[job_id] = asyncio.create_task(run_broadcast_job(job_id))
+
+async def resume_broadcast_jobs():
+    """Klaim job yang tidak punya pemilik aktif (lease kosong/kedaluwarsa) dan jalankan di instance ini."""
+    now = int(time.time())
+    try:
+        claimed_job_ids = await storage.claim_broadcast_jobs(INSTANCE_ID, now, now + BROADCAST_LEASE_SECONDS)
+    except Exception as e_resume:
+        logger.error(f"Gagal mengklaim job broadcast yang belum selesai: {e_resume}", exc_info=True); return
+    for claimed_job_id in claimed_job_ids:
+        logger.info(f"Melanjutkan job broadcast {claimed_job_id} yang terhenti (instance {INSTANCE_ID}).")
+        start_broadcast_job(claimed_job_id)
+
+async def broadcast_job_claimer():
+    """Job milik instance yang mati diambil alih setelah lease-nya habis, bukan hanya saat startup."""
+    while True:
+        await resume_broadcast_jobs()
+        await asyncio.sleep(BROADCAST_LEASE_SECONDS)
+
 # --- Fungsi Periodik ---
 async def clean_cache(): 
     while True:
         try:
-            # ... (logika pembersihan cache)
-            await asyncio.sleep(CACHE_TTL) 
+            await asyncio.sleep(USER_CACHE_SWEEP_INTERVAL)
+            expired_count = user_data_cache.sweep(time.time())
+            for snapshot_chat_id in [cid for cid, snapshot in dialog_snapshots.items() if time.time() - snapshot.taken_at >= DIALOG_SNAPSHOT_TTL]: del dialog_snapshots[snapshot_chat_id]
+            # Set target dan pacer hanya dibutuhkan selama task copy berjalan
+            for idle_chat_id in [cid for cid in resolved_target_sets if not user_task_running(cid)]: drop_resolved_targets(idle_chat_id)
+            for idle_chat_id in [cid for cid, pacer in client_pacers.items() if not user_task_running(cid) and pacer.hold_until <= time.monotonic()]: del client_pacers[idle_chat_id]
+            cache_stats = user_data_cache.stats()
+            (logger.info if expired_count else logger.debug)(f"Cache state pengguna: {expired_count} entri kedaluwarsa dibuang; {cache_stats}; load digabung: {user_data_loads.coalesced}; total kirim: { {action: dict(totals) for action, totals in delivery_totals.items()} }")
         except Exception as e_clean_cache: logger.error(f"Error membersihkan cache: {e_clean_cache}", exc_info=True); await asyncio.sleep(CACHE_TTL * 2)
 
-async def check_user_keys_and_sessions():
-    await asyncio.sleep(60) 
+async def prune_delivery_reports_periodically():
+    """Hapus laporan pengiriman lama; terpisah dari sweep cache agar DELETE tidak jalan tiap menit dan gagalnya tidak menunda sweep."""
+    while True:
+        await asyncio.sleep(DELIVERY_REPORT_PRUNE_INTERVAL)
+        try: await storage.prune_delivery_reports(time.time() - DELIVERY_REPORT_RETENTION)
+        except Exception as e_prune: logger.error(f"Error menghapus laporan pengiriman lama: {e_prune}", exc_info=True)
+
+def schedule_key_expiry(chat_id, expiry_ts):
+    """Daftarkan kedaluwarsa kunci ke timer in-process bila jatuh sebelum sweep berikutnya."""
+    if not expiry_ts or is_admin(chat_id) or expiry_ts > time.time() + KEY_CHECK_INTERVAL: return
+    heapq.heappush(key_expiry_heap, (expiry_ts, chat_id))
+    if key_expiry_heap[0] == (expiry_ts, chat_id): key_expiry_wakeup.set()
+
+async def expire_user_keys(now, chat_ids=None):
+    expired_chat_ids = await storage.expire_user_keys(now, chat_ids, ADMIN_IDS)
+    if expired_chat_ids: invalidate_active_user_count()
+    for chat_id_expired in expired_chat_ids:
+        logger.info(f"Kunci untuk pengguna {chat_id_expired} telah kedaluwarsa. Menghapus akses.")
+        client_expired = user_clients.pop(chat_id_expired, None)
+        if client_expired and client_expired.is_connected():
+            try: await client_expired.disconnect()
+            except Exception as e_disc: logger.error(f"Error disconnect user client {chat_id_expired} saat kunci kedaluwarsa: {e_disc}")
+        task_expired = user_tasks.pop(chat_id_expired, None)
+        if task_expired and not task_expired.done(): task_expired.cancel()
+        discard_pending_user_writes(chat_id_expired)
+        user_data_cache.pop(chat_id_expired, None)
+        warning_counts.pop(chat_id_expired, None)
+        # Daftar item dan handle media sudah dihapus storage.expire_user_keys; buang salinan di memori
+        release_user_runtime_state(chat_id_expired)
+        try: await bot.send_message(chat_id_expired, "Maaf, kunci akses Anda telah kedaluwarsa.")
+        except Exception: pass
+    return len(expired_chat_ids)
+
+async def sweep_key_expiries(now):
+    """Cabut semua kunci yang sudah lewat dan muat kedaluwarsa sebelum sweep berikutnya ke heap."""
+    expired_count = await expire_user_keys(now)
+    upcoming_rows = await storage.fetch_upcoming_key_expiries(now, now + KEY_CHECK_INTERVAL, ADMIN_IDS)
+    key_expiry_heap.clear()
+    key_expiry_heap.extend((row['key_expiry_ts'], row['chat_id']) for row in upcoming_rows)
+    heapq.heapify(key_expiry_heap)
+    logger.info(f"Sweep kedaluwarsa kunci: {expired_count} dicabut, {len(key_expiry_heap)} dijadwalkan sebelum sweep berikutnya.")
+
+async def key_expiry_scheduler():
+    next_sweep_ts = 0.0
     while True:
-        logger.info("Memulai pemeriksaan periodik kunci pengguna dan sesi...")
-        current_ts = int(time.time())
         try:
-            async with db_pool.acquire() as conn:
-                users_with_keys = await conn.fetch("SELECT chat_id, bot_data FROM users WHERE (bot_data->>'has_valid_key')::boolean = TRUE")
-
-            for user_record in users_with_keys:
-                chat_id_check = user_record['chat_id']
-                if is_admin(chat_id_check): continue 
-
-                bot_data_check = json.loads(user_record['bot_data']) if user_record['bot_data'] else {}
-                key_expiry_ts = bot_data_check.get('key_expiry_timestamp')
-                is_userbot_registered = bot_data_check.get('is_registered', False)
-
-                if key_expiry_ts and current_ts >= key_expiry_ts:
-                    logger.info(f"Kunci untuk pengguna {chat_id_check} telah kedaluwarsa. Menghapus akses.")
-                    try: await bot.send_message(chat_id_check, "Maaf, kunci akses Anda telah kedaluwarsa.")
-                    except: pass 
-                    await logout_user(chat_id_check, "KEY_EXPIRED") 
-                    await update_user_data_db(chat_id_check, bot_data_update={'awaiting_input_type': None, 'has_valid_key': False}) 
-                    continue 
-
-                if is_userbot_registered:
-                    user_client_check = user_clients.get(chat_id_check)
-                    if not user_client_check: 
-                        _ph_rec, _ss_rec, _bd_rec = await get_user_data(chat_id_check)
-                        if _ss_rec:
-                             user_client_check = TelegramClient(StringSession(_ss_rec), API_ID, API_HASH, loop=loop)
-                             user_clients[chat_id_check] = user_client_check
-                        else: 
-                            await update_user_data_db(chat_id_check, bot_data_update={'is_registered': False})
-                            continue 
-
-                    if user_client_check and (not await ensure_connected(user_client_check, chat_id_check) or \
-                       not await verify_session(user_client_check, chat_id_check)):
-                        logger.warning(f"Sesi userbot untuk {chat_id_check} tidak valid. Coba reconnect.")
-                        if not await reconnect_client(user_client_check, chat_id_check):
-                            logger.error(f"Gagal reconnect userbot untuk {chat_id_check}. Logout userbot.")
-                            await update_user_data_db(chat_id_check, bot_data_update={'is_registered': False, 'session_string': None})
-                            try: await bot.send_message(chat_id_check, "Sesi userbot Anda terputus. Silakan login kembali.")
-                            except:pass
-
-                if bot_data_check.get('has_valid_key') and bot_data_check.get('is_registered') and (is_admin(chat_id_check) or bot_data_check.get('key_expiry_timestamp',0) > current_ts):
+            now = time.time()
+            if now >= next_sweep_ts:
+                await sweep_key_expiries(now)
+                next_sweep_ts = now + KEY_CHECK_INTERVAL
+            due_chat_ids = set()
+            while key_expiry_heap and key_expiry_heap[0][0] <= now:
+                due_chat_ids.add(heapq.heappop(key_expiry_heap)[1])
+            if due_chat_ids: await expire_user_keys(now, list(due_chat_ids))
+            wake_at = min(key_expiry_heap[0][0], next_sweep_ts) if key_expiry_heap else next_sweep_ts
+            key_expiry_wakeup.clear()
+            try: await asyncio.wait_for(key_expiry_wakeup.wait(), timeout=max(wake_at - time.time(), 0))
+            except asyncio.TimeoutError: pass
+        except Exception as e_expiry:
+            logger.error(f"Error dalam penjadwal kedaluwarsa kunci: {e_expiry}", exc_info=True)
+            await asyncio.sleep(60)
+
+async def check_user_sessions():
+    await asyncio.sleep(60) 
+    while True:
+        logger.info("Memulai pemeriksaan periodik sesi userbot...")
+        for chat_id_check, user_client_check in list(user_clients.items()):
+            try:
+                if not await ensure_connected(user_client_check, chat_id_check) or not await verify_session(user_client_check, chat_id_check):
+                    logger.warning(f"Sesi userbot untuk {chat_id_check} tidak valid. Coba reconnect.")
+                    if not await reconnect_client(user_client_check, chat_id_check):
+                        logger.error(f"Gagal reconnect userbot untuk {chat_id_check}. Logout userbot.")
+                        await update_user_data_db(chat_id_check, bot_data_update={'is_registered': False, 'session_string': None})
+                        try: await bot.send_message(chat_id_check, "Sesi userbot Anda terputus. Silakan login kembali.")
+                        except:pass
+                        continue
+                _ph_check, _ss_check, bot_data_check = await get_user_data(chat_id_check)
+                if bot_data_check.get('has_valid_key') and bot_data_check.get('is_registered') and (is_admin(chat_id_check) or (bot_data_check.get('key_expiry_timestamp') or 0) > time.time()):
                     await manage_forward_copy_task(chat_id_check, bot_data_check)
-                await asyncio.sleep(0.2) 
-        except Exception as e_periodic_keys:
-            logger.error(f"Error dalam pemeriksaan periodik kunci/sesi: {e_periodic_keys}", exc_info=True)
+            except Exception as e_periodic_session:
+                logger.error(f"Error dalam pemeriksaan periodik sesi untuk {chat_id_check}: {e_periodic_session}", exc_info=True)
         
-        logger.info(f"Pemeriksaan periodik kunci/sesi selesai. Berikutnya dalam {KEY_CHECK_INTERVAL // 60} menit.")
+        logger.info(f"Pemeriksaan periodik sesi selesai. Berikutnya dalam {KEY_CHECK_INTERVAL // 60} menit.")
         await asyncio.sleep(KEY_CHECK_INTERVAL)
 
 async def reconnect_client(client_instance_rc, chat_id_rc, max_attempts_rc=2): 
@@ -2147,33 +4442,32 @@ async def main():
     try: await init_db()
     except Exception as e_db_init: return 
 
+    if not INSTANCE_NAME_FROM_ENV:
+        logger.warning(f"INSTANCE_NAME tidak diset; memakai '{INSTANCE_NAME}'. Set INSTANCE_NAME unik bila beberapa proses di host dan direktori yang sama memakai DB yang sama.")
     try:
-        if db_pool:
-            async with db_pool.acquire() as conn_main:
-                await conn_main.execute(
-                    """
-                    UPDATE users
-                    SET bot_data = bot_data - 'is_registered' - 'session_string' || jsonb_build_object('is_registered', false, 'session_string', null)
-                    WHERE (bot_data->>'is_registered')::boolean = TRUE OR bot_data->>'session_string' IS NOT NULL;
-                    """
-                )
-                logger.info("Semua sesi userbot yang ada telah direset di DB (is_registered=false, session_string=null). Info kunci dijaga.")
-                user_clients.clear()
-                for task_key in list(user_tasks.keys()): 
-                    if user_tasks[task_key] and not user_tasks[task_key].done():
-                        user_tasks[task_key].cancel()
-                    del user_tasks[task_key] 
-                user_data_cache.clear() 
+        if storage:
+            reset_count = await storage.reset_userbot_sessions(INSTANCE_NAME)
+            logger.info(f"{reset_count} sesi userbot milik instance {INSTANCE_NAME} direset di DB (is_registered=false, session_string=null). Info kunci dijaga.")
+            user_clients.clear()
+            for task_key in list(user_tasks.keys()): 
+                if user_tasks[task_key] and not user_tasks[task_key].done():
+                    user_tasks[task_key].cancel()
+                del user_tasks[task_key] 
+            user_data_cache.clear() 
     except Exception as e_startup_reset:
         logger.critical(f"Error kritis saat mereset sesi userbot di startup: {e_startup_reset}", exc_info=True)
 
     asyncio.create_task(clean_cache())
-    asyncio.create_task(check_user_keys_and_sessions()) 
+    asyncio.create_task(prune_delivery_reports_periodically())
+    asyncio.create_task(user_cache_listener())
+    asyncio.create_task(key_expiry_scheduler())
+    asyncio.create_task(check_user_sessions())
     
     try:
         logger.info("Memulai bot utama...")
         await bot.start(bot_token=BOT_TOKEN)
         logger.info("Bot utama berhasil dimulai.")
+        asyncio.create_task(broadcast_job_claimer())
         await bot.run_until_disconnected()
     except Exception as e_main_run: logger.critical(f"Error kritis di fungsi utama: {e_main_run}", exc_info=True)
     finally:
@@ -2185,6 +4479,10 @@ async def main():
                 except: pass 
             if client_id_shutdown_val in user_clients: del user_clients[client_id_shutdown_val]
         
+        for broadcast_task in list(broadcast_tasks.values()):
+            if not broadcast_task.done(): broadcast_task.cancel()
+        if broadcast_tasks: await asyncio.gather(*broadcast_tasks.values(), return_exceptions=True)
+
         for task_key_shutdown in list(user_tasks.keys()): 
             if user_tasks[task_key_shutdown] and not user_tasks[task_key_shutdown].done():
                 user_tasks[task_key_shutdown].cancel()
@@ -2194,7 +4492,10 @@ async def main():
             try: await bot.disconnect()
             except: pass
         
-        if db_pool: await db_pool.close()
+        if storage:
+            try: await flush_all_user_data()
+            except Exception as e_flush_shutdown: logger.error(f"Gagal flush data tertunda saat shutdown: {e_flush_shutdown}", exc_info=True)
+            await storage.close()
         logger.info("Bot telah dimatikan.")
 
 if __name__ == '__main__':
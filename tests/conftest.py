@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault('API_ID', '1')
+os.environ.setdefault('API_HASH', 'test')
+os.environ.setdefault('STORAGE_BACKEND', 'sqlite')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('telethon')
+import Kelana  # noqa: E402
+
+
+@pytest.fixture
+def run():
+    """Jalankan coroutine di event loop milik modul (SQLiteStorage memakai loop global itu)."""
+    return Kelana.loop.run_until_complete
+
+
+@pytest.fixture
+def sqlite_storage(run):
+    sqlite_storage = Kelana.SQLiteStorage(':memory:')
+    run(sqlite_storage.initialize())
+    yield sqlite_storage
+    run(sqlite_storage.close())
+
+
+@pytest.fixture
+def user_state(run, sqlite_storage, monkeypatch):
+    """Storage global diganti SQLite in-memory; cache dan buffer write-behind dikosongkan sebelum dan sesudah tes."""
+    monkeypatch.setattr(Kelana, 'storage', sqlite_storage)
+    monkeypatch.setattr(Kelana, 'RETRY_DELAY', 0)
+    monkeypatch.setattr(Kelana, 'WRITE_BEHIND_DELAY', 60) # tes memanggil flush_user_data sendiri
+    Kelana.user_data_cache.clear()
+    Kelana.pending_user_writes.clear()
+    yield Kelana
+    for flush_task in list(Kelana.pending_flush_tasks.values()): flush_task.cancel()
+    run(Kelana.asyncio.sleep(0))
+    Kelana.pending_flush_tasks.clear()
+    Kelana.pending_user_writes.clear()
+    Kelana.user_data_cache.clear()
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import time
+
+import Kelana
+
+
+def make_cache(max_entries=2, max_bytes=10 ** 9, ttl=60, pinned=()):
+    return Kelana.UserStateCache(max_entries, max_bytes, lambda: ttl, lambda chat_id: chat_id in pinned)
+
+
+def cache_entry(ts=None, **bot_data):
+    return (time.time() if ts is None else ts, None, None, Kelana.UserState(bot_data))
+
+
+def test_user_state_cache_evicts_least_recently_used():
+    cache = make_cache()
+    cache[1] = cache_entry()
+    cache[2] = cache_entry()
+    assert cache.lookup(1) is not None
+    cache[3] = cache_entry()
+    assert 2 not in cache and 1 in cache and 3 in cache
+    assert cache.evictions == 1
+
+
+def test_user_state_cache_keeps_pinned_entries():
+    cache = make_cache(max_entries=1, pinned={1})
+    cache[1] = cache_entry()
+    cache[2] = cache_entry()
+    assert 1 in cache and 2 not in cache
+
+
+def test_user_state_cache_byte_budget_and_accounting():
+    entry_size = Kelana.UserStateCache.estimate_size(cache_entry())
+    cache = make_cache(max_entries=10, max_bytes=entry_size * 2)
+    for chat_id in range(3): cache[chat_id] = cache_entry()
+    assert len(cache) == 2 and cache.total_bytes <= entry_size * 2
+    cache.pop(1); cache.pop(2)
+    assert cache.total_bytes == 0
+
+
+def test_user_state_cache_ttl_lookup_and_sweep():
+    cache = make_cache(max_entries=10, ttl=60, pinned={2})
+    cache[1] = cache_entry(ts=time.time() - 120)
+    cache[2] = cache_entry(ts=time.time() - 120)
+    assert cache.lookup(1) is None and cache.misses == 1
+    assert cache.sweep(time.time()) == 1
+    assert 1 not in cache and 2 in cache
+
+
+def test_user_state_copy_is_independent_for_scalars():
+    state = Kelana.UserState({'delay': 3})
+    clone = state.copy()
+    clone['delay'] = 9
+    assert state['delay'] == 3 and clone['delay'] == 9
+    assert json.loads(state.to_json())['delay'] == 3
+
+
+def test_single_flight_coalesces_concurrent_loads(run):
+    single_flight = Kelana.SingleFlight()
+    load_calls = []
+
+    async def loader():
+        load_calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'hasil'
+
+    async def run_both():
+        return await asyncio.gather(single_flight.run('k', loader), single_flight.run('k', loader))
+
+    assert run(run_both()) == ['hasil', 'hasil']
+    assert len(load_calls) == 1 and single_flight.coalesced == 1 and not single_flight.in_flight
+
+
+def test_client_pacer_holds_client_on_flood_and_pauses_after_burst():
+    pacer = Kelana.ClientPacer(min_interval=0.1, burst_size=2, burst_pause=5)
+    pacer.on_request()
+    assert pacer.next_send_at - time.monotonic() <= 0.1
+    pacer.on_request()
+    assert pacer.next_send_at - time.monotonic() > 4
+    pacer.on_request(flood_seconds=30)
+    assert pacer.hold_until - time.monotonic() > 29
+
+
+def test_delivery_report_keeps_first_failure_until_success():
+    report = Kelana.DeliveryReport(1, 'Copy')
+    report.record_failure(10, ValueError('a'), latency=0.2)
+    report.record_failure(10, KeyError('b'))
+    report.record_failure(11, ValueError('c'))
+    report.record_success(10, 0.4)
+    assert report.failed == {11: ('ValueError', 'c')}
+    assert report.average_latency_ms() == 400
+    assert report.summary_line() == 'Copy: 1 berhasil, 1 gagal.'
+    assert json.loads(report.to_row()[-1]) == {'ValueError': 1}
+
+
+def test_flush_writes_buffered_patch(run, user_state):
+    run(user_state.get_user_data(1))
+    run(user_state.update_user_data_db(1, bot_data_update={'delay': 7}))
+    assert 1 in user_state.pending_user_writes
+    run(user_state.flush_user_data(1))
+    assert 1 not in user_state.pending_user_writes
+    assert json.loads(run(user_state.storage.load_user(1))['bot_data'])['delay'] == 7
+
+
+def test_flush_keeps_newer_pending_update_in_cache(run, user_state, monkeypatch):
+    run(user_state.get_user_data(1))
+    original_save_user = user_state.storage.save_user
+
+    async def save_user_with_concurrent_update(*args):
+        saved_row = await original_save_user(*args)
+        monkeypatch.setattr(user_state.storage, 'save_user', original_save_user)
+        await user_state.update_user_data_db(1, bot_data_update={'delay': 9})
+        return saved_row
+
+    monkeypatch.setattr(user_state.storage, 'save_user', save_user_with_concurrent_update)
+    run(user_state.update_user_data_db(1, bot_data_update={'delay': 7}))
+    run(user_state.flush_user_data(1))
+    assert run(user_state.get_user_data(1))[2]['delay'] == 9
+    assert user_state.pending_user_writes[1]['bot_data'] == {'delay': 9}
+
+
+def test_failed_flush_requeues_patch_under_newer_update(run, user_state, monkeypatch):
+    run(user_state.get_user_data(1))
+
+    async def failing_save_user(*args):
+        await user_state.update_user_data_db(1, bot_data_update={'watermark_enabled': True})
+        raise ConnectionError('db down')
+
+    monkeypatch.setattr(user_state.storage, 'save_user', failing_save_user)
+    monkeypatch.setattr(user_state, 'RETRY_ATTEMPTS', 1)
+    run(user_state.update_user_data_db(1, bot_data_update={'delay': 7, 'watermark_enabled': False}))
+    run(user_state.flush_user_data(1))
+    assert user_state.pending_user_writes[1]['bot_data'] == {'delay': 7, 'watermark_enabled': True}
+    assert 1 in user_state.pending_flush_tasks
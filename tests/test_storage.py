@@ -0,0 +1,87 @@
+import json
+
+import Kelana
+
+
+def test_save_user_merges_patch_into_stored_bot_data(run, sqlite_storage):
+    run(sqlite_storage.save_user(1, '+62', 'sess', json.dumps({'delay': 7}), True))
+    saved_row = run(sqlite_storage.save_user(1, None, None, json.dumps({'watermark_enabled': True}), True))
+    assert saved_row['phone_number'] == '+62' and saved_row['session_string'] == 'sess'
+
+    row = run(sqlite_storage.load_user(1))
+    bot_data = json.loads(row['bot_data'])
+    assert bot_data['delay'] == 7 and bot_data['watermark_enabled'] is True
+    assert set(bot_data) == set(Kelana.DEFAULT_BOT_DATA)
+
+
+def test_save_user_skips_full_row_when_not_needed(run, sqlite_storage):
+    saved_row = run(sqlite_storage.save_user(1, None, None, '{}', False))
+    assert saved_row['bot_data'] is None
+
+
+def test_list_items_round_trip_keeps_insertion_order(run, sqlite_storage):
+    item_ids = ['-1003', '@grup_b', '-1001']
+    added = run(sqlite_storage.add_list_items(1, 'target_groups', item_ids, [json.dumps(item_id) for item_id in item_ids]))
+    assert added == 3
+    assert run(sqlite_storage.add_list_items(1, 'target_groups', ['-1003'], ['"-1003"'])) == 0
+    assert run(sqlite_storage.count_list_items(1, 'target_groups')) == 3
+    assert [item_id for item_id, _ in run(sqlite_storage.fetch_list_page(1, 'target_groups', 1, 2))] == ['@grup_b', '-1001']
+
+    assert run(sqlite_storage.delete_list_items(1, 'target_groups', ['@grup_b'])) == 1
+    assert sorted(run(sqlite_storage.fetch_list_ids(1, 'target_groups'))) == ['-1001', '-1003']
+    assert run(sqlite_storage.fetch_list_ids(2, 'target_groups')) == []
+
+    run(sqlite_storage.clear_list_items(1, 'target_groups'))
+    assert not run(sqlite_storage.has_list_items(1, 'target_groups'))
+
+
+def test_reset_userbot_sessions_only_touches_own_and_unowned(run, sqlite_storage):
+    for chat_id, owner in ((1, 'a'), (2, 'b'), (3, None)):
+        run(sqlite_storage.save_user(chat_id, None, None, json.dumps({'is_registered': True, 'session_string': 's', 'session_owner': owner}), False))
+
+    assert run(sqlite_storage.reset_userbot_sessions('a')) == 2
+    registered = {chat_id: json.loads(run(sqlite_storage.load_user(chat_id))['bot_data'])['is_registered'] for chat_id in (1, 2, 3)}
+    assert registered == {1: False, 2: True, 3: False}
+
+
+def test_media_handles_are_scoped_per_owner(run, sqlite_storage):
+    handle_row = ('document', 11, 22, b'ref', None, None)
+    run(sqlite_storage.save_media_handle(1, 'item', handle_row, 1.0))
+    run(sqlite_storage.save_media_handle(2, 'item', handle_row, 1.0))
+    run(sqlite_storage.delete_media_handles(1, ['item']))
+    assert run(sqlite_storage.fetch_media_handle(1, 'item')) is None
+    assert run(sqlite_storage.fetch_media_handle(2, 'item')) is not None
+
+
+def test_broadcast_jobs_are_claimed_once_per_lease(run, sqlite_storage):
+    run(sqlite_storage.create_broadcast_job('job', 99, 'halo', None, 0, 'proses-a', 100))
+    assert run(sqlite_storage.claim_broadcast_jobs('proses-b', 50, 110)) == []
+    assert run(sqlite_storage.claim_broadcast_jobs('proses-b', 150, 210)) == ['job']
+    assert not run(sqlite_storage.renew_broadcast_lease('job', 'proses-a', 260))
+    assert run(sqlite_storage.renew_broadcast_lease('job', 'proses-b', 260))
+
+
+def test_schema_migrations_are_ordered_and_end_at_current_version():
+    versions = [target_version for target_version, _ in Kelana.USER_SCHEMA_MIGRATIONS]
+    assert versions == sorted(set(versions))
+    assert versions[-1] == Kelana.USER_SCHEMA_VERSION
+
+
+def test_initialize_conforms_old_rows_to_defaults(run, tmp_path):
+    db_path = str(tmp_path / 'kelana.db')
+    old_storage = Kelana.SQLiteStorage(db_path)
+    run(old_storage.initialize())
+    legacy_bot_data = {'delay': 9, 'kunci_usang': 1, 'target_groups': ['-1001']}
+    run(old_storage._execute('INSERT INTO users (chat_id, bot_data, schema_version) VALUES (?, ?, ?)', (1, json.dumps(legacy_bot_data), Kelana.USER_SCHEMA_VERSION - 1)))
+    run(old_storage.close())
+
+    new_storage = Kelana.SQLiteStorage(db_path)
+    run(new_storage.initialize())
+    try:
+        bot_data = json.loads(run(new_storage.load_user(1))['bot_data'])
+        schema_version = run(new_storage._fetchone('SELECT schema_version FROM users WHERE chat_id = 1'))[0]
+    finally:
+        run(new_storage.close())
+    assert set(bot_data) == set(Kelana.DEFAULT_BOT_DATA)
+    assert bot_data['delay'] == 9 and bot_data['session_owner'] is None
+    assert schema_version == Kelana.USER_SCHEMA_VERSION